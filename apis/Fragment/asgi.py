@@ -0,0 +1,58 @@
+"""
+ASGI entry point for the Fragment API.
+
+Serves the same routes and JSON contracts as main.py from one long-lived
+event loop, awaiting the async handlers directly:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 3003
+
+In production run it under gunicorn (see gunicorn.conf.py):
+
+    gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:app
+"""
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+
+import main
+from main import ROUTES, ApiRequest, handle
+from common import metrics
+from common.tracing import REQUEST_ID_HEADER, new_request_id
+
+app = cors(Quart(__name__))
+
+
+def quart_view(handler):
+    """Wrap an async handler as a Quart view"""
+    async def view(**params):
+        req = ApiRequest(
+            headers=request.headers,
+            json=await request.get_json(silent=True),
+            args=request.args,
+            params=params,
+            request_id=new_request_id(request.headers.get(REQUEST_ID_HEADER))
+        )
+        body, status = await handle(handler, req)
+        return jsonify(body), status, {REQUEST_ID_HEADER: req.request_id}
+    view.__name__ = handler.__name__
+    view.__doc__ = handler.__doc__
+    return view
+
+
+for path, methods, handler in ROUTES:
+    app.add_url_rule(path, handler.__name__, quart_view(handler), methods=methods)
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_view():
+    """Prometheus metrics, summed over the worker processes when METRICS_DIR is set"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.before_serving
+async def startup():
+    await main.startup()
+
+
+@app.after_serving
+async def shutdown():
+    await main.shutdown()
@@ -0,0 +1 @@
+# Benchmark Suite Package
@@ -0,0 +1,324 @@
+"""
+Load driver for the Fragment API.
+
+Starts the upstream mocks (bench.mocks) and the app under test (the ASGI
+app under uvicorn, or the Flask server), drives each route open-loop at a
+target rate and reports p50/p95/p99 latency, throughput, errors and
+upstream calls per request. Latency is measured from each request's
+scheduled start, so queueing inside the app is not hidden.
+
+    python -m bench.load --rps 50 --duration 10
+    python -m bench.load --app flask --routes health,search_user --fragment-latency 0.2
+    python -m bench.load --json before.json
+    python -m bench.load --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+from bench import mocks
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_KEY = 'bench-api-key'
+INTERNAL_TOKEN = 'bench-internal-token'
+UPSTREAMS = ('node', 'fragment', 'tonapi')
+
+
+@dataclass
+class Route:
+    name: str
+    method: str
+    path: str
+    # Builds the JSON body for the i-th request
+    body: Optional[Callable[[int], Any]] = None
+    internal: bool = False
+
+
+def recipient(i: int) -> str:
+    # A small set of recipients, so recipient caching shows up as it would in production
+    return f"benchuser{i % 50}"
+
+
+ROUTES = [
+    Route('health', 'GET', '/health'),
+    Route('root', 'GET', '/'),
+    Route('wallet_info', 'GET', '/wallet-info'),
+    Route('generate_wallet', 'POST', '/generate-wallet'),
+    Route('generate_wallets', 'POST', '/generate-wallets', lambda i: {
+        "subscriptions": [{"subscriptionId": 1, "userId": 1} for _ in range(4)]
+    }, internal=True),
+    Route('search_user', 'POST', '/search-user', lambda i: {"username": recipient(i), "quantity": 50}),
+    Route('stars_price', 'GET', '/stars-price?quantity=50'),
+    Route('buy_stars', 'POST', '/buy-stars', lambda i: {"username": recipient(i), "quantity": 50}),
+    Route('buy_stars_async', 'POST', '/buy-stars', lambda i: {"username": recipient(i), "quantity": 50, "async": True}),
+    Route('buy_stars_batch', 'POST', '/buy-stars/batch', lambda i: {
+        "items": [{"username": recipient(i + k), "quantity": 50} for k in range(4)]
+    }),
+    Route('buy_stars_job', 'GET', '/buy-stars/jobs/{job_id}'),
+    Route('buy_stars_batch_status', 'GET', '/buy-stars/batches/{batch_id}'),
+    Route('wallet_balance', 'GET', '/wallet-balance'),
+    Route('invalidate_subscriptions', 'POST', '/internal/subscriptions/invalidate', lambda i: {"subscriptionId": 1}, internal=True),
+    Route('invalidate_user_context', 'POST', '/internal/user-context/invalidate', lambda i: {"userId": 1}, internal=True),
+    Route('wallet_pool', 'GET', '/internal/wallet-pool', internal=True),
+    Route('wallet_queues', 'GET', '/internal/wallet-queues', internal=True),
+    Route('singleflight', 'GET', '/internal/singleflight', internal=True),
+]
+
+
+@dataclass
+class RouteResult:
+    route: str
+    requests: int
+    ok: int
+    errors: int
+    throughput: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    upstream_per_request: Dict[str, float] = field(default_factory=dict)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of values (0 for an empty list)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def run_mocks(ports: Dict[str, int], faults: Dict[str, mocks.Faults], inclusion_delay: float) -> None:
+    asyncio.run(mocks.serve(
+        ports['node'], ports['fragment'], ports['tonapi'],
+        faults['node'], faults['fragment'], faults['tonapi'],
+        inclusion_delay,
+    ))
+
+
+def start_app(kind: str, port: int, ports: Dict[str, int], job_db: str) -> subprocess.Popen:
+    """Start the app under test pointed at the mocks"""
+    env = {
+        **os.environ,
+        "API_BASE_URL": f"http://127.0.0.1:{ports['node']}/api",
+        "FRAGMENT_API_URL": f"http://127.0.0.1:{ports['fragment']}/api",
+        "TONAPI_BASE_URL": f"http://127.0.0.1:{ports['tonapi']}/v2",
+        "INTERNAL_API_TOKEN": INTERNAL_TOKEN,
+        "JOB_DB_PATH": job_db,
+    }
+    # Mock inclusion is near-instant; poll it quickly unless told otherwise
+    env.setdefault("SEQNO_POLL_INTERVAL", "0.05")
+    # All load runs through one mock session; keep its request budget out of the way
+    env.setdefault("FRAGMENT_RATE", "1000")
+    env.setdefault("FRAGMENT_BURST", "1000")
+    env.setdefault("FRAGMENT_MAX_RATE", "1000")
+    # Stopped with a 10s timeout below; don't let queued purchases hold up the drain
+    env.setdefault("GRACEFUL_TIMEOUT", "5")
+    if kind == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, '-c', f"from main import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+
+
+async def wait_ready(client: httpx.AsyncClient, url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+
+async def upstream_calls(client: httpx.AsyncClient, ports: Dict[str, int], reset: bool = False) -> Dict[str, int]:
+    """Total calls served by each mock (optionally zeroing the counters)"""
+    calls = {}
+    for name in UPSTREAMS:
+        base = f"http://127.0.0.1:{ports[name]}"
+        stats = (await client.get(f"{base}/__stats")).json()
+        calls[name] = stats["calls"].get("total", 0)
+        if reset:
+            await client.post(f"{base}/__reset")
+    return calls
+
+
+async def run_route(
+    client: httpx.AsyncClient,
+    base_url: str,
+    route: Route,
+    rps: float,
+    duration: float,
+    ports: Dict[str, int],
+    params: Dict[str, str],
+    settle: float = 0.0,
+) -> RouteResult:
+    """Send rps * duration requests open-loop and collect latencies"""
+    headers = {"X-Internal-Token": INTERNAL_TOKEN} if route.internal else {"X-API-Key": API_KEY}
+    path = route.path.format(**params)
+    total = max(1, int(rps * duration))
+    latencies: List[float] = []
+    errors = 0
+
+    async def send(i: int, scheduled: float) -> None:
+        nonlocal errors
+        try:
+            response = await client.request(
+                route.method, base_url + path, headers=headers,
+                json=route.body(i) if route.body else None,
+            )
+            failed = response.status_code >= 400
+        except httpx.HTTPError:
+            failed = True
+        if failed:
+            errors += 1
+        else:
+            latencies.append(time.perf_counter() - scheduled)
+
+    # Let background work from the previous route finish before counting
+    await asyncio.sleep(settle)
+    await upstream_calls(client, ports, reset=True)
+    t0 = time.perf_counter()
+    tasks = []
+    for i in range(total):
+        scheduled = t0 + i / rps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(i, scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - t0
+    calls = await upstream_calls(client, ports)
+
+    return RouteResult(
+        route=route.name,
+        requests=total,
+        ok=len(latencies),
+        errors=errors,
+        throughput=round(len(latencies) / elapsed, 1),
+        p50_ms=round(percentile(latencies, 50) * 1000, 1),
+        p95_ms=round(percentile(latencies, 95) * 1000, 1),
+        p99_ms=round(percentile(latencies, 99) * 1000, 1),
+        upstream_per_request={name: round(count / total, 2) for name, count in calls.items()},
+    )
+
+
+def print_results(results: List[RouteResult]) -> None:
+    header = f"{'route':<26}{'reqs':>6}{'ok':>6}{'err':>5}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}  upstream/req (node/fragment/tonapi)"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        upstream = '/'.join(f"{r.upstream_per_request.get(name, 0):g}" for name in UPSTREAMS)
+        print(f"{r.route:<26}{r.requests:>6}{r.ok:>6}{r.errors:>5}{r.throughput:>8}{r.p50_ms:>9}{r.p95_ms:>9}{r.p99_ms:>9}  {upstream}")
+
+
+def compare(results: List[RouteResult], baseline_path: str, tolerance: float) -> List[str]:
+    """Routes whose p95 latency or upstream calls grew by more than tolerance over the baseline"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {r["route"]: r for r in json.load(f)["results"]}
+
+    regressions = []
+    for r in results:
+        before = baseline.get(r.route)
+        if not before:
+            continue
+        if before["p95_ms"] and r.p95_ms > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{r.route}: p95 {before['p95_ms']}ms -> {r.p95_ms}ms")
+        for name in UPSTREAMS:
+            was, now = before["upstream_per_request"].get(name, 0), r.upstream_per_request.get(name, 0)
+            if now > was * (1 + tolerance) and now - was >= 0.1:
+                regressions.append(f"{r.route}: {name} calls/request {was} -> {now}")
+    return regressions
+
+
+async def run(args: argparse.Namespace, ports: Dict[str, int]) -> List[RouteResult]:
+    base_url = f"http://127.0.0.1:{args.port}"
+    selected = args.routes.split(',') if args.routes else [route.name for route in ROUTES]
+    unknown = set(selected) - {route.name for route in ROUTES}
+    if unknown:
+        raise SystemExit(f"Unknown routes: {', '.join(sorted(unknown))}")
+
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        await wait_ready(client, f"{base_url}/health")
+        for name in UPSTREAMS:
+            await wait_ready(client, f"http://127.0.0.1:{ports[name]}/__stats")
+
+        # A job to poll for the buy_stars_job route
+        response = await client.post(
+            f"{base_url}/buy-stars", headers={"X-API-Key": API_KEY},
+            json={"username": recipient(0), "quantity": 50, "async": True},
+        )
+        params = {"job_id": response.json().get("data", {}).get("job_id", "missing")}
+        # And a batch for the buy_stars_batch_status route
+        response = await client.post(
+            f"{base_url}/buy-stars/batch", headers={"X-API-Key": API_KEY},
+            json={"items": [{"username": recipient(k), "quantity": 50} for k in range(2)]},
+        )
+        params["batch_id"] = response.json().get("data", {}).get("batch_id", "missing")
+
+        results = []
+        for route in ROUTES:
+            if route.name in selected:
+                results.append(await run_route(client, base_url, route, args.rps, args.duration, ports, params, args.settle))
+                print(f"  {route.name}: done", file=sys.stderr)
+        return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Drive every Fragment API route at a target rate against local mocks')
+    parser.add_argument('--app', choices=('asgi', 'flask'), default='asgi', help='server to benchmark')
+    parser.add_argument('--port', type=int, default=3903, help='port for the app under test')
+    parser.add_argument('--mock-base-port', type=int, default=4900, help='Node/Fragment/TonAPI mocks use this port and the next two')
+    parser.add_argument('--rps', type=float, default=20, help='target requests per second per route')
+    parser.add_argument('--duration', type=float, default=5, help='seconds to drive each route')
+    parser.add_argument('--routes', default='', help='comma-separated route names (default: all)')
+    parser.add_argument('--max-in-flight', type=int, default=256, help='client connection limit')
+    parser.add_argument('--timeout', type=float, default=60, help='per-request timeout in seconds')
+    parser.add_argument('--settle', type=float, default=1.0, help='pause before each route so background work does not skew its upstream counts')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='baseline results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression against the baseline')
+    mocks.add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    ports = {name: args.mock_base_port + i for i, name in enumerate(UPSTREAMS)}
+    faults = {name: mocks.faults_from_args(args, name) for name in UPSTREAMS}
+    job_db = os.path.join(tempfile.mkdtemp(prefix='fragment-bench-'), 'purchase_jobs.db')
+
+    mock_process = multiprocessing.Process(target=run_mocks, args=(ports, faults, args.inclusion_delay), daemon=True)
+    mock_process.start()
+    app_process = start_app(args.app, args.port, ports, job_db)
+    try:
+        results = asyncio.run(run(args, ports))
+    finally:
+        app_process.terminate()
+        app_process.wait(timeout=10)
+        mock_process.terminate()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"app": args.app, "rps": args.rps, "duration": args.duration,
+                       "results": [asdict(r) for r in results]}, f, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Micro-benchmarks for the Fragment service's CPU-bound helpers: wallet
+generation, Fragment payload decoding, the cookie/JSON builders and the
+prepared-session lookup.
+
+    python -m bench.micro
+    python -m bench.micro --only encoded,build_cookies --seconds 2
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+from typing import Callable, Dict, List
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'starsBuy'))
+
+from walletCreate.wallet_generator import WalletGenerator
+from api import fragment
+
+FRAGMENT_DATA = {
+    'stelSsid': 'a' * 32,
+    'stelDt': '-240',
+    'stelTonToken': 'b' * 128,
+    'stelToken': 'c' * 64,
+    'cfClearance': 'd' * 256,
+    'fragmentAddress': '0:' + '00' * 32,
+    'fragmentWallets': 'te6cc' + 'A' * 400,
+    'fragmentPublicKey': '00' * 32,
+}
+COOKIE_DATA = {
+    'stel_ssid': FRAGMENT_DATA['stelSsid'],
+    'stel_dt': FRAGMENT_DATA['stelDt'],
+    'stel_ton_token': FRAGMENT_DATA['stelTonToken'],
+    'stel_token': FRAGMENT_DATA['stelToken'],
+    'cf_clearance': FRAGMENT_DATA['cfClearance'],
+}
+# Shaped like a getBuyStarsLink payload (unpadded base64 of prefix + comment)
+PAYLOAD = base64.b64encode(b'\x00\x00\x00\x0050 Telegram Stars \n\nRef#abcdef123456').decode().rstrip('=')
+
+
+def bench(fn: Callable[[], object], seconds: float) -> Dict[str, float]:
+    """Call fn repeatedly for about `seconds` and summarize per-call timings"""
+    fn()  # warm up
+    timings: List[float] = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+
+    timings.sort()
+    return {
+        "calls": len(timings),
+        "ops_per_sec": round(len(timings) / sum(timings), 1),
+        "mean_us": round(sum(timings) / len(timings) * 1e6, 2),
+        "p50_us": round(timings[len(timings) // 2] * 1e6, 2),
+        "p99_us": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6, 2),
+    }
+
+
+def cases() -> Dict[str, Callable[[], object]]:
+    generator = WalletGenerator()
+    loop = asyncio.new_event_loop()
+    return {
+        "generate_single_wallet": generator.generate_single_wallet,
+        "encoded": lambda: loop.run_until_complete(fragment.encoded(PAYLOAD)),
+        "build_cookies": lambda: fragment.build_cookies_from_data(COOKIE_DATA),
+        "build_account_json": lambda: fragment.build_account_json(FRAGMENT_DATA),
+        "build_device_json": fragment.build_device_json,
+        "fragment_session": lambda: fragment.FragmentSession.from_data(FRAGMENT_DATA),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for Fragment service helpers')
+    parser.add_argument('--seconds', type=float, default=1.0, help='time spent per benchmark')
+    parser.add_argument('--only', default='', help='comma-separated benchmark names (default: all)')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    selected = cases()
+    if args.only:
+        selected = {name: fn for name, fn in selected.items() if name in args.only.split(',')}
+
+    results = {}
+    print(f"{'benchmark':<26}{'calls':>9}{'ops/s':>12}{'mean us':>11}{'p50 us':>11}{'p99 us':>11}")
+    for name, fn in selected.items():
+        r = results[name] = bench(fn, args.seconds)
+        print(f"{name:<26}{r['calls']:>9}{r['ops_per_sec']:>12}{r['mean_us']:>11}{r['p50_us']:>11}{r['p99_us']:>11}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Local stand-ins for the Fragment service's upstreams:
+
+- Node API: /api/subscriptions/validate, /api/wallets/*, /api/fragment-user-data/*
+- fragment.com/api: searchStarsRecipient, updateStarsPrices, updateStarsBuyState,
+  initBuyStarsRequest, getBuyStarsLink
+- TonAPI v2: account state, seqno get-method, message send, transactions, bulk accounts
+
+Each mock injects latency (fixed + uniform jitter) and errors (a share of
+requests answered with an error status), and counts the calls it serves.
+GET /__stats returns the counters; POST /__config changes latency/errors
+at runtime and POST /__reset zeroes the counters.
+
+    python -m bench.mocks --node-port 4000 --fragment-port 4001 --tonapi-port 4002
+"""
+import argparse
+import asyncio
+import base64
+import random
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, asdict
+
+from pytoniq_core import Address, Cell, MessageAny
+from quart import Quart, request, jsonify
+import uvicorn
+
+from walletCreate.wallet_generator import WalletGenerator
+
+BENCH_USER_ID = 1
+BENCH_SUBSCRIPTION_ID = 1
+BENCH_TONAPI_KEY = 'bench-tonapi-key'
+BENCH_FRAGMENT_HASH = 'benchhash'
+# Where purchases are paid to (any valid address will do)
+BENCH_DESTINATION = 'EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N'
+CONTROL_PATHS = ('/__stats', '/__config', '/__reset')
+
+
+@dataclass
+class Faults:
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+
+
+def mock_app(name: str, faults: Faults) -> Quart:
+    """Quart app with latency/error injection, call counters and control routes"""
+    app = Quart(name)
+    app.faults = faults
+    app.calls = Counter()
+
+    @app.before_request
+    async def inject():
+        if request.path in CONTROL_PATHS:
+            return None
+        app.calls['total'] += 1
+        delay = app.faults.latency + random.uniform(0, app.faults.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if random.random() < app.faults.error_rate:
+            app.calls['errors'] += 1
+            return jsonify({"success": False, "error": "Injected failure"}), app.faults.error_status
+        return None
+
+    @app.get('/__stats')
+    async def stats():
+        return jsonify({"calls": dict(app.calls), "faults": asdict(app.faults)})
+
+    @app.post('/__config')
+    async def config():
+        data = await request.get_json()
+        for key, value in (data or {}).items():
+            if hasattr(app.faults, key):
+                setattr(app.faults, key, type(getattr(app.faults, key))(value))
+        return jsonify(asdict(app.faults))
+
+    @app.post('/__reset')
+    async def reset():
+        app.calls.clear()
+        return jsonify({"success": True})
+
+    return app
+
+
+def node_app(faults: Faults, mnemonics: str) -> Quart:
+    """Node API routes used by main.py and StarsBuyService"""
+    app = mock_app('mock-node', faults)
+    subscription = {
+        "id": BENCH_SUBSCRIPTION_ID,
+        "selectedUser": BENCH_USER_ID,
+        "userName": "bench",
+        "selectedAPI": "Fragment",
+        "selectedSubscribe": "bench",
+    }
+    wallet = {
+        "id": 1,
+        "subscriptionId": BENCH_SUBSCRIPTION_ID,
+        "userId": BENCH_USER_ID,
+        "mnemonics": mnemonics,
+        "tonApiKey": BENCH_TONAPI_KEY,
+    }
+    fragment = {
+        "id": 1,
+        "userId": BENCH_USER_ID,
+        "stelSsid": "ssid",
+        "stelDt": "-240",
+        "stelTonToken": "ton-token",
+        "stelToken": "token",
+        "cfClearance": "clearance",
+        "fragmentHash": BENCH_FRAGMENT_HASH,
+        "fragmentAddress": "0:" + "00" * 32,
+        "fragmentWallets": "",
+        "fragmentPublicKey": "00" * 32,
+        "isActive": True,
+    }
+
+    @app.post('/api/subscriptions/validate')
+    async def validate():
+        app.calls['subscriptions.validate'] += 1
+        return jsonify({"success": True, "data": {"isValid": True, "subscription": subscription}})
+
+    @app.get('/api/wallets/subscription/<int:subscription_id>')
+    async def wallets_by_subscription(subscription_id):
+        app.calls['wallets.subscription'] += 1
+        # Empty, so /generate-wallet always gets to generate and save
+        return jsonify({"success": True, "data": []})
+
+    @app.get('/api/wallets/user/<int:user_id>')
+    async def wallets_by_user(user_id):
+        app.calls['wallets.user'] += 1
+        return jsonify({"success": True, "data": [wallet]})
+
+    @app.post('/api/wallets')
+    async def create_wallet():
+        app.calls['wallets.create'] += 1
+        data = await request.get_json()
+        return jsonify({"success": True, "data": {**data, "id": random.randint(1, 10 ** 9)}}), 201
+
+    @app.post('/api/wallets/bulk')
+    async def create_wallets():
+        app.calls['wallets.bulk'] += 1
+        data = await request.get_json()
+        return jsonify({"success": True, "data": data.get("wallets", [])}), 201
+
+    @app.get('/api/fragment-user-data/user/<int:user_id>/context')
+    async def user_context(user_id):
+        app.calls['fragment-user-data.context'] += 1
+        return jsonify({"success": True, "data": {"wallet": wallet, "fragment": fragment, "fragments": [fragment]}})
+
+    @app.get('/api/fragment-user-data/user/<int:user_id>/active')
+    async def active_fragment(user_id):
+        app.calls['fragment-user-data.active'] += 1
+        return jsonify({"success": True, "data": fragment})
+
+    return app
+
+
+def fragment_app(faults: Faults) -> Quart:
+    """fragment.com/api stars purchase methods"""
+    app = mock_app('mock-fragment', faults)
+    # getBuyStarsLink payloads are base64 of a binary prefix + comment text
+    payload = base64.b64encode(b'\x00\x00\x00\x0050 Telegram Stars \n\nRef#bench').decode()
+
+    @app.post('/api')
+    async def api():
+        form = await request.form
+        method = form.get('method', '')
+        app.calls[method] += 1
+
+        if method == 'searchStarsRecipient':
+            return jsonify({"ok": True, "found": {
+                "name": form.get('query', ''),
+                "recipient": uuid.uuid5(uuid.NAMESPACE_DNS, form.get('query', '')).hex,
+                "photo": "",
+            }})
+        if method == 'updateStarsPrices':
+            # 0.002 TON per star, so 50 stars cost what getBuyStarsLink asks for
+            price = int(form.get('quantity') or 0) * 0.002
+            return jsonify({"ok": True, "cur_price": f'<div class="tm-value icon-before icon-ton">{price:g}</div>'})
+        if method == 'updateStarsBuyState':
+            return jsonify({"ok": True, "mode": form.get('mode')})
+        if method == 'initBuyStarsRequest':
+            return jsonify({"req_id": uuid.uuid4().hex, "amount": "0.1", "myself": False})
+        if method == 'getBuyStarsLink':
+            return jsonify({"ok": True, "transaction": {
+                "validUntil": int(time.time()) + 600,
+                "messages": [{"address": BENCH_DESTINATION, "amount": "100000000", "payload": payload}],
+            }})
+        return jsonify({"error": "Unknown method"}), 400
+
+    return app
+
+
+def tonapi_app(faults: Faults, inclusion_delay: float = 0.0) -> Quart:
+    """TonAPI v2 routes used by tonutils and the wallet module"""
+    app = mock_app('mock-tonapi', faults)
+    seqnos: Counter = Counter()
+
+    def raw(address: str) -> str:
+        return Address(address).to_str(is_user_friendly=False)
+
+    async def include(address: str) -> None:
+        await asyncio.sleep(inclusion_delay)
+        seqnos[address] += 1
+
+    @app.get('/v2/blockchain/accounts/<address>')
+    async def account(address):
+        app.calls['accounts.get'] += 1
+        return jsonify({"address": raw(address), "balance": 10 ** 12, "status": "uninit"})
+
+    @app.get('/v2/blockchain/accounts/<address>/methods/seqno')
+    async def seqno(address):
+        app.calls['methods.seqno'] += 1
+        return jsonify({"success": True, "exit_code": 0, "stack": [{"type": "num", "num": hex(seqnos[raw(address)])}]})
+
+    @app.post('/v2/blockchain/message')
+    async def message():
+        app.calls['blockchain.message'] += 1
+        boc = (await request.get_json())["boc"]
+        msg = MessageAny.deserialize(Cell.one_from_boc(bytes.fromhex(boc)).begin_parse())
+        # The message lands on-chain (seqno advances) after inclusion_delay
+        asyncio.ensure_future(include(msg.info.dest.to_str(is_user_friendly=False)))
+        return jsonify({})
+
+    @app.get('/v2/blockchain/accounts/<address>/transactions')
+    async def transactions(address):
+        app.calls['accounts.transactions'] += 1
+        return jsonify({"transactions": []})
+
+    @app.post('/v2/accounts/_bulk')
+    async def bulk_accounts():
+        app.calls['accounts.bulk'] += 1
+        data = await request.get_json()
+        return jsonify({"accounts": [
+            {"address": raw(address), "balance": 10 ** 12, "status": "uninit"}
+            for address in data.get("account_ids", [])
+        ]})
+
+    return app
+
+
+async def serve(
+    node_port: int = 4000,
+    fragment_port: int = 4001,
+    tonapi_port: int = 4002,
+    node: Faults = None,
+    fragment: Faults = None,
+    tonapi: Faults = None,
+    inclusion_delay: float = 0.0,
+) -> None:
+    """Run the three mocks on one event loop until cancelled"""
+    mnemonics = " ".join(WalletGenerator().generate_single_wallet()["mnemonics"])
+    apps = [
+        (node_app(node or Faults(), mnemonics), node_port),
+        (fragment_app(fragment or Faults()), fragment_port),
+        (tonapi_app(tonapi or Faults(), inclusion_delay), tonapi_port),
+    ]
+    servers = [
+        uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning', lifespan='off'))
+        for app, port in apps
+    ]
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser) -> None:
+    for name in ('node', 'fragment', 'tonapi'):
+        parser.add_argument(f'--{name}-latency', type=float, default=0.0, help=f'{name} latency in seconds')
+        parser.add_argument(f'--{name}-jitter', type=float, default=0.0, help=f'{name} extra uniform latency in seconds')
+        parser.add_argument(f'--{name}-error-rate', type=float, default=0.0, help=f'share of {name} calls that fail')
+    parser.add_argument('--error-status', type=int, default=500, help='status code of injected errors')
+    parser.add_argument('--inclusion-delay', type=float, default=0.0, help='seconds before a sent message advances the seqno')
+
+
+def faults_from_args(args: argparse.Namespace, name: str) -> Faults:
+    return Faults(
+        latency=getattr(args, f'{name}_latency'),
+        jitter=getattr(args, f'{name}_jitter'),
+        error_rate=getattr(args, f'{name}_error_rate'),
+        error_status=args.error_status,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run mock Node, Fragment and TonAPI servers')
+    parser.add_argument('--node-port', type=int, default=4000)
+    parser.add_argument('--fragment-port', type=int, default=4001)
+    parser.add_argument('--tonapi-port', type=int, default=4002)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    print(f"Node API mock:  http://127.0.0.1:{args.node_port}/api")
+    print(f"Fragment mock:  http://127.0.0.1:{args.fragment_port}/api")
+    print(f"TonAPI mock:    http://127.0.0.1:{args.tonapi_port}/v2")
+    asyncio.run(serve(
+        args.node_port, args.fragment_port, args.tonapi_port,
+        faults_from_args(args, 'node'), faults_from_args(args, 'fragment'), faults_from_args(args, 'tonapi'),
+        args.inclusion_delay,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+# Common Utilities Package
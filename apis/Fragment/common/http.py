@@ -0,0 +1,218 @@
+import asyncio
+import importlib.util
+import ipaddress
+import os
+import socket
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from time import perf_counter
+from typing import Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from common.metrics import CLOUDFLARE_CHALLENGES, UPSTREAM_DURATION, UPSTREAM_RESPONSES
+from common.resilience import get_breaker
+from common.tracing import REQUEST_ID_HEADER, request_id
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+# Our own services get the request id header; third parties (fragment.com
+# in particular, which should only see browser-like requests) do not
+PROPAGATE_REQUEST_ID = {'backend', 'webhook'}
+
+# HTTP/2 needs the optional 'h2' package (httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+# Upstreams whose clients fail fast through a circuit breaker
+BREAKER_UPSTREAMS = {'backend', 'tonapi'}
+
+# The Node API is on our side of the network: a slow answer means it is in trouble
+BACKEND_TIMEOUT = float(os.environ.get('BACKEND_TIMEOUT', 10))
+BACKEND_CONNECT_TIMEOUT = float(os.environ.get('BACKEND_CONNECT_TIMEOUT', 2))
+DEFAULT_TIMEOUTS = {
+    'backend': httpx.Timeout(BACKEND_TIMEOUT, connect=BACKEND_CONNECT_TIMEOUT),
+}
+# Every other client, unless it passes its own timeout
+HTTP_TIMEOUT = httpx.Timeout(float(os.environ.get('HTTP_TIMEOUT', 10)))
+
+# Client-supplied URLs (webhooks) may only point at public addresses,
+# unless this is set for local development
+ALLOW_PRIVATE_CALLBACKS = os.environ.get('ALLOW_PRIVATE_CALLBACKS', '0') == '1'
+
+
+def no_cookie_jar() -> CookieJar:
+    """
+    Return a jar that never stores cookies.
+    Shared clients proxy per-user cookies via the Cookie header, so a
+    client-level jar would leak Set-Cookie values between users.
+    """
+    return CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+
+
+def is_cloudflare_challenge(response: httpx.Response) -> bool:
+    """
+    True if Cloudflare answered with a challenge page instead of the origin
+    """
+    if response.headers.get('cf-mitigated') == 'challenge':
+        return True
+    return (
+        response.status_code in (403, 429, 503)
+        and response.headers.get('server', '').lower() == 'cloudflare'
+        and 'text/html' in response.headers.get('content-type', '')
+    )
+
+
+class UnsafeURLError(ValueError):
+    """
+    Raised instead of requesting a client-supplied URL that check_public_url refuses
+    """
+
+
+async def _resolve_public(url: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    (reason the URL is refused or None, a vetted public address of its host
+    or None when ALLOW_PRIVATE_CALLBACKS skips the check)
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return 'malformed URL', None
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        return 'must be an http(s) URL', None
+    if ALLOW_PRIVATE_CALLBACKS:
+        return None, None
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            parts.hostname, port or (443 if parts.scheme == 'https' else 80), type=socket.SOCK_STREAM
+        )
+    except (socket.gaierror, UnicodeError):
+        return 'host does not resolve', None
+    addresses = []
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if not address.is_global or address.is_multicast:
+            return 'host resolves to a non-public address', None
+        addresses.append(str(address))
+    if not addresses:
+        return 'host does not resolve', None
+    return None, addresses[0]
+
+
+async def check_public_url(url: str) -> Optional[str]:
+    """
+    Why a client-supplied URL must not be requested (None if it may be):
+    it must be http(s) and every address its host resolves to must be
+    public, so callers cannot reach loopback, private or link-local
+    services (metadata endpoints, our own backend) through us
+    """
+    reason, _ = await _resolve_public(url)
+    return reason
+
+
+async def request_public_url(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Send a request to a client-supplied URL, connecting to the address that
+    check_public_url vetted rather than resolving the host again (a second
+    lookup could be rebound to a private address). The original host still
+    goes in the Host header and TLS SNI, so certificates are checked against
+    it. Redirects are not followed. Raises UnsafeURLError for refused URLs.
+    """
+    reason, address = await _resolve_public(url)
+    if reason:
+        raise UnsafeURLError(reason)
+    target = httpx.URL(url)
+    headers = kwargs.pop('headers', None) or {}
+    extensions = kwargs.pop('extensions', None) or {}
+    if address is not None:
+        headers = {**headers, 'Host': target.netloc.decode('ascii')}
+        if target.scheme == 'https':
+            extensions = {**extensions, 'sni_hostname': target.host}
+        target = target.copy_with(host=address)
+    request = client.build_request(method, target, headers=headers, extensions=extensions, **kwargs)
+    return await client.send(request, follow_redirects=False)
+
+
+class BreakerTransport(httpx.AsyncBaseTransport):
+    """
+    Transport that sends requests through the upstream's circuit breaker.
+    Connection errors, timeouts and 5xx responses count as failures.
+    """
+
+    def __init__(self, name: str, transport: httpx.AsyncBaseTransport):
+        self.breaker = get_breaker(name)
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.breaker.before()
+        started_at = perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except asyncio.CancelledError:
+            self.breaker.cancelled()
+            raise
+        except Exception:
+            self.breaker.failure()
+            raise
+        if response.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success(perf_counter() - started_at)
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def _instrument(name: str) -> dict:
+    """
+    Event hooks that tag outgoing requests and record upstream metrics
+    """
+    async def on_request(request: httpx.Request) -> None:
+        request.extensions['started_at'] = perf_counter()
+        current = request_id.get()
+        if current and name in PROPAGATE_REQUEST_ID:
+            request.headers[REQUEST_ID_HEADER] = current
+
+    async def on_response(response: httpx.Response) -> None:
+        started_at = response.request.extensions.get('started_at')
+        if started_at is not None:
+            UPSTREAM_DURATION.observe(perf_counter() - started_at, upstream=name)
+        UPSTREAM_RESPONSES.inc(upstream=name, status=str(response.status_code))
+        if is_cloudflare_challenge(response):
+            CLOUDFLARE_CHALLENGES.inc(upstream=name)
+
+    return {'request': [on_request], 'response': [on_response]}
+
+
+def get_client(name: str = 'default', **kwargs) -> httpx.AsyncClient:
+    """
+    Return a shared AsyncClient for name, creating it on first use.
+    Clients are bound to the event loop that first uses them.
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUTS.get(name, HTTP_TIMEOUT))
+        if kwargs.get('http2') and not HTTP2_AVAILABLE:
+            kwargs['http2'] = False
+        if name in BREAKER_UPSTREAMS and 'transport' not in kwargs:
+            transport = httpx.AsyncHTTPTransport(
+                http2=kwargs.pop('http2', False),
+                **{key: kwargs.pop(key) for key in ('limits', 'verify') if key in kwargs}
+            )
+            kwargs['transport'] = BreakerTransport(name, transport)
+        hooks = _instrument(name)
+        for event, callbacks in kwargs.pop('event_hooks', {}).items():
+            hooks.setdefault(event, []).extend(callbacks)
+        client = httpx.AsyncClient(event_hooks=hooks, **kwargs)
+        _clients[name] = client
+    return client
+
+
+async def close_clients() -> None:
+    """
+    Close every shared client (call on shutdown)
+    """
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger('invalidation')
+
+# Cache invalidations reach one worker over HTTP; they are written to this
+# SQLite file, shared by every worker on the host, and replayed by the others
+INVALIDATION_DB_PATH = os.environ.get(
+    'INVALIDATION_DB_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'invalidations.db'))
+INVALIDATION_POLL_INTERVAL = float(os.environ.get('INVALIDATION_POLL_INTERVAL', 0.5))
+INVALIDATION_RETENTION = float(os.environ.get('INVALIDATION_RETENTION', 300))
+
+_handlers: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+_log: Optional["InvalidationLog"] = None
+_last_id = 0
+_task: Optional[asyncio.Task] = None
+
+
+class InvalidationLog:
+    """
+    Append-only table of cache invalidations, trimmed after INVALIDATION_RETENTION
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS invalidations ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "kind TEXT NOT NULL, "
+                "payload TEXT NOT NULL, "
+                "pid INTEGER NOT NULL, "
+                "created REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def append(self, kind: str, payload: Dict[str, Any]) -> int:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM invalidations WHERE created < ?", (now - INVALIDATION_RETENTION,))
+            cursor = conn.execute(
+                "INSERT INTO invalidations (kind, payload, pid, created) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps(payload), os.getpid(), now)
+            )
+            return cursor.lastrowid
+
+    def since(self, last_id: int) -> List[Tuple[int, str, Dict[str, Any], int]]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, kind, payload, pid FROM invalidations WHERE id > ? ORDER BY id", (last_id,)
+            ).fetchall()
+        return [(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def last_id(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+
+
+def _get_log() -> InvalidationLog:
+    global _log
+    if _log is None:
+        _log = InvalidationLog(INVALIDATION_DB_PATH)
+    return _log
+
+
+def register(kind: str, handler: Callable[[Dict[str, Any]], Any]) -> None:
+    """
+    Apply `handler(payload)` to this process's caches for invalidations of `kind`
+    """
+    _handlers[kind] = handler
+
+
+async def publish(kind: str, payload: Dict[str, Any]) -> Any:
+    """
+    Apply an invalidation here and record it for the other workers.
+    Returns what the local handler returned.
+    """
+    result = _handlers[kind](payload)
+    try:
+        await asyncio.to_thread(_get_log().append, kind, payload)
+    except sqlite3.Error as e:
+        # Other workers fall back to their cache TTL
+        logger.warning('invalidation %s not shared with other workers: %s', kind, e)
+    return result
+
+
+def start() -> None:
+    """
+    Replay other workers' invalidations in this process (call once per worker, after any fork)
+    """
+    global _task, _last_id
+    if INVALIDATION_POLL_INTERVAL <= 0 or (_task is not None and not _task.done()):
+        return
+    # Caches start empty, so older invalidations do not matter
+    _last_id = _get_log().last_id()
+    _task = asyncio.ensure_future(_poll())
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+
+
+async def _poll() -> None:
+    global _last_id
+    while True:
+        await asyncio.sleep(INVALIDATION_POLL_INTERVAL)
+        try:
+            entries = await asyncio.to_thread(_get_log().since, _last_id)
+        except sqlite3.Error as e:
+            logger.warning('reading invalidations failed: %s', e)
+            continue
+        for entry_id, kind, payload, pid in entries:
+            _last_id = entry_id
+            handler = _handlers.get(kind)
+            if handler is None or pid == os.getpid():
+                continue
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception('applying %s invalidation failed', kind)
@@ -0,0 +1,28 @@
+import threading
+import time
+
+# Set once this process starts shutting down; readiness turns false so
+# load balancers stop routing new requests while in-flight ones finish
+_draining = threading.Event()
+
+started_at = time.time()
+
+
+def mark_started() -> None:
+    """
+    Reset the start time (called in each worker, after a preloading fork)
+    """
+    global started_at
+    started_at = time.time()
+
+
+def begin_drain() -> None:
+    _draining.set()
+
+
+def is_draining() -> bool:
+    return _draining.is_set()
+
+
+def uptime() -> float:
+    return time.time() - started_at
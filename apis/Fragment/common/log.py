@@ -0,0 +1,164 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Optional
+
+from common.tracing import request_id
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# 'text' or 'json' (one object per line)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# Share of DEBUG records kept; INFO and above are never sampled out
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1.0))
+QUIET_LOGGERS = ('httpx', 'httpcore')
+
+REDACTED = '***'
+# Keys whose values are never logged (wallet secrets, API keys, session cookies)
+_SECRET_KEY = re.compile(
+    r'private_?key|mnemonic|api_?key|token|secret|password|cookie|authorization|stel_|cf_?clearance',
+    re.IGNORECASE,
+)
+# Secrets embedded in strings, e.g. a Cookie header
+_SECRET_PAIR = re.compile(r'\b(stel_\w+|cf_clearance)=[^;\s]*')
+
+
+def redact(value: Any) -> Any:
+    """
+    Copy of value with secret fields masked (dicts/lists recursively)
+    """
+    if isinstance(value, dict):
+        return {
+            k: REDACTED if isinstance(k, str) and _SECRET_KEY.search(k) else redact(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return type(value)(redact(v) for v in value)
+    if isinstance(value, str):
+        return _SECRET_PAIR.sub(lambda m: f'{m.group(1)}={REDACTED}', value)
+    return value
+
+
+class Lazy:
+    """
+    Log argument computed only if the record is actually formatted
+    """
+
+    __slots__ = ('fn',)
+
+    def __init__(self, fn: Callable[[], Any]):
+        self.fn = fn
+
+    def __str__(self) -> str:
+        return str(self.fn())
+
+
+def lazy_json(value: Any, limit: int = 2000) -> Lazy:
+    """
+    Redacted, truncated JSON of value, serialized only when logged
+    """
+    return Lazy(lambda: json.dumps(redact(value), default=str, ensure_ascii=False)[:limit])
+
+
+class ContextFilter(logging.Filter):
+    """
+    Stamp the current request id and redact secret arguments. Runs in the
+    logging thread, before the record is queued.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get() or '-'
+        if isinstance(record.args, tuple):
+            record.args = tuple(a if isinstance(a, (Lazy, int, float)) else redact(a) for a in record.args)
+        elif isinstance(record.args, dict):
+            record.args = redact(record.args)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a share of DEBUG records
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, 'request_id', '-'),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class AsyncLogHandler(QueueHandler):
+    """
+    Queue handler whose records are written by a background listener
+    thread, so request handlers never block on log I/O. The listener is
+    started lazily per process, so it survives forking servers.
+    """
+
+    def __init__(self, target: logging.Handler):
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self._listener: Optional[QueueListener] = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A forked child inherits the queue but not the listener thread
+            self.queue = queue.SimpleQueue()
+            self._listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self._listener.stop)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self._ensure_listener()
+        super().emit(record)
+
+
+def configure_logging() -> None:
+    """
+    Install the async, redacting root handler (unless logging is already configured)
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+
+    stream = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+
+    handler = AsyncLogHandler(stream)
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    handler.addFilter(ContextFilter())
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every request at INFO; upstream calls are counted in /metrics instead
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
@@ -0,0 +1,31 @@
+import asyncio
+import os
+import threading
+from typing import Any, Coroutine, Optional
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the process-wide background event loop, starting it on first use.
+    Started lazily so that forking servers create it in each worker.
+    """
+    global _loop, _pid
+    with _lock:
+        # A forked child inherits the loop object but not the thread running it
+        if _loop is None or _loop.is_closed() or _pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _pid = os.getpid()
+            thread = threading.Thread(target=_loop.run_forever, name='async-loop', daemon=True)
+            thread.start()
+        return _loop
+
+
+def run(coro: Coroutine[Any, Any, Any], timeout: Optional[float] = None) -> Any:
+    """
+    Run a coroutine on the background loop from synchronous (WSGI) code
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
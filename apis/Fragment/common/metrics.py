@@ -0,0 +1,331 @@
+import bisect
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger('metrics')
+
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# With several worker processes, each writes its values here (one file per
+# pid) and /metrics renders the sum over all of them. Files of exited workers
+# are kept so counters never go backwards; clear the directory on restart.
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+_registry: List["Metric"] = []
+_flusher: Optional[threading.Thread] = None
+_stop_flushing = threading.Event()
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """
+    Base class: a named, documented family of labelled series, registered
+    for rendering at /metrics. Values are per process; see METRICS_DIR.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        """
+        This process's series, as (label values, value)
+        """
+        raise NotImplementedError
+
+    def merge(self, snapshots: List[List[Tuple[Tuple[str, ...], Any]]]) -> Dict[Tuple[str, ...], Any]:
+        raise NotImplementedError
+
+    def collect(self, snapshots: Optional[List[List[Tuple[Tuple[str, ...], Any]]]] = None) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def snapshot(self) -> List[Tuple[Tuple[str, ...], float]]:
+        with self._lock:
+            return list(self._values.items())
+
+    def merge(self, snapshots: List[List[Tuple[Tuple[str, ...], float]]]) -> Dict[Tuple[str, ...], float]:
+        values: Dict[Tuple[str, ...], float] = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                values[key] = values.get(key, 0.0) + value
+        return values
+
+    def collect(self, snapshots: Optional[List[List[Tuple[Tuple[str, ...], float]]]] = None) -> List[str]:
+        values = self.merge(snapshots if snapshots is not None else [self.snapshot()])
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}' for key, v in values.items()]
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Across processes the most recently set
+    value of each series wins, so use it for state every worker can observe
+    (like the size of a shared store), not for per-process amounts.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        # Per series: value, wall-clock time it was set
+        self._values: Dict[Tuple[str, ...], Tuple[float, float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = (value, time())
+
+    def snapshot(self) -> List[Tuple[Tuple[str, ...], Tuple[float, float]]]:
+        with self._lock:
+            return list(self._values.items())
+
+    def merge(self, snapshots: List[List[Tuple[Tuple[str, ...], Tuple[float, float]]]]) -> Dict[Tuple[str, ...], Tuple[float, float]]:
+        values: Dict[Tuple[str, ...], Tuple[float, float]] = {}
+        for snapshot in snapshots:
+            for key, (value, updated_at) in snapshot:
+                if key not in values or updated_at > values[key][1]:
+                    values[key] = (value, updated_at)
+        return values
+
+    def collect(self, snapshots: Optional[List[List[Tuple[Tuple[str, ...], Tuple[float, float]]]]] = None) -> List[str]:
+        values = self.merge(snapshots if snapshots is not None else [self.snapshot()])
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}' for key, (v, _) in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # Per series: per-bucket counts (not cumulative), sum
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * len(self.buckets), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Observe the duration of the with-block
+        """
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - t0, **labels)
+
+    def snapshot(self) -> List[Tuple[Tuple[str, ...], Tuple[List[int], float]]]:
+        with self._lock:
+            return [(key, (list(counts), total[0])) for key, (counts, total) in self._series.items()]
+
+    def merge(self, snapshots: List[List[Tuple[Tuple[str, ...], Tuple[List[int], float]]]]) -> Dict[Tuple[str, ...], Tuple[List[int], float]]:
+        series: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+        for snapshot in snapshots:
+            for key, (counts, total) in snapshot:
+                if key in series:
+                    merged, merged_total = series[key]
+                    series[key] = ([a + b for a, b in zip(merged, counts)], merged_total + total)
+                else:
+                    series[key] = (list(counts), total)
+        return series
+
+    def collect(self, snapshots: Optional[List[List[Tuple[Tuple[str, ...], Tuple[List[int], float]]]]] = None) -> List[str]:
+        series = self.merge(snapshots if snapshots is not None else [self.snapshot()])
+        lines = []
+        for key, (counts, total) in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ('le',), key + (_format_value(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f'{pid}.json')
+
+
+def flush() -> None:
+    """
+    Write this process's values to METRICS_DIR
+    """
+    if not METRICS_DIR:
+        return
+    data = {metric.name: metric.snapshot() for metric in _registry}
+    path = _snapshot_path(os.getpid())
+    tmp = f'{path}.tmp'
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning('writing metrics to %s failed: %s', METRICS_DIR, e)
+
+
+def _flush_loop() -> None:
+    while not _stop_flushing.wait(METRICS_FLUSH_INTERVAL):
+        flush()
+
+
+def start_flushing() -> None:
+    """
+    Write this process's values to METRICS_DIR every METRICS_FLUSH_INTERVAL
+    (call once per worker, after any fork)
+    """
+    global _flusher
+    if not METRICS_DIR or (_flusher is not None and _flusher.is_alive()):
+        return
+    _stop_flushing.clear()
+    _flusher = threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True)
+    _flusher.start()
+
+
+def stop_flushing() -> None:
+    _stop_flushing.set()
+    flush()
+
+
+def _load_snapshots() -> List[Dict[str, list]]:
+    # This process's values are current; the other workers' are up to METRICS_FLUSH_INTERVAL old
+    snapshots = [{metric.name: metric.snapshot() for metric in _registry}]
+    own = f'{os.getpid()}.json'
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return snapshots
+    for name in names:
+        if not name.endswith('.json') or name == own:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        snapshots.append({
+            metric_name: [(tuple(key), value) for key, value in series]
+            for metric_name, series in data.items()
+        })
+    return snapshots
+
+
+def aggregate(metric: Metric) -> Dict[Tuple[str, ...], Any]:
+    """
+    A metric's merged values by label values, over every worker process
+    when METRICS_DIR is set (as /metrics would show them)
+    """
+    if not METRICS_DIR:
+        return metric.merge([metric.snapshot()])
+    return metric.merge([snapshot.get(metric.name, []) for snapshot in _load_snapshots()])
+
+
+def render() -> str:
+    """
+    All registered metrics in Prometheus text format, summed over every
+    worker process when METRICS_DIR is set
+    """
+    snapshots = _load_snapshots() if METRICS_DIR else None
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        if snapshots is None:
+            lines.extend(metric.collect())
+        else:
+            lines.extend(metric.collect([snapshot.get(metric.name, []) for snapshot in snapshots]))
+    return '\n'.join(lines) + '\n'
+
+
+REQUESTS = Counter(
+    'fragment_api_requests_total', 'API requests served, by route and status', ('route', 'status'))
+REQUEST_DURATION = Histogram(
+    'fragment_api_request_duration_seconds', 'API request latency by route', ('route',))
+STAGE_DURATION = Histogram(
+    'fragment_stage_duration_seconds', 'Latency of pipeline stages (auth, Fragment steps, TON send)', ('stage', 'outcome'))
+UPSTREAM_RESPONSES = Counter(
+    'fragment_upstream_responses_total', 'Upstream HTTP responses by upstream and status code', ('upstream', 'status'))
+UPSTREAM_DURATION = Histogram(
+    'fragment_upstream_request_duration_seconds', 'Upstream HTTP latency to response headers', ('upstream',))
+CLOUDFLARE_CHALLENGES = Counter(
+    'fragment_cloudflare_challenges_total', 'Upstream responses that were Cloudflare challenges', ('upstream',))
+FRAGMENT_THROTTLED = Counter(
+    'fragment_throttled_total', 'fragment.com responses that slowed a session down, by reason', ('reason',))
+FRAGMENT_RETRIED = Counter(
+    'fragment_retries_total', 'fragment.com calls retried after backoff, by method', ('method',))
+FRAGMENT_RATE_WAIT = Histogram(
+    'fragment_rate_limit_wait_seconds', 'Time fragment.com calls waited for their session budget')
+CIRCUIT_TRANSITIONS = Counter(
+    'fragment_circuit_transitions_total', 'Circuit breaker state changes by upstream and new state', ('upstream', 'state'))
+CIRCUIT_REJECTIONS = Counter(
+    'fragment_circuit_rejections_total', 'Calls failed fast because the upstream circuit was open', ('upstream',))
+HEDGED_REQUESTS = Counter(
+    'fragment_hedged_requests_total', 'Second (hedged) requests sent for slow idempotent reads', ('upstream',))
+PREFLIGHT_REJECTIONS = Counter(
+    'fragment_preflight_rejections_total', 'Purchases refused before any Fragment call, by reason', ('reason',))
+WALLET_POOL_TAKES = Counter(
+    'fragment_wallet_pool_takes_total', 'Wallets requested from the pre-generated reserve, by result (hit or miss)', ('result',))
+WALLET_POOL_REFILLED = Counter(
+    'fragment_wallet_pool_refilled_total', 'Wallets generated into the pre-generated reserve')
+WALLET_POOL_DEPTH = Gauge(
+    'fragment_wallet_pool_depth', 'Ready wallets in the pre-generated reserve')
+WALLET_POOL_REFILL_RATE = Gauge(
+    'fragment_wallet_pool_refill_rate', 'Wallets per second generated by the last reserve refill')
@@ -0,0 +1,134 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+
+class RateLimitedError(Exception):
+    """
+    The upstream is rate limiting us for longer than the caller can wait
+    """
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket whose rate follows the upstream (additive increase,
+    multiplicative decrease). Each success raises the rate by `increase`
+    requests/s up to max_rate. A throttling response (429, 5xx, challenge)
+    multiplies it by `decrease`, at most once per `cooldown` seconds so one
+    burst of failures counts once, down to min_rate. A Retry-After pauses
+    the bucket, for at most max_pause seconds. Waiters are served in arrival
+    order.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        min_rate: float,
+        max_rate: float,
+        increase: float = 0.1,
+        decrease: float = 0.5,
+        cooldown: float = 1.0,
+        max_pause: Optional[float] = None
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.max_pause = max_pause
+        self.tokens = burst
+        self.paused_until = 0.0
+        self.throttled_total = 0
+        self.waiting = 0
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, timeout: Optional[float] = None) -> float:
+        """
+        Wait for a token; returns the seconds waited. Raises RateLimitedError
+        at once, instead of sleeping, if the token would come after `timeout`.
+        """
+        t0 = time.monotonic()
+        deadline = None if timeout is None else t0 + timeout
+        # A pause outlasting the deadline fails here, without queueing behind the lock
+        self._check_deadline(self.paused_until - t0, t0, deadline)
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self.paused_until - now
+                    if wait <= 0:
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            return now - t0
+                        wait = (1 - self.tokens) / self.rate
+                    self._check_deadline(wait, now, deadline)
+                    await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+
+    @staticmethod
+    def _check_deadline(wait: float, now: float, deadline: Optional[float]) -> None:
+        if deadline is not None and wait > 0 and now + wait > deadline:
+            raise RateLimitedError(f"rate limited for another {wait:.1f}s")
+
+    def success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self, retry_after: Optional[float] = None) -> None:
+        now = time.monotonic()
+        self.throttled_total += 1
+        if retry_after:
+            if self.max_pause is not None:
+                retry_after = min(retry_after, self.max_pause)
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self._last_decrease >= self.cooldown:
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # Drop the saved burst so the slower rate applies at once
+            self.tokens = 0.0
+            self._last_decrease = now
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "rate": round(self.rate, 2),
+            "tokens": round(self.tokens, 2),
+            "waiting": self.waiting,
+            "throttled": self.throttled_total,
+            "paused_for": max(0.0, round(self.paused_until - time.monotonic(), 1)),
+        }
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds from a Retry-After header (delta-seconds or HTTP date)
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Exponential backoff with full jitter: uniform in [0, min(cap, base * 2**attempt)]
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
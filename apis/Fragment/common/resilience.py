@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from common.metrics import CIRCUIT_REJECTIONS, CIRCUIT_TRANSITIONS, HEDGED_REQUESTS
+
+logger = logging.getLogger('resilience')
+
+# Consecutive failures (errors, timeouts, 5xx) that open an upstream's circuit
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+# How long an open circuit fails fast before letting a probe through
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get('BREAKER_HALF_OPEN_PROBES', 1))
+# Hedged reads: a second request is sent if the first is slower than the
+# upstream's recent p95 (but at least HEDGE_MIN_DELAY seconds)
+HEDGE_READS = os.environ.get('HEDGE_READS', '0') == '1'
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.05))
+HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', 1.0))
+# Latency samples kept per upstream for the p95
+LATENCY_WINDOW = 200
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """
+    The upstream's circuit is open; the call was not made
+    """
+
+    def __init__(self, upstream: str, retry_in: float):
+        super().__init__(f"{upstream} is unavailable, retry in {retry_in:.0f}s")
+        self.upstream = upstream
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Fails calls to a degraded upstream fast instead of letting them queue.
+
+    CLOSED: calls pass; `failure_threshold` consecutive failures open it.
+    OPEN: calls raise CircuitOpenError for `reset_timeout` seconds.
+    HALF_OPEN: up to `half_open_probes` calls go through; a success closes
+    the circuit, a failure opens it again. State is per process.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT,
+        half_open_probes: int = BREAKER_HALF_OPEN_PROBES
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.opened_at = 0.0
+        self._probes = 0
+        self._latencies: deque = deque(maxlen=LATENCY_WINDOW)
+
+    def _transition(self, state: str) -> None:
+        if state != self.state:
+            logger.warning('circuit %s %s -> %s', self.name, self.state, state)
+            CIRCUIT_TRANSITIONS.inc(upstream=self.name, state=state)
+        self.state = state
+
+    def before(self) -> None:
+        """
+        Raise CircuitOpenError unless a call may go through now
+        """
+        if self.state == OPEN:
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0:
+                self.rejected += 1
+                CIRCUIT_REJECTIONS.inc(upstream=self.name)
+                raise CircuitOpenError(self.name, retry_in)
+            self._transition(HALF_OPEN)
+            self._probes = 0
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_probes:
+                self.rejected += 1
+                CIRCUIT_REJECTIONS.inc(upstream=self.name)
+                raise CircuitOpenError(self.name, 1)
+            self._probes += 1
+
+    def success(self, elapsed: Optional[float] = None) -> None:
+        self.failures = 0
+        if elapsed is not None:
+            self._latencies.append(elapsed)
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def cancelled(self) -> None:
+        # A cancelled probe (e.g. the losing half of a hedge) proved nothing
+        if self.state == HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def failure(self) -> None:
+        self.failures += 1
+        # Calls already in flight when the circuit opened must not push its reset back
+        if self.state == OPEN:
+            return
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._transition(OPEN)
+
+    async def call(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        is_failure: Callable[[Exception], bool] = lambda e: True
+    ) -> Any:
+        """
+        Run fn() through the breaker. Errors for which is_failure() is
+        false (e.g. a 4xx for one bad request) show the upstream is up.
+        """
+        self.before()
+        t0 = time.monotonic()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            self.cancelled()
+            raise
+        except Exception as e:
+            if is_failure(e):
+                self.failure()
+            else:
+                self.success()
+            raise
+        self.success(time.monotonic() - t0)
+        return result
+
+    def p95(self) -> Optional[float]:
+        if len(self._latencies) < 20:
+            return None
+        samples = sorted(self._latencies)
+        return samples[int(len(samples) * 0.95) - 1]
+
+    def get_stats(self) -> Dict[str, Any]:
+        p95 = self.p95()
+        return {
+            "upstream": self.name,
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+def get_stats() -> List[Dict[str, Any]]:
+    return [breaker.get_stats() for breaker in _breakers.values()]
+
+
+async def hedged(upstream: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Run an idempotent read; if it is still pending after the upstream's
+    p95, start a second copy and return whichever succeeds first.
+    Without HEDGE_READS this is just `await fn()`.
+    """
+    if not HEDGE_READS:
+        return await fn()
+
+    p95 = get_breaker(upstream).p95()
+    delay = max(HEDGE_MIN_DELAY, p95 if p95 is not None else HEDGE_DEFAULT_DELAY)
+    tasks = [asyncio.ensure_future(fn())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            HEDGED_REQUESTS.inc(upstream=upstream)
+            tasks.append(asyncio.ensure_future(fn()))
+
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,65 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+_groups: Dict[str, "SingleFlight"] = {}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller makes the
+    upstream call and every caller arriving while it is in flight awaits the
+    same result (or exception). Nothing is cached once the call completes.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        # Upstream calls made, and callers that shared one instead
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Return the result of fn(), sharing an in-flight call for key if there is one
+        """
+        future = self._calls.get(key)
+        if future is not None and not future.done():
+            self.shared += 1
+        else:
+            self.calls += 1
+            future = self._calls[key] = asyncio.ensure_future(fn())
+            future.add_done_callback(lambda f: self._done(key, f))
+        # A cancelled caller must not cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            # Mark the exception retrieved even if every caller went away
+            future.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "shared": self.shared,
+            "in_flight": len(self._calls),
+        }
+
+
+def get_group(name: str) -> SingleFlight:
+    """
+    Return the shared single-flight group for name, creating it on first use
+    """
+    group = _groups.get(name)
+    if group is None:
+        group = _groups.setdefault(name, SingleFlight(name))
+    return group
+
+
+def get_stats() -> list:
+    """
+    Counters of every single-flight group
+    """
+    return [group.stats() for group in _groups.values()]
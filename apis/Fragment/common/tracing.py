@@ -0,0 +1,45 @@
+import logging
+import re
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Iterator, Optional
+
+from common.metrics import STAGE_DURATION
+
+logger = logging.getLogger('tracing')
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+_VALID_REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+# Id of the API request (or purchase job) the current task works for;
+# copied into tasks created from it, so it follows every upstream call
+request_id: ContextVar[Optional[str]] = ContextVar('request_id', default=None)
+
+
+def new_request_id(incoming: Optional[str] = None) -> str:
+    """
+    Use the caller's request id if it is well-formed, otherwise make one
+    """
+    if incoming and _VALID_REQUEST_ID.match(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Time a pipeline stage into the stage histogram, tagged with the request id
+    """
+    t0 = perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        elapsed = perf_counter() - t0
+        STAGE_DURATION.observe(elapsed, stage=stage, outcome=outcome)
+        logger.debug('span stage=%s outcome=%s ms=%.1f request_id=%s', stage, outcome, elapsed * 1000, request_id.get())
@@ -0,0 +1,92 @@
+"""
+Gunicorn settings for the Fragment API in production.
+
+    gunicorn -c gunicorn.conf.py main:app                                   # WSGI, threaded workers
+    gunicorn -c gunicorn.conf.py -k uvicorn_worker.UvicornWorker asgi:app   # ASGI
+
+The app is imported once in the master (preload) and forked into the
+workers. Each worker then starts its own event loop, upstream clients,
+purchase workers and log listener. On SIGTERM a worker fails /readyz,
+stops accepting connections, finishes in-flight requests and lets running
+purchases be sent (up to graceful_timeout) before it exits.
+
+Caches are per worker: invalidations posted by the Node API reach one
+worker and are replayed by the others from a shared SQLite log (see
+common/invalidation.py). /metrics is served by whichever worker takes the
+scrape, so every worker writes its values to METRICS_DIR and the scrape
+sums them.
+"""
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 3003)}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Flask views block on the shared event loop, so each worker serves requests from a thread pool
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+backlog = int(os.environ.get('GUNICORN_BACKLOG', 2048))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Workers that stop heartbeating for this long are killed and replaced
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# Recycle workers now and then; jitter keeps them from restarting together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info').lower()
+proc_name = 'fragment-api'
+
+# Set before the app is imported so every worker shares one directory
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'fragment-api-metrics'))
+
+
+def _is_asgi(worker) -> bool:
+    # uvicorn_worker.UvicornWorker runs the ASGI app, whose before/after_serving hooks start and drain the process
+    return type(worker).__module__.split('.')[0] in ('uvicorn_worker', 'uvicorn')
+
+
+def on_starting(server):
+    # Values from a previous run would be added to this run's counters
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['METRICS_DIR'], exist_ok=True)
+
+
+def post_worker_init(worker):
+    if _is_asgi(worker):
+        return
+    import asyncio
+    import main
+    from common import lifecycle, loop
+
+    loop.run(main.startup())
+
+    # Fail readiness and stop claiming purchases as soon as the worker is
+    # told to stop, while gunicorn finishes the in-flight requests
+    handle_exit = worker.handle_exit
+
+    def drain(sig, frame):
+        lifecycle.begin_drain()
+        asyncio.run_coroutine_threadsafe(main.wallet_api.purchase_jobs.drain(graceful_timeout), loop.get_loop())
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, drain)
+
+
+def worker_exit(server, worker):
+    if _is_asgi(worker):
+        return
+    import main
+    from common import loop
+
+    try:
+        loop.run(main.shutdown(), timeout=graceful_timeout + 5)
+    except Exception as e:
+        server.log.warning('worker %s shutdown failed: %s', worker.pid, e)
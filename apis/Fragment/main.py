@@ -1,186 +1,387 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-import requests
+import asyncio
 import os
 import sys
 import json
+import hashlib
+import hmac
+import logging
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Mapping, Optional
 
 # Add the wallet creation module to path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'walletCreate'))
 # Add the stars buy module to path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'starsBuy'))
 
-from walletCreate.wallet_generator import WalletGenerator
+from walletCreate.wallet_generator import WalletGenerator, new_executor
+from walletCreate.wallet_pool import WalletPool
 from starsBuy.stars_buy_service import StarsBuyService
+from starsBuy.purchase_jobs import PurchaseJobManager, SENT, CONFIRMED, FAILED, UNCONFIRMED
+from common.cache import TTLCache
+from common.http import check_public_url, close_clients, get_client
+from common.singleflight import get_group, get_stats as get_singleflight_counters
+from common import invalidation, lifecycle, loop, metrics
+from common.log import configure_logging
+from common.resilience import CircuitOpenError, get_stats as get_breaker_stats, hedged
+from common.tracing import REQUEST_ID_HEADER, new_request_id, request_id, span
+from api import fragment as fragment_api
+from api import wallet as ton_wallet
+from tonutils.utils import to_amount
+
+configure_logging()
+logger = logging.getLogger('main')
 
 app = Flask(__name__)
 CORS(app)
 
 # Configuration
-API_BASE_URL = "http://localhost:3000/api"
+API_BASE_URL = os.environ.get("API_BASE_URL", "http://localhost:3000/api")
 API_KEY_HEADER = "X-API-Key"
+INTERNAL_TOKEN_HEADER = "X-Internal-Token"
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+INTERNAL_API_TOKEN = os.environ.get("INTERNAL_API_TOKEN", "")
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 60))
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 10000))
+# Wallet fields never returned by an HTTP route
+SECRET_WALLET_FIELDS = ("mnemonics", "private_key", "privateKey")
+MAX_BULK_WALLETS = int(os.environ.get("MAX_BULK_WALLETS", 10000))
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", 500))
+# How long a synchronous /buy-stars call waits for its queued job to be sent
+PURCHASE_WAIT_TIMEOUT = float(os.environ.get("PURCHASE_WAIT_TIMEOUT", 120))
+# How long a stopping worker lets running purchases finish (matches gunicorn's graceful_timeout)
+GRACEFUL_TIMEOUT = float(os.environ.get("GRACEFUL_TIMEOUT", 30))
+# Pre-generated wallet reserve (disabled unless an encryption key is configured)
+WALLET_POOL_KEY = os.environ.get("WALLET_POOL_KEY", "")
+WALLET_POOL_PATH = os.environ.get("WALLET_POOL_PATH", os.path.join(os.path.dirname(__file__), "wallet_pool.db"))
+WALLET_POOL_LOW = int(os.environ.get("WALLET_POOL_LOW", 50))
+WALLET_POOL_HIGH = int(os.environ.get("WALLET_POOL_HIGH", 200))
+
+
+@dataclass
+class ApiRequest:
+    """Framework-independent view of an incoming request"""
+    headers: Mapping[str, str]
+    json: Optional[dict] = None
+    args: Mapping[str, str] = field(default_factory=dict)
+    params: dict = field(default_factory=dict)
+    request_id: Optional[str] = None
+
 
 class WalletAPI:
     def __init__(self):
         self.wallet_generator = WalletGenerator()
-        self.stars_buy_service = StarsBuyService()
-    
-    def validate_api_key(self, api_key):
-        """Validate API key with the main API server"""
-        try:
-            response = requests.post(
-                f"{API_BASE_URL}/subscriptions/validate",
-                json={"apiKey": api_key},
-                headers={"Content-Type": "application/json"}
+        # Process pool for bulk generation, started on first use in each worker
+        self.generator_executor = None
+        self.stars_buy_service = StarsBuyService(API_BASE_URL)
+        self.purchase_jobs = PurchaseJobManager(self.stars_buy_service)
+        self.wallet_pool = None
+        if WALLET_POOL_KEY:
+            self.wallet_pool = WalletPool(
+                self.wallet_generator,
+                WALLET_POOL_PATH,
+                WALLET_POOL_KEY,
+                low_watermark=WALLET_POOL_LOW,
+                high_watermark=WALLET_POOL_HIGH
             )
-            
-            if response.status_code == 200:
-                data = response.json()
-                return data.get("success", False) and data.get("data", {}).get("isValid", False)
-            return False
-        except Exception as e:
-            print(f"Error validating API key: {e}")
-            return False
-    
-    def get_subscription_info(self, api_key):
-        """Get subscription information from the main API server"""
+        # Subscriptions keyed by sha256(api_key); the raw key is never stored
+        self.subscription_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+    @staticmethod
+    def hash_api_key(api_key):
+        """Hash an API key for use as a cache key"""
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+    async def lookup_subscription(self, api_key):
+        """Validate API key with the main API server and return its subscription"""
         try:
-            response = requests.post(
+            # A read despite the POST, so it may be hedged
+            response = await hedged('backend', lambda: get_client('backend').post(
                 f"{API_BASE_URL}/subscriptions/validate",
                 json={"apiKey": api_key},
                 headers={"Content-Type": "application/json"}
-            )
-            
+            ))
+
             if response.status_code == 200:
                 data = response.json()
-                if data.get("success", False):
-                    return data.get("data", {}).get("subscription", {})
+                if data.get("success", False) and data.get("data", {}).get("isValid", False):
+                    return data["data"].get("subscription") or None
             return None
+        except CircuitOpenError:
+            # Not an invalid key: the backend is down
+            raise
         except Exception as e:
-            print(f"Error getting subscription info: {e}")
+            logger.warning('Error validating API key: %s', e)
             return None
 
+    async def authenticate(self, api_key):
+        """Return the subscription for a valid API key, using the cache when possible"""
+        key = self.hash_api_key(api_key)
+        subscription = self.subscription_cache.get(key)
+        if subscription is None:
+            # Concurrent requests with the same key share one validation call
+            subscription = await get_group('subscriptions').do(key, lambda: self.lookup_subscription(api_key))
+            if subscription:
+                self.subscription_cache.set(key, subscription)
+        return subscription
+
+    def invalidate_subscription(self, subscription_id=None, api_key_hash=None):
+        """Drop cached subscriptions by ID and/or API key hash, or everything if neither is given"""
+        if subscription_id is None and api_key_hash is None:
+            removed = len(self.subscription_cache)
+            self.subscription_cache.clear()
+            return removed
+
+        removed = 0
+        if api_key_hash:
+            if self.subscription_cache.pop(api_key_hash) is not None:
+                removed += 1
+        if subscription_id is not None:
+            removed += self.subscription_cache.discard_where(
+                lambda _key, sub: str(sub.get("id")) == str(subscription_id)
+            )
+        return removed
+
+    async def get_subscription_wallets(self, subscription_id):
+        """Get wallets already stored for a subscription (None if the lookup failed)"""
+        response = await get_client('backend').get(
+            f"{API_BASE_URL}/wallets/subscription/{subscription_id}",
+            headers={"Content-Type": "application/json"}
+        )
+        if response.status_code != 200:
+            return None
+        return response.json().get("data", [])
+
+    async def take_wallet(self):
+        """Pop a pre-generated wallet from the reserve, generating one inline if it is empty"""
+        wallet_data = None
+        if self.wallet_pool:
+            try:
+                wallet_data = await asyncio.to_thread(self.wallet_pool.take)
+            except Exception as e:
+                logger.warning('Error taking wallet from pool: %s', e)
+        if wallet_data is None:
+            # CPU-bound, keep it off the event loop
+            wallet_data = await asyncio.to_thread(self.wallet_generator.generate_single_wallet)
+        return wallet_data
+
+    async def generate_wallets(self, count):
+        """Generate wallets across all cores without blocking the event loop"""
+        if self.generator_executor is None:
+            self.generator_executor = new_executor()
+        executor = self.generator_executor
+        try:
+            return await asyncio.to_thread(
+                lambda: list(self.wallet_generator.iter_wallets_parallel(count, executor=executor))
+            )
+        except BrokenProcessPool:
+            # Start a fresh pool for the next request
+            if self.generator_executor is executor:
+                self.close_generator_executor()
+            raise
+
+    def close_generator_executor(self):
+        """Stop the bulk generation processes"""
+        if self.generator_executor is not None:
+            self.generator_executor.shutdown(wait=False, cancel_futures=True)
+            self.generator_executor = None
+
+    @staticmethod
+    def build_wallet_record(wallet_data, subscription_id, user_id):
+        """Build the /api/wallets payload for a generated wallet"""
+        return {
+            "subscriptionId": int(subscription_id),
+            "userId": int(user_id),
+            "walletAddress": str(wallet_data["address"]),
+            "mnemonics": " ".join(wallet_data["mnemonics"]),
+            "publicKey": str(wallet_data["public_key"]),
+            "privateKey": str(wallet_data["private_key"]),
+            "workchain": int(wallet_data["workchain"]),
+            "version": str(wallet_data["version"])
+        }
+
 wallet_api = WalletAPI()
 
-@app.route('/health', methods=['GET'])
-def health_check():
+# Invalidations arrive at one worker and are replayed by the others
+invalidation.register('subscription', lambda payload: wallet_api.invalidate_subscription(
+    subscription_id=payload.get("subscriptionId"),
+    api_key_hash=payload.get("apiKeyHash")
+))
+invalidation.register('user_context', lambda payload: wallet_api.stars_buy_service.invalidate_user_data(
+    payload.get("userId")
+))
+
+
+def check_internal_token(req):
+    """Return an error response unless the request carries the internal token"""
+    if not INTERNAL_API_TOKEN:
+        # Internal routes are closed unless a token is configured
+        return {
+            "success": False,
+            "message": "Internal API is disabled"
+        }, 403
+    if not hmac.compare_digest(req.headers.get(INTERNAL_TOKEN_HEADER, ""), INTERNAL_API_TOKEN):
+        return {
+            "success": False,
+            "message": "Invalid internal token"
+        }, 401
+    return None
+
+
+def public_wallet(wallet):
+    """Copy of a wallet record without its mnemonic or private key"""
+    return {k: v for k, v in wallet.items() if k not in SECRET_WALLET_FIELDS}
+
+
+def upstream_unavailable(error):
+    """503 response for a call refused by an open circuit breaker"""
+    return {
+        "success": False,
+        "message": str(error),
+        "retry_after": max(1, round(error.retry_in))
+    }, 503
+
+
+async def authenticate_request(req):
+    """
+    Resolve the request's API key to a Fragment subscription.
+    Returns (subscription, None) on success or (None, error_response).
+    """
+    api_key = req.headers.get(API_KEY_HEADER)
+    if not api_key:
+        return None, ({
+            "success": False,
+            "message": "API key is required"
+        }, 401)
+
+    try:
+        with span('auth'):
+            subscription = await wallet_api.authenticate(api_key)
+    except CircuitOpenError as e:
+        return None, upstream_unavailable(e)
+    if not subscription:
+        return None, ({
+            "success": False,
+            "message": "Invalid API key"
+        }, 401)
+
+    # Check if subscription is for Fragment API
+    if subscription.get("selectedAPI") != "Fragment":
+        return None, ({
+            "success": False,
+            "message": "This API key is not authorized for Fragment API"
+        }, 403)
+
+    return subscription, None
+
+
+async def health_check(req):
     """Health check endpoint"""
-    return jsonify({
+    return {
         "success": True,
         "message": "Fragment Wallet API is running",
         "timestamp": datetime.now().isoformat(),
         "version": "1.0.0"
-    })
+    }, 200
+
 
-@app.route('/generate-wallet', methods=['POST'])
-def generate_wallet():
+async def liveness(req):
+    """Liveness probe: the process and its event loop respond"""
+    return {
+        "success": True,
+        "status": "alive",
+        "pid": os.getpid(),
+        "uptime": round(lifecycle.uptime(), 1)
+    }, 200
+
+
+async def readiness(req):
+    """Readiness probe: not shutting down and the purchase job store is reachable"""
+    if lifecycle.is_draining():
+        return {"success": False, "status": "draining"}, 503
+
+    try:
+        await asyncio.to_thread(wallet_api.purchase_jobs.store.ping)
+    except Exception as e:
+        logger.warning('readiness check failed: %s', e)
+        return {"success": False, "status": "unavailable", "message": "Purchase job store is unavailable"}, 503
+
+    return {
+        "success": True,
+        "status": "ready",
+        "pid": os.getpid(),
+        "purchase_workers": wallet_api.purchase_jobs.running
+    }, 200
+
+
+async def generate_wallet(req):
     """Generate a single wallet"""
     try:
-        # Get API key from header
-        api_key = request.headers.get(API_KEY_HEADER)
-        if not api_key:
-            return jsonify({
-                "success": False,
-                "message": "API key is required"
-            }), 401
-        
-        # Validate API key
-        if not wallet_api.validate_api_key(api_key):
-            return jsonify({
-                "success": False,
-                "message": "Invalid API key"
-            }), 401
-        
-        # Get subscription info
-        subscription = wallet_api.get_subscription_info(api_key)
-        if not subscription:
-            return jsonify({
-                "success": False,
-                "message": "Could not retrieve subscription information"
-            }), 400
-        
-        # Check if subscription is for Fragment API
-        if subscription.get("selectedAPI") != "Fragment":
-            return jsonify({
-                "success": False,
-                "message": "This API key is not authorized for Fragment API"
-            }), 403
-        
+        # Authenticate API key (single cached lookup)
+        subscription, error = await authenticate_request(req)
+        if error:
+            return error
+
         # Check if subscription already has a wallet
         subscription_id = subscription.get("id")
         if not subscription_id:
-            return jsonify({
+            return {
                 "success": False,
                 "message": "Could not retrieve subscription ID"
-            }), 400
-        
-        # Check if wallet already exists for this subscription
-        check_response = requests.get(
-            f"{API_BASE_URL}/wallets/subscription/{subscription_id}",
-            headers={"Content-Type": "application/json"}
-        )
-        
-        if check_response.status_code == 200:
-            existing_wallets = check_response.json().get("data", [])
-            if existing_wallets:
-                return jsonify({
-                    "success": False,
-                    "message": "This subscription already has a wallet. Only one wallet per subscription is allowed."
-                }), 400
-        
-        # Generate wallet
-        wallet_data = wallet_api.wallet_generator.generate_single_wallet()
-        
-        print(f"Generated wallet data: {wallet_data}")
-        
-        # Save wallet to database
+            }, 400
+
+        # Validated before a reserve wallet is taken, so a bad subscription never consumes one
         selected_user = subscription.get("selectedUser")
         if not selected_user:
-            return jsonify({
+            return {
                 "success": False,
                 "message": "Could not retrieve user ID from subscription"
-            }), 400
-            
-        wallet_save_data = {
-            "subscriptionId": int(subscription_id),
-            "userId": int(selected_user),
-            "walletAddress": str(wallet_data["address"]),
-            "mnemonics": " ".join(wallet_data["mnemonics"]),
-            "publicKey": str(wallet_data["public_key"]),
-            "privateKey": str(wallet_data["private_key"]),
-            "workchain": int(wallet_data["workchain"]),
-            "version": str(wallet_data["version"])
-        }
-        
-        print(f"Saving wallet data: {wallet_save_data}")
-        
-        save_response = requests.post(
+            }, 400
+
+        # Check if wallet already exists for this subscription
+        existing_wallets = await wallet_api.get_subscription_wallets(subscription_id)
+        if existing_wallets:
+            return {
+                "success": False,
+                "message": "This subscription already has a wallet. Only one wallet per subscription is allowed."
+            }, 400
+
+        # Take a pre-generated wallet (falls back to generating one)
+        wallet_data = await wallet_api.take_wallet()
+
+        # Save wallet to database
+        wallet_save_data = wallet_api.build_wallet_record(wallet_data, subscription_id, selected_user)
+
+        save_response = await get_client('backend').post(
             f"{API_BASE_URL}/wallets",
             json=wallet_save_data,
             headers={"Content-Type": "application/json"}
         )
-        
-        print(f"Save response status: {save_response.status_code}")
-        print(f"Save response content: {save_response.text}")
-        
+
+        logger.info('Saved wallet subscription=%s address=%s status=%s',
+                    subscription_id, wallet_save_data["walletAddress"], save_response.status_code)
+
         if save_response.status_code != 201:
             error_data = save_response.json() if save_response.content else {}
-            return jsonify({
+            return {
                 "success": False,
                 "message": f"Error saving wallet to database: {error_data.get('message', 'Unknown error')}",
                 "status_code": save_response.status_code,
                 "response": error_data
-            }), 500
-        
+            }, 500
+
         saved_wallet = save_response.json().get("data", {})
-        
-        return jsonify({
+
+        return {
             "success": True,
             "message": "Wallet generated and saved successfully",
             "data": {
-                "wallet": wallet_data,
-                "saved_wallet": saved_wallet,
+                "wallet": public_wallet(wallet_data),
+                "saved_wallet": public_wallet(saved_wallet),
                 "subscription": {
                     "userName": subscription.get("userName"),
                     "selectedAPI": subscription.get("selectedAPI"),
@@ -188,63 +389,109 @@ def generate_wallet():
                 },
                 "generated_at": datetime.now().isoformat()
             }
-        })
-        
+        }, 200
+
+    except CircuitOpenError:
+        raise
     except Exception as e:
-        return jsonify({
+        return {
             "success": False,
             "message": f"Error generating wallet: {str(e)}"
-        }), 500
+        }, 500
 
 
-
-@app.route('/wallet-info', methods=['GET'])
-def get_wallet_info():
-    """Get information about wallet generation capabilities"""
+async def generate_wallets(req):
+    """
+    Generate wallets in bulk for onboarding (internal).
+    Body: {"subscriptions": [{"subscriptionId": .., "userId": ..}, ...]}
+    generates one wallet per subscription and saves them with a single bulk
+    insert. Key material is only sent to the backend, never returned.
+    """
     try:
-        # Get API key from header
-        api_key = request.headers.get(API_KEY_HEADER)
-        if not api_key:
-            return jsonify({
-                "success": False,
-                "message": "API key is required"
-            }), 401
-        
-        # Validate API key
-        if not wallet_api.validate_api_key(api_key):
-            return jsonify({
+        error = check_internal_token(req)
+        if error:
+            return error
+
+        data = req.json or {}
+        assignments = data.get("subscriptions")
+
+        if not isinstance(assignments, list) or not assignments:
+            return {
                 "success": False,
-                "message": "Invalid API key"
-            }), 401
-        
-        # Get subscription info
-        subscription = wallet_api.get_subscription_info(api_key)
-        if not subscription:
-            return jsonify({
+                "message": "Provide a non-empty subscriptions list"
+            }, 400
+        count = len(assignments)
+
+        if count > MAX_BULK_WALLETS:
+            return {
                 "success": False,
-                "message": "Could not retrieve subscription information"
-            }), 400
-        
-        # Check if subscription is for Fragment API
-        if subscription.get("selectedAPI") != "Fragment":
-            return jsonify({
+                "message": f"At most {MAX_BULK_WALLETS} wallets can be generated per request"
+            }, 400
+
+        wallets = await wallet_api.generate_wallets(count)
+
+        records = [
+            wallet_api.build_wallet_record(wallet_data, item.get("subscriptionId"), item.get("userId"))
+            for wallet_data, item in zip(wallets, assignments)
+        ]
+
+        save_response = await get_client('backend').post(
+            f"{API_BASE_URL}/wallets/bulk",
+            json={"wallets": records},
+            headers={"Content-Type": "application/json"}
+        )
+
+        if save_response.status_code != 201:
+            error_data = save_response.json() if save_response.content else {}
+            return {
                 "success": False,
-                "message": "This API key is not authorized for Fragment API"
-            }), 403
-        
+                "message": f"Error saving wallets to database: {error_data.get('message', 'Unknown error')}",
+                "status_code": save_response.status_code,
+                "response": error_data
+            }, 500
+
+        saved_wallets = save_response.json().get("data", [])
+
+        return {
+            "success": True,
+            "message": "Wallets generated and saved successfully",
+            "data": {
+                "count": len(saved_wallets),
+                "saved_wallets": [public_wallet(w) for w in saved_wallets],
+                "generated_at": datetime.now().isoformat()
+            }
+        }, 200
+
+    except (TypeError, ValueError) as e:
+        return {
+            "success": False,
+            "message": f"Invalid subscriptions list: {str(e)}"
+        }, 400
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        return {
+            "success": False,
+            "message": f"Error generating wallets: {str(e)}"
+        }, 500
+
+
+async def get_wallet_info(req):
+    """Get information about wallet generation capabilities"""
+    try:
+        # Authenticate API key (single cached lookup)
+        subscription, error = await authenticate_request(req)
+        if error:
+            return error
+
         # Check if subscription already has a wallet
         subscription_id = subscription.get("id")
         has_wallet = False
         if subscription_id:
-            check_response = requests.get(
-                f"{API_BASE_URL}/wallets/subscription/{subscription_id}",
-                headers={"Content-Type": "application/json"}
-            )
-            if check_response.status_code == 200:
-                existing_wallets = check_response.json().get("data", [])
-                has_wallet = len(existing_wallets) > 0
-        
-        return jsonify({
+            existing_wallets = await wallet_api.get_subscription_wallets(subscription_id)
+            has_wallet = bool(existing_wallets)
+
+        return {
             "success": True,
             "data": {
                 "subscription": {
@@ -268,274 +515,710 @@ def get_wallet_info():
                     }
                 }
             }
-        })
-        
+        }, 200
+
+    except CircuitOpenError:
+        raise
     except Exception as e:
-        return jsonify({
+        return {
             "success": False,
             "message": f"Error getting wallet info: {str(e)}"
-        }), 500
+        }, 500
+
 
-@app.route('/search-user', methods=['POST'])
-def search_user():
+async def search_user(req):
     """Search for a Telegram user by username"""
     try:
-        # Get API key from header
-        api_key = request.headers.get(API_KEY_HEADER)
-        if not api_key:
-            return jsonify({
-                "success": False,
-                "message": "API key is required"
-            }), 401
-        
-        # Validate API key
-        if not wallet_api.validate_api_key(api_key):
-            return jsonify({
-                "success": False,
-                "message": "Invalid API key"
-            }), 401
-        
-        # Get subscription info
-        subscription = wallet_api.get_subscription_info(api_key)
-        if not subscription:
-            return jsonify({
-                "success": False,
-                "message": "Could not retrieve subscription information"
-            }), 400
-        
-        # Check if subscription is for Fragment API
-        if subscription.get("selectedAPI") != "Fragment":
-            return jsonify({
-                "success": False,
-                "message": "This API key is not authorized for Fragment API"
-            }), 403
-        
+        # Authenticate API key (single cached lookup)
+        subscription, error = await authenticate_request(req)
+        if error:
+            return error
+
         # Get request data
-        data = request.get_json()
+        data = req.json
         if not data:
-            return jsonify({
+            return {
                 "success": False,
                 "message": "Request body is required"
-            }), 400
-        
+            }, 400
+
         username = data.get("username")
         quantity = data.get("quantity", 50)
-        
+
         if not username:
-            return jsonify({
+            return {
                 "success": False,
                 "message": "Username is required"
-            }), 400
-        
+            }, 400
+
         # Remove @ if present
         username = username.lstrip("@")
-        
+
         # Search for user
-        import asyncio
-        user_result = asyncio.run(wallet_api.stars_buy_service.search_user(
+        user_result = await wallet_api.stars_buy_service.search_user(
             user_id=subscription.get("selectedUser"),
             username=username,
             quantity=quantity
-        ))
-        
+        )
+
         if not user_result:
-            return jsonify({
+            return {
                 "success": False,
                 "message": "User not found or no recipient address available"
-            }), 404
-        
-        return jsonify({
+            }, 404
+
+        return {
             "success": True,
             "message": "User found successfully",
             "data": user_result
-        })
-        
+        }, 200
+
+    except CircuitOpenError:
+        raise
     except Exception as e:
-        return jsonify({
+        return {
             "success": False,
             "message": f"Error searching user: {str(e)}"
-        }), 500
+        }, 500
 
 
-@app.route('/buy-stars', methods=['POST'])
-def buy_stars():
+async def buy_stars(req):
     """Buy Telegram Stars for a user"""
     try:
-        # Get API key from header
-        api_key = request.headers.get(API_KEY_HEADER)
-        if not api_key:
-            return jsonify({
-                "success": False,
-                "message": "API key is required"
-            }), 401
-        
-        # Validate API key
-        if not wallet_api.validate_api_key(api_key):
-            return jsonify({
-                "success": False,
-                "message": "Invalid API key"
-            }), 401
-        
-        # Get subscription info
-        subscription = wallet_api.get_subscription_info(api_key)
-        if not subscription:
-            return jsonify({
-                "success": False,
-                "message": "Could not retrieve subscription information"
-            }), 400
-        
-        # Check if subscription is for Fragment API
-        if subscription.get("selectedAPI") != "Fragment":
-            return jsonify({
-                "success": False,
-                "message": "This API key is not authorized for Fragment API"
-            }), 403
-        
+        # Authenticate API key (single cached lookup)
+        subscription, error = await authenticate_request(req)
+        if error:
+            return error
+
         # Get request data
-        data = request.get_json()
+        data = req.json
         if not data:
-            return jsonify({
+            return {
                 "success": False,
                 "message": "Request body is required"
-            }), 400
-        
+            }, 400
+
         username = data.get("username")
         quantity = data.get("quantity", 50)
-        
+
         if not username:
-            return jsonify({
+            return {
                 "success": False,
                 "message": "Username is required"
-            }), 400
-        
+            }, 400
+
         if not isinstance(quantity, int) or quantity <= 0:
-            return jsonify({
+            return {
                 "success": False,
                 "message": "Quantity must be a positive integer"
-            }), 400
-        
+            }, 400
+
+        callback_url = data.get("callback_url")
+        if callback_url:
+            # The webhook is sent from inside our network: only public hosts
+            reason = await check_public_url(callback_url) if isinstance(callback_url, str) else "must be an http(s) URL"
+            if reason:
+                return {
+                    "success": False,
+                    "message": f"callback_url is not allowed: {reason}"
+                }, 400
+
+        # Retries carrying the same key never buy twice
+        idempotency_key = req.headers.get(IDEMPOTENCY_KEY_HEADER) or data.get("idempotency_key")
+        if idempotency_key is not None and not (isinstance(idempotency_key, str) and 0 < len(idempotency_key) <= 255):
+            return {
+                "success": False,
+                "message": "Idempotency key must be a string of at most 255 characters"
+            }, 400
+
         # Remove @ if present
         username = username.lstrip("@")
-        
-        # Buy stars
-        import asyncio
-        tx_hash = asyncio.run(wallet_api.stars_buy_service.buy_stars(
-            user_id=subscription.get("selectedUser"),
-            username=username,
-            quantity=quantity
-        ))
-        
-        if not tx_hash:
-            return jsonify({
+        user_id = subscription.get("selectedUser")
+
+        # Refuse a new purchase the wallet clearly cannot pay for, before any Fragment call
+        if idempotency_key is None or await wallet_api.purchase_jobs.find(user_id, idempotency_key) is None:
+            shortfall = wallet_api.stars_buy_service.check_balance(user_id, quantity)
+            if shortfall:
+                metrics.PREFLIGHT_REJECTIONS.inc(reason='balance')
+                return {
+                    "success": False,
+                    "message": "Insufficient wallet balance for this purchase",
+                    "data": {
+                        "required": to_amount(shortfall["required_nano"], precision=9),
+                        "required_nano": shortfall["required_nano"],
+                        "required_formatted": f"{shortfall['required_nano'] / 1e9:.9f} TON",
+                        "balance": to_amount(shortfall["balance_nano"], precision=9),
+                        "balance_nano": shortfall["balance_nano"],
+                        "balance_formatted": f"{shortfall['balance_nano'] / 1e9:.9f} TON"
+                    }
+                }, 400
+
+        job, created = await wallet_api.purchase_jobs.submit(
+            user_id, username, quantity, callback_url, idempotency_key
+        )
+        if not created and (job.username, job.quantity) != (username, quantity):
+            return {
                 "success": False,
-                "message": "Failed to buy stars. Please check your wallet balance and Fragment credentials."
-            }), 400
-        
-        return jsonify({
+                "message": "Idempotency key was already used for a different purchase"
+            }, 409
+
+        queued = {
+            "success": True,
+            "message": "Stars purchase queued",
+            "data": {
+                "job_id": job.job_id,
+                "state": job.state,
+                "status_url": f"/buy-stars/jobs/{job.job_id}"
+            }
+        }, 202
+
+        # Asynchronous mode: return the job id right away
+        if data.get("async") or callback_url:
+            return queued
+
+        # Synchronous mode: wait for the queued purchase to be sent
+        job = await wallet_api.purchase_jobs.wait(job.job_id, PURCHASE_WAIT_TIMEOUT)
+
+        if job is None:
+            # Purged from the store while we waited
+            return {
+                "success": False,
+                "message": "Job not found"
+            }, 404
+
+        if job.state == FAILED:
+            return {
+                "success": False,
+                "message": job.error
+            }, 400
+
+        if job.state not in (SENT, CONFIRMED, UNCONFIRMED):
+            queued[0]["data"]["state"] = job.state
+            return queued
+
+        return {
             "success": True,
             "message": "Stars purchased successfully",
             "data": {
                 "username": username,
                 "quantity": quantity,
-                "tx_hash": tx_hash,
+                "tx_hash": job.tx_hash,
+                "job_id": job.job_id,
                 "purchased_at": datetime.now().isoformat()
             }
-        })
-        
+        }, 200
+
+    except CircuitOpenError:
+        raise
     except Exception as e:
-        return jsonify({
+        return {
             "success": False,
             "message": f"Error buying stars: {str(e)}"
-        }), 500
+        }, 500
 
 
-@app.route('/wallet-balance', methods=['GET'])
-def get_wallet_balance():
-    """Get wallet balance for the authenticated user"""
+async def get_stars_price(req):
+    """Quote the TON price of Telegram Stars from the cached price table"""
+    try:
+        # Authenticate API key (single cached lookup)
+        subscription, error = await authenticate_request(req)
+        if error:
+            return error
+
+        quantity = req.args.get("quantity")
+        if quantity is not None:
+            if not quantity.isdigit() or int(quantity) <= 0:
+                return {
+                    "success": False,
+                    "message": "Quantity must be a positive integer"
+                }, 400
+            quantity = int(quantity)
+
+        quote = await wallet_api.stars_buy_service.quote_stars(
+            user_id=subscription.get("selectedUser"),
+            quantity=quantity
+        )
+
+        if not quote:
+            return {
+                "success": False,
+                "message": "Stars price is not available right now"
+            }, 503
+
+        return {
+            "success": True,
+            "message": "Stars price retrieved successfully",
+            "data": quote if quantity else {"prices": quote}
+        }, 200
+
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        return {
+            "success": False,
+            "message": f"Error getting stars price: {str(e)}"
+        }, 500
+
+
+async def get_purchase_job(req):
+    """Get the state of a stars purchase job"""
     try:
-        # Get API key from header
-        api_key = request.headers.get(API_KEY_HEADER)
-        if not api_key:
-            return jsonify({
+        # Authenticate API key (single cached lookup)
+        subscription, error = await authenticate_request(req)
+        if error:
+            return error
+
+        job = await wallet_api.purchase_jobs.get(req.params.get("job_id"))
+        if not job or str(job.user_id) != str(subscription.get("selectedUser")):
+            return {
                 "success": False,
-                "message": "API key is required"
-            }), 401
-        
-        # Validate API key
-        if not wallet_api.validate_api_key(api_key):
-            return jsonify({
+                "message": "Job not found"
+            }, 404
+
+        return {
+            "success": True,
+            "data": job.to_dict()
+        }, 200
+
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        return {
+            "success": False,
+            "message": f"Error getting job: {str(e)}"
+        }, 500
+
+
+async def buy_stars_batch(req):
+    """
+    Queue Telegram Stars purchases for many recipients. Each item becomes a
+    durable purchase job (as with async /buy-stars); the response lists the
+    job ids to poll, and the batch id for GET /buy-stars/batches/<batch_id>.
+    With an idempotency key, item i is keyed "<key>:<i>" (or by its own
+    idempotency_key), so a retried batch never buys twice.
+    """
+    try:
+        # Authenticate API key (single cached lookup)
+        subscription, error = await authenticate_request(req)
+        if error:
+            return error
+
+        # Get request data
+        data = req.json
+        items = data.get("items") if data else None
+        if not isinstance(items, list) or not items:
+            return {
                 "success": False,
-                "message": "Invalid API key"
-            }), 401
-        
-        # Get subscription info
-        subscription = wallet_api.get_subscription_info(api_key)
-        if not subscription:
-            return jsonify({
+                "message": "A non-empty items list is required"
+            }, 400
+
+        if len(items) > MAX_BATCH_ITEMS:
+            return {
                 "success": False,
-                "message": "Could not retrieve subscription information"
-            }), 400
-        
-        # Check if subscription is for Fragment API
-        if subscription.get("selectedAPI") != "Fragment":
-            return jsonify({
+                "message": f"At most {MAX_BATCH_ITEMS} items are allowed per batch"
+            }, 400
+
+        callback_url = data.get("callback_url")
+        if callback_url:
+            reason = await check_public_url(callback_url) if isinstance(callback_url, str) else "must be an http(s) URL"
+            if reason:
+                return {
+                    "success": False,
+                    "message": f"callback_url is not allowed: {reason}"
+                }, 400
+
+        batch_key = req.headers.get(IDEMPOTENCY_KEY_HEADER) or data.get("idempotency_key")
+        if batch_key is not None and not (isinstance(batch_key, str) and 0 < len(batch_key) <= 240):
+            return {
                 "success": False,
-                "message": "This API key is not authorized for Fragment API"
-            }), 403
-        
-        # Get wallet balance
-        import asyncio
-        balance = asyncio.run(wallet_api.stars_buy_service.get_wallet_balance(
+                "message": "Idempotency key must be a string of at most 240 characters"
+            }, 400
+
+        # Invalid items fail individually instead of rejecting the batch
+        user_id = subscription.get("selectedUser")
+        # A retried batch keeps its id
+        batch_id = (
+            hashlib.sha256(f"{user_id}:{batch_key}".encode()).hexdigest()[:32] if batch_key
+            else uuid.uuid4().hex
+        )
+        results = []
+        for index, item in enumerate(items):
+            item = item if isinstance(item, dict) else {}
+            username = item.get("username")
+            quantity = item.get("quantity", 50)
+            idempotency_key = item.get("idempotency_key") or (f"{batch_key}:{index}" if batch_key else None)
+            result = {"username": username, "quantity": quantity}
+            if not username or not isinstance(username, str):
+                results.append({**result, "success": False, "error": "Username is required"})
+                continue
+            if not isinstance(quantity, int) or quantity <= 0:
+                results.append({**result, "success": False, "error": "Quantity must be a positive integer"})
+                continue
+            if idempotency_key is not None and not (isinstance(idempotency_key, str) and len(idempotency_key) <= 255):
+                results.append({**result, "success": False, "error": "Idempotency key must be a string of at most 255 characters"})
+                continue
+
+            username = result["username"] = username.lstrip("@")
+            job, created = await wallet_api.purchase_jobs.submit(
+                user_id, username, quantity, callback_url, idempotency_key, batch_id
+            )
+            if not created and (job.username, job.quantity) != (username, quantity):
+                results.append({**result, "success": False, "error": "Idempotency key was already used for a different purchase"})
+                continue
+            results.append({
+                **result,
+                "success": True,
+                "job_id": job.job_id,
+                "state": job.state,
+                "status_url": f"/buy-stars/jobs/{job.job_id}"
+            })
+
+        queued = sum(1 for result in results if result["success"])
+
+        return {
+            "success": True,
+            "message": "Batch queued",
+            "data": {
+                "batch_id": batch_id,
+                "status_url": f"/buy-stars/batches/{batch_id}",
+                "results": results,
+                "queued": queued,
+                "rejected": len(results) - queued
+            }
+        }, 202
+
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        return {
+            "success": False,
+            "message": f"Error buying stars: {str(e)}"
+        }, 500
+
+
+async def get_purchase_batch(req):
+    """Get the state of every purchase job queued by one batch"""
+    try:
+        # Authenticate API key (single cached lookup)
+        subscription, error = await authenticate_request(req)
+        if error:
+            return error
+
+        jobs = await wallet_api.purchase_jobs.list_batch(
+            subscription.get("selectedUser"), req.params.get("batch_id")
+        )
+        if not jobs:
+            return {
+                "success": False,
+                "message": "Batch not found"
+            }, 404
+
+        states = {}
+        for job in jobs:
+            states[job.state] = states.get(job.state, 0) + 1
+
+        return {
+            "success": True,
+            "data": {
+                "batch_id": req.params.get("batch_id"),
+                "total": len(jobs),
+                "states": states,
+                "jobs": [job.to_dict() for job in jobs]
+            }
+        }, 200
+
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        return {
+            "success": False,
+            "message": f"Error getting batch: {str(e)}"
+        }, 500
+
+
+async def get_wallet_balance(req):
+    """Get wallet balance for the authenticated user"""
+    try:
+        # Authenticate API key (single cached lookup)
+        subscription, error = await authenticate_request(req)
+        if error:
+            return error
+
+        # Get wallet balance (cached for a few seconds per wallet)
+        entry = await wallet_api.stars_buy_service.get_wallet_balance_entry(
             user_id=subscription.get("selectedUser")
-        ))
-        
-        if balance is None:
-            return jsonify({
+        )
+
+        if entry is None:
+            return {
                 "success": False,
                 "message": "Failed to get wallet balance. Please check your wallet configuration."
-            }), 400
-        
-        return jsonify({
+            }, 400
+
+        return {
             "success": True,
             "message": "Wallet balance retrieved successfully",
             "data": {
-                "balance": balance,
-                "balance_formatted": f"{balance / 1e9:.9f} TON",
+                # In TON, as wallet.balance() has always returned; nanotons alongside
+                "balance": to_amount(entry["balance_nano"], precision=9),
+                "balance_nano": entry["balance_nano"],
+                "balance_formatted": f"{entry['balance_nano'] / 1e9:.9f} TON",
+                "cached_at": entry["cached_at"],
                 "retrieved_at": datetime.now().isoformat()
             }
-        })
-        
+        }, 200
+
+    except CircuitOpenError:
+        raise
     except Exception as e:
-        return jsonify({
+        return {
             "success": False,
             "message": f"Error getting wallet balance: {str(e)}"
-        }), 500
+        }, 500
+
+
+async def invalidate_subscription_cache(req):
+    """Invalidate cached subscriptions (called by the Node API on update/delete)"""
+    error = check_internal_token(req)
+    if error:
+        return error
 
+    data = req.json or {}
+    api_key = data.get("apiKey")
+    # Only the hash is shared with the other workers
+    removed = await invalidation.publish('subscription', {
+        "subscriptionId": data.get("subscriptionId"),
+        "apiKeyHash": wallet_api.hash_api_key(api_key) if api_key else None
+    })
+
+    return {
+        "success": True,
+        "message": "Subscription cache invalidated",
+        "data": {
+            "removed": removed
+        }
+    }, 200
+
+
+async def invalidate_user_context_cache(req):
+    """Invalidate cached wallet/fragment data (called by the Node API on wallet or cookie changes)"""
+    error = check_internal_token(req)
+    if error:
+        return error
+
+    data = req.json or {}
+    removed = await invalidation.publish('user_context', {"userId": data.get("userId")})
+
+    return {
+        "success": True,
+        "message": "User context cache invalidated",
+        "data": {
+            "removed": removed
+        }
+    }, 200
+
+
+async def get_wallet_pool_stats(req):
+    """Pre-generated wallet reserve metrics (internal)"""
+    error = check_internal_token(req)
+    if error:
+        return error
+
+    if not wallet_api.wallet_pool:
+        return {
+            "success": True,
+            "data": {
+                "enabled": False
+            }
+        }, 200
+
+    stats = await asyncio.to_thread(wallet_api.wallet_pool.stats)
+    return {
+        "success": True,
+        "data": {
+            "enabled": True,
+            **stats
+        }
+    }, 200
 
-@app.route('/', methods=['GET'])
-def root():
+
+async def get_wallet_queue_stats(req):
+    """Per-wallet send queue depth and seqno state (internal)"""
+    error = check_internal_token(req)
+    if error:
+        return error
+
+    return {
+        "success": True,
+        "data": {
+            "queues": ton_wallet.get_queue_stats()
+        }
+    }, 200
+
+
+async def get_singleflight_stats(req):
+    """Upstream calls made and saved by request coalescing (internal)"""
+    error = check_internal_token(req)
+    if error:
+        return error
+
+    return {
+        "success": True,
+        "data": {
+            "groups": get_singleflight_counters()
+        }
+    }, 200
+
+
+async def get_fragment_session_stats(req):
+    """Health, load and request budget of the Fragment sessions used by this process (internal)"""
+    error = check_internal_token(req)
+    if error:
+        return error
+
+    return {
+        "success": True,
+        "data": {
+            "sessions": wallet_api.stars_buy_service.sessions.get_stats(),
+            "rate_limits": fragment_api.get_limiter_stats()
+        }
+    }, 200
+
+
+async def get_circuit_stats(req):
+    """Circuit breaker state and latency of each upstream in this process (internal)"""
+    error = check_internal_token(req)
+    if error:
+        return error
+
+    return {
+        "success": True,
+        "data": {
+            "circuits": get_breaker_stats()
+        }
+    }, 200
+
+
+async def root(req):
     """Root endpoint with API information"""
-    return jsonify({
+    return {
         "success": True,
         "message": "Fragment Wallet & Stars API",
         "version": "1.0.0",
         "description": "Generate TON wallets and buy Telegram Stars with API key authentication",
         "endpoints": {
             "health": "GET /health",
+            "liveness": "GET /livez",
+            "readiness": "GET /readyz",
             "generate_wallet": "POST /generate-wallet",
+            "generate_wallets": "POST /generate-wallets",
             "wallet_info": "GET /wallet-info",
             "search_user": "POST /search-user",
+            "stars_price": "GET /stars-price",
             "buy_stars": "POST /buy-stars",
-            "wallet_balance": "GET /wallet-balance"
+            "buy_stars_batch": "POST /buy-stars/batch",
+            "buy_stars_job": "GET /buy-stars/jobs/<job_id>",
+            "buy_stars_batch_status": "GET /buy-stars/batches/<batch_id>",
+            "wallet_balance": "GET /wallet-balance",
+            "metrics": "GET /metrics"
         },
         "authentication": {
             "header": "X-API-Key",
             "description": "Include your API key in the X-API-Key header"
         }
-    })
+    }, 200
+
+
+# Route table shared by the Flask (WSGI) app below and the ASGI app in asgi.py
+ROUTES = [
+    ('/health', ['GET'], health_check),
+    ('/livez', ['GET'], liveness),
+    ('/readyz', ['GET'], readiness),
+    ('/generate-wallet', ['POST'], generate_wallet),
+    ('/generate-wallets', ['POST'], generate_wallets),
+    ('/wallet-info', ['GET'], get_wallet_info),
+    ('/search-user', ['POST'], search_user),
+    ('/stars-price', ['GET'], get_stars_price),
+    ('/buy-stars', ['POST'], buy_stars),
+    ('/buy-stars/batch', ['POST'], buy_stars_batch),
+    ('/buy-stars/jobs/<job_id>', ['GET'], get_purchase_job),
+    ('/buy-stars/batches/<batch_id>', ['GET'], get_purchase_batch),
+    ('/wallet-balance', ['GET'], get_wallet_balance),
+    ('/internal/subscriptions/invalidate', ['POST'], invalidate_subscription_cache),
+    ('/internal/user-context/invalidate', ['POST'], invalidate_user_context_cache),
+    ('/internal/wallet-pool', ['GET'], get_wallet_pool_stats),
+    ('/internal/wallet-queues', ['GET'], get_wallet_queue_stats),
+    ('/internal/singleflight', ['GET'], get_singleflight_stats),
+    ('/internal/fragment-sessions', ['GET'], get_fragment_session_stats),
+    ('/internal/circuits', ['GET'], get_circuit_stats),
+    ('/', ['GET'], root),
+]
+
+
+async def startup():
+    """Start this process's background work; run once per worker, after any fork"""
+    lifecycle.mark_started()
+    invalidation.start()
+    metrics.start_flushing()
+    # Resume purchases left queued, running or unconfirmed by a previous run
+    wallet_api.purchase_jobs.start()
+    if wallet_api.wallet_pool:
+        wallet_api.wallet_pool.start()
+
+
+async def shutdown(timeout=GRACEFUL_TIMEOUT):
+    """Drain this process: fail readiness, let running purchases be sent, close upstream clients"""
+    lifecycle.begin_drain()
+    await wallet_api.purchase_jobs.drain(timeout)
+    await invalidation.stop()
+    metrics.stop_flushing()
+    if wallet_api.wallet_pool:
+        wallet_api.wallet_pool.stop()
+    wallet_api.close_generator_executor()
+    await close_clients()
+
+
+async def handle(handler, req):
+    """Run a handler under the request's trace id and record its latency and status"""
+    request_id.set(req.request_id)
+    with metrics.REQUEST_DURATION.time(route=handler.__name__):
+        try:
+            body, status = await handler(req)
+        except CircuitOpenError as e:
+            body, status = upstream_unavailable(e)
+    metrics.REQUESTS.inc(route=handler.__name__, status=str(status))
+    return body, status
+
+
+def flask_view(handler):
+    """Wrap an async handler as a Flask view running on the shared event loop"""
+    def view(**params):
+        req = ApiRequest(
+            headers=request.headers,
+            json=request.get_json(silent=True),
+            args=request.args,
+            params=params,
+            request_id=new_request_id(request.headers.get(REQUEST_ID_HEADER))
+        )
+        body, status = loop.run(handle(handler, req))
+        return jsonify(body), status, {REQUEST_ID_HEADER: req.request_id}
+    view.__name__ = handler.__name__
+    view.__doc__ = handler.__doc__
+    return view
+
+
+for path, methods, handler in ROUTES:
+    app.add_url_rule(path, handler.__name__, flask_view(handler), methods=methods)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """Prometheus metrics, summed over the worker processes when METRICS_DIR is set"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 3003))
     print(f"🐍 Fragment Python API running on port {port}")
     print(f"🔗 API available at http://localhost:{port}")
-    app.run(host='0.0.0.0', port=port, debug=True) 
\ No newline at end of file
+    # The Werkzeug debugger runs arbitrary code for anyone who can reach it: opt in locally only
+    app.run(host='0.0.0.0', port=port, debug=os.environ.get("FLASK_DEBUG", "0") == "1")
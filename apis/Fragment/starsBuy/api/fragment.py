@@ -1,11 +1,149 @@
-import requests
+import asyncio
+import httpx
 import base64
 import logging
+import os
 import time
 import json
+import re
+from urllib.parse import urlencode
+from common.cache import TTLCache
+from common.http import get_client, is_cloudflare_challenge, no_cookie_jar
+from common.log import Lazy, lazy_json
+from common.metrics import FRAGMENT_RATE_WAIT, FRAGMENT_RETRIED, FRAGMENT_THROTTLED
+from common.ratelimit import AdaptiveRateLimiter, RateLimitedError, backoff_delay, parse_retry_after
+from common.singleflight import get_group
 
 logger = logging.getLogger('fragment.api')
 
+FRAGMENT_API_URL = os.environ.get('FRAGMENT_API_URL', 'https://fragment.com/api')
+
+# Connection pool and timeouts for the shared fragment.com client
+FRAGMENT_HTTP2 = os.environ.get('FRAGMENT_HTTP2', '1') == '1'
+FRAGMENT_MAX_CONNECTIONS = int(os.environ.get('FRAGMENT_MAX_CONNECTIONS', 100))
+FRAGMENT_MAX_KEEPALIVE = int(os.environ.get('FRAGMENT_MAX_KEEPALIVE', 20))
+FRAGMENT_KEEPALIVE_EXPIRY = float(os.environ.get('FRAGMENT_KEEPALIVE_EXPIRY', 60))
+FRAGMENT_CONNECT_TIMEOUT = float(os.environ.get('FRAGMENT_CONNECT_TIMEOUT', 5))
+FRAGMENT_READ_TIMEOUT = float(os.environ.get('FRAGMENT_READ_TIMEOUT', 30))
+FRAGMENT_POOL_TIMEOUT = float(os.environ.get('FRAGMENT_POOL_TIMEOUT', 10))
+
+# searchStarsRecipient results by normalized username ("not found" cached briefly)
+RECIPIENT_CACHE_TTL = float(os.environ.get('RECIPIENT_CACHE_TTL', 300))
+RECIPIENT_NEGATIVE_TTL = float(os.environ.get('RECIPIENT_NEGATIVE_TTL', 30))
+RECIPIENT_CACHE_SIZE = int(os.environ.get('RECIPIENT_CACHE_SIZE', 10000))
+
+# Request budget per session (fragmentHash), shared by all Fragment methods.
+# The rate adapts between the min and max from 429/5xx/challenge responses.
+FRAGMENT_RATE = float(os.environ.get('FRAGMENT_RATE', 5))
+FRAGMENT_BURST = float(os.environ.get('FRAGMENT_BURST', 10))
+FRAGMENT_MIN_RATE = float(os.environ.get('FRAGMENT_MIN_RATE', 0.5))
+FRAGMENT_MAX_RATE = float(os.environ.get('FRAGMENT_MAX_RATE', 20))
+FRAGMENT_RATE_INCREASE = float(os.environ.get('FRAGMENT_RATE_INCREASE', 0.1))
+FRAGMENT_RATE_DECREASE = float(os.environ.get('FRAGMENT_RATE_DECREASE', 0.5))
+# Longest pause a Retry-After can put on a session, and longest a call waits
+# for the session's budget before failing with RateLimitedError
+FRAGMENT_RETRY_AFTER_MAX = float(os.environ.get('FRAGMENT_RETRY_AFTER_MAX', 60))
+FRAGMENT_RATE_WAIT_MAX = float(os.environ.get('FRAGMENT_RATE_WAIT_MAX', 30))
+
+# Retries (jittered exponential backoff) for methods that are safe to repeat
+FRAGMENT_RETRIES = int(os.environ.get('FRAGMENT_RETRIES', 3))
+FRAGMENT_BACKOFF_BASE = float(os.environ.get('FRAGMENT_BACKOFF_BASE', 0.5))
+FRAGMENT_BACKOFF_MAX = float(os.environ.get('FRAGMENT_BACKOFF_MAX', 10))
+IDEMPOTENT_METHODS = {'searchStarsRecipient', 'updateStarsBuyState', 'updateStarsPrices'}
+
+# Prepared FragmentSession objects, one per session record
+FRAGMENT_SESSION_CACHE_SIZE = int(os.environ.get('FRAGMENT_SESSION_CACHE_SIZE', 10000))
+FRAGMENT_SESSION_CACHE_TTL = float(os.environ.get('FRAGMENT_SESSION_CACHE_TTL', 3600))
+# Session record fields a prepared session is built from
+SESSION_FIELDS = (
+    'fragmentHash', 'stelSsid', 'stelDt', 'stelTonToken', 'stelToken', 'cfClearance',
+    'fragmentAddress', 'fragmentWallets', 'fragmentPublicKey',
+)
+
+BASE_HEADERS = {
+    'accept': 'application/json, text/javascript, */*; q=0.01',
+    'accept-language': 'en-US,en;q=0.5',
+    'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
+    'origin': 'https://fragment.com',
+    'priority': 'u=1, i',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:141.0) Gecko/20100101 Firefox/141.0',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+    'x-requested-with': 'XMLHttpRequest',
+}
+
+DEVICE_JSON = json.dumps({
+    'platform': 'windows',
+    'appName': 'tonkeeper',
+    'appVersion': '4.1.2',
+    'maxProtocolVersion': 2,
+    'features': [
+        'SendTransaction',
+        {'name': 'SendTransaction', 'maxMessages': 4, 'extraCurrencySupported': True},
+        {'name': 'SignData', 'types': ['text', 'binary', 'cell']},
+    ],
+}, separators=(',', ':'))
+
+_recipients = TTLCache(maxsize=RECIPIENT_CACHE_SIZE, ttl=RECIPIENT_CACHE_TTL)
+_sessions = TTLCache(maxsize=FRAGMENT_SESSION_CACHE_SIZE, ttl=FRAGMENT_SESSION_CACHE_TTL)
+# Request budgets by session hash, bounded like the prepared sessions that use them
+_limiters = TTLCache(maxsize=FRAGMENT_SESSION_CACHE_SIZE, ttl=FRAGMENT_SESSION_CACHE_TTL)
+_NOT_FOUND_RE = re.compile(r'not found|no .*users? found', re.IGNORECASE)
+
+
+class ChallengeError(Exception):
+    """
+    Cloudflare answered with a challenge instead of Fragment
+    (the session's cf_clearance cookie is stale or rate limited)
+    """
+
+
+def get_limiter(HASH: str) -> AdaptiveRateLimiter:
+    """
+    Get the request budget of a Fragment session. Called whenever a prepared
+    session is built, which keeps the budget of a session in use across
+    rebuilds; one whose sessions are all gone expires with them.
+    """
+    limiter = _limiters.get(HASH)
+    if limiter is None:
+        limiter = AdaptiveRateLimiter(
+            FRAGMENT_RATE, FRAGMENT_BURST, FRAGMENT_MIN_RATE, FRAGMENT_MAX_RATE,
+            increase=FRAGMENT_RATE_INCREASE, decrease=FRAGMENT_RATE_DECREASE,
+            max_pause=FRAGMENT_RETRY_AFTER_MAX,
+        )
+    _limiters.set(HASH, limiter)
+    return limiter
+
+
+def get_limiter_stats() -> dict:
+    """
+    Current budget of each session, keyed by a short hash prefix
+    """
+    return {f'{HASH[:8]}…': limiter.get_stats() for HASH, limiter in _limiters.items()}
+
+
+def get_session() -> httpx.AsyncClient:
+    """
+    Get the shared keep-alive client for fragment.com.
+    Reused across requests and users; cookies are sent per request.
+    """
+    return get_client(
+        'fragment',
+        http2=FRAGMENT_HTTP2,
+        limits=httpx.Limits(
+            max_connections=FRAGMENT_MAX_CONNECTIONS,
+            max_keepalive_connections=FRAGMENT_MAX_KEEPALIVE,
+            keepalive_expiry=FRAGMENT_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            FRAGMENT_READ_TIMEOUT,
+            connect=FRAGMENT_CONNECT_TIMEOUT,
+            pool=FRAGMENT_POOL_TIMEOUT,
+        ),
+        cookies=no_cookie_jar(),
+    )
+
 
 async def encoded(encoded_string: str) -> str:
     """
@@ -30,141 +168,241 @@ async def encoded(encoded_string: str) -> str:
         return encoded_string
 
 
-def post(
-    COOKIES: str,
-    HASH: str,
-    data: dict,
-    referer: str
-    ) -> requests.Response:
+def normalize_username(username: str) -> str:
     """
-    Make POST request to Fragment API
+    Normalize a Telegram username for recipient cache keys
     """
-    params = {
-        'hash': HASH
-    }
+    return username.strip().lstrip('@').lower()
 
-    headers = {
-        'accept': 'application/json, text/javascript, */*; q=0.01',
-        'accept-language': 'en-US,en;q=0.5',
-        'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'origin': 'https://fragment.com',
-        'priority': 'u=1, i',
-        'referer': referer,
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:141.0) Gecko/20100101 Firefox/141.0',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'cookie': COOKIES,
-        'x-requested-with': 'XMLHttpRequest',
-    }
-    
-    t0 = time.time()
-    try:
-        logger.debug('POST https://fragment.com/api | params=%s referer=%s', params, referer)
-        logger.debug('Headers UA=%s | Cookie set=%s cf_clearance=%s', headers['user-agent'], bool(COOKIES), ('cf_clearance' in COOKIES))
-        logger.debug('Data=%s', data)
-        resp = requests.post('https://fragment.com/api', params=params, headers=headers, data=data)
-        dt = (time.time() - t0) * 1000
-        logger.debug('Response status=%s time_ms=%.1f', resp.status_code, dt)
-        logger.debug('Resp headers: content-type=%s cf-ray=%s', resp.headers.get('content-type'), resp.headers.get('cf-ray'))
-        try:
-            logger.debug('Resp json: %s', resp.json())
-        except Exception:
-            logger.debug('Resp text: %s', resp.text[:500])
-        return resp
-    except Exception as ex:
-        logger.exception('POST failed: %s', ex)
-        raise
-
-
-async def get_user_address(
-    COOKIES: str,
-    HASH: str,
-    username: str,
-    quantity: int
-    ) -> dict:
-    """
-    Search for user address by username
-    """
-    logger.debug('get_user_address username=%s quantity=%s', username, quantity)
-    data = {
-        'query': username,
-        'quantity': str(quantity),
-        'method': 'searchStarsRecipient',
-    }
-    referer = f'https://fragment.com/stars/buy?quantity={quantity}'
-    response = post(COOKIES, HASH, data, referer)
-    return response.json()
+
+def session_key(session: dict) -> str:
+    """
+    Stable id of a Fragment session record (never its cookies)
+    """
+    return str(session.get('id') or session.get('fragmentHash', ''))
 
 
-async def init_buy_stars(
-    COOKIES: str,
-    HASH: str,
-    recipient: str,
-    quantity: int
-    ) -> dict:
+class FragmentSession:
     """
-    Initialize buy stars request
+    One Fragment session (stel_* / cf_clearance cookies and hash) prepared
+    for repeated calls: the cookie string, request headers and the encoded
+    account/device form fields are built once, and the session's request
+    budget is attached. Get one per session record with from_data().
     """
-    logger.debug('init_buy_stars recipient=%s quantity=%s', recipient, quantity)
-    data = {
-        'recipient': recipient,
-        'quantity': str(quantity),
-        'method': 'initBuyStarsRequest',
-    }
-    referer = f'https://fragment.com/stars/buy?recipient={recipient}&quantity={quantity}'
-    response = post(COOKIES, HASH, data, referer)
-    return response.json()
-
-
-async def get_buy_stars(
-    COOKIES: str,
-    HASH: str,
-    req_id: str,
-    recipient: str,
-    quantity: int,
-    account_json: str,
-    device_json: str,
-    show_sender: int = 1,
-    ) -> dict:
-    """
-    Get buy stars link
-    """
-    logger.debug('get_buy_stars req_id=%s recipient=%s quantity=%s show_sender=%s', req_id, recipient, quantity, show_sender)
-    data = {
-        'transaction': '1',
-        'id': str(req_id),
-        'show_sender': str(show_sender),
-        'account': account_json,
-        'device': device_json,
-        'method': 'getBuyStarsLink',
-    }
-    referer = f'https://fragment.com/stars/buy?recipient={recipient}&quantity={quantity}'
-    response = post(COOKIES, HASH, data, referer)
-    return response.json()
-
-
-async def update_stars_buy_state(
-    COOKIES: str,
-    HASH: str,
-    mode: str,
-    lv: bool,
-    referer: str,
-    dh: str | None = None,
-    ) -> dict:
-    """
-    Update stars buy state
-    """
-    logger.debug('update_stars_buy_state mode=%s lv=%s dh_len=%s', mode, lv, (len(dh) if dh else 0))
-    data = {
-        'mode': mode,
-        'lv': '1' if lv else '0',
-        'method': 'updateStarsBuyState',
-    }
-    if dh:
-        data['dh'] = dh
-    response = post(COOKIES, HASH, data, referer)
-    return response.json()
+
+    __slots__ = ('key', 'hash', 'cookies', 'params', 'headers', 'link_form', 'limiter')
+
+    def __init__(
+        self,
+        HASH: str,
+        COOKIES: str,
+        account_json: str = '',
+        device_json: str | None = None,
+        key: str | None = None
+    ):
+        self.key = key or HASH
+        self.hash = HASH
+        self.cookies = COOKIES
+        self.params = {'hash': HASH}
+        self.headers = {**BASE_HEADERS, 'cookie': COOKIES}
+        # Constant part of every getBuyStarsLink body
+        self.link_form = urlencode({
+            'transaction': '1',
+            'account': account_json,
+            'device': DEVICE_JSON if device_json is None else device_json,
+        })
+        self.limiter = get_limiter(HASH)
+
+    @classmethod
+    def from_data(cls, fragment_data: dict) -> 'FragmentSession':
+        """
+        Prepared session for a Fragment session record from the backend,
+        cached until the record's cookies or wallet change
+        """
+        key = session_key(fragment_data)
+        fingerprint = tuple(fragment_data.get(field) for field in SESSION_FIELDS)
+        session = _sessions.get((key, fingerprint))
+        if session is None:
+            session = cls(
+                fragment_data.get('fragmentHash', ''),
+                build_cookies_from_data({
+                    'stel_ssid': fragment_data.get('stelSsid', ''),
+                    'stel_dt': fragment_data.get('stelDt', ''),
+                    'stel_ton_token': fragment_data.get('stelTonToken', ''),
+                    'stel_token': fragment_data.get('stelToken', ''),
+                    'cf_clearance': fragment_data.get('cfClearance', ''),
+                }),
+                account_json=build_account_json(fragment_data),
+                key=key,
+            )
+            _sessions.set((key, fingerprint), session)
+        return session
+
+    async def post(self, data: dict, referer: str, form: str = '') -> dict:
+        """
+        Make POST request to Fragment API and return the parsed JSON response
+        (parsed exactly once; raises ChallengeError on a Cloudflare challenge
+        and ValueError if the body is not JSON). `form` is an already
+        encoded body prefix sent ahead of `data`.
+
+        Calls wait for the session's request budget (RateLimitedError if that
+        takes over FRAGMENT_RATE_WAIT_MAX). Idempotent methods are retried
+        with jittered backoff on 429, 5xx and connection errors.
+        """
+        headers = {**self.headers, 'referer': referer}
+        body = {'content': f'{form}&{urlencode(data)}'} if form else {'data': data}
+        method = data.get('method')
+        limiter = self.limiter
+        attempts = FRAGMENT_RETRIES + 1 if method in IDEMPOTENT_METHODS else 1
+        for attempt in range(attempts):
+            FRAGMENT_RATE_WAIT.observe(await limiter.acquire(FRAGMENT_RATE_WAIT_MAX))
+            retry = attempt + 1 < attempts
+            t0 = time.perf_counter()
+            try:
+                resp = await get_session().post(FRAGMENT_API_URL, params=self.params, headers=headers, **body)
+            except httpx.TransportError as ex:
+                if not retry:
+                    logger.exception('POST failed method=%s: %s', method, ex)
+                    raise
+                delay = backoff_delay(attempt, FRAGMENT_BACKOFF_BASE, FRAGMENT_BACKOFF_MAX)
+                logger.warning('POST method=%s failed (%s), retry %s in %.2fs', method, ex, attempt + 1, delay)
+                FRAGMENT_RETRIED.inc(method=method)
+                await asyncio.sleep(delay)
+                continue
+            except Exception as ex:
+                logger.exception('POST failed method=%s: %s', method, ex)
+                raise
+
+            dt = (time.perf_counter() - t0) * 1000
+            if is_cloudflare_challenge(resp):
+                limiter.throttled(parse_retry_after(resp.headers.get('retry-after')))
+                FRAGMENT_THROTTLED.inc(reason='challenge')
+                logger.warning('POST method=%s challenged status=%s cf-ray=%s', method, resp.status_code, resp.headers.get('cf-ray'))
+                raise ChallengeError(f"Cloudflare challenge (status {resp.status_code})")
+
+            if resp.status_code != 429 and resp.status_code < 500:
+                limiter.success()
+                break
+
+            # The session is being throttled: slow it down (and pause it for Retry-After)
+            retry_after = parse_retry_after(resp.headers.get('retry-after'))
+            limiter.throttled(retry_after)
+            FRAGMENT_THROTTLED.inc(reason='429' if resp.status_code == 429 else '5xx')
+            if retry and (retry_after or 0) <= FRAGMENT_BACKOFF_MAX:
+                # The limiter already holds the next call back for Retry-After
+                delay = backoff_delay(attempt, FRAGMENT_BACKOFF_BASE, FRAGMENT_BACKOFF_MAX)
+                logger.warning('POST method=%s status=%s, retry %s in %.2fs', method, resp.status_code, attempt + 1, delay)
+                FRAGMENT_RETRIED.inc(method=method)
+                await asyncio.sleep(delay)
+                continue
+            if resp.status_code == 429:
+                logger.warning('POST method=%s rate limited, retry_after=%s', method, retry_after)
+                raise RateLimitedError(f"Fragment rate limit (retry after {retry_after}s)" if retry_after else "Fragment rate limit")
+            break
+
+        try:
+            result = resp.json()
+        except ValueError:
+            logger.warning(
+                'POST method=%s status=%s time_ms=%.1f cf-ray=%s returned non-JSON: %s',
+                method, resp.status_code, dt, resp.headers.get('cf-ray'), Lazy(lambda: resp.text[:500]),
+            )
+            raise
+
+        # Payloads are serialized (and redacted) only if debug logging is on
+        logger.debug(
+            'POST session=%s method=%s status=%s time_ms=%.1f cf-ray=%s cf_clearance=%s data=%s response=%s',
+            self.key, method, resp.status_code, dt, resp.headers.get('cf-ray'), 'cf_clearance' in self.cookies,
+            lazy_json(data), lazy_json(result),
+        )
+        return result
+
+    async def search_recipient(self, username: str, quantity: int, use_cache: bool = True) -> dict:
+        """
+        searchStarsRecipient: find a user's stars recipient address.
+        Results are cached per username; quantity only affects display upstream.
+        """
+        key = normalize_username(username)
+        if use_cache:
+            cached = _recipients.get(key)
+            if cached is not None:
+                logger.debug('search_recipient cache hit username=%s', key)
+                return cached
+
+        # Concurrent searches for the same username on this session share one upstream
+        # call; a failure (expired cookies, throttling) is never handed to another tenant
+        return await get_group('recipients').do(
+            (self.key, key), lambda: self._search_recipient(key, username, quantity)
+        )
+
+    async def _search_recipient(self, key: str, username: str, quantity: int) -> dict:
+        logger.debug('search_recipient username=%s quantity=%s', username, quantity)
+        data = {
+            'query': username,
+            'quantity': str(quantity),
+            'method': 'searchStarsRecipient',
+        }
+        referer = f'https://fragment.com/stars/buy?quantity={quantity}'
+        result = await self.post(data, referer)
+
+        if result.get('found'):
+            _recipients.set(key, result)
+        elif _NOT_FOUND_RE.search(str(result.get('error', ''))):
+            _recipients.set(key, result, ttl=RECIPIENT_NEGATIVE_TTL)
+        return result
+
+    async def update_buy_state(self, mode: str, lv: bool, referer: str, dh: str | None = None) -> dict:
+        """
+        updateStarsBuyState
+        """
+        logger.debug('update_buy_state mode=%s lv=%s dh_len=%s', mode, lv, (len(dh) if dh else 0))
+        data = {
+            'mode': mode,
+            'lv': '1' if lv else '0',
+            'method': 'updateStarsBuyState',
+        }
+        if dh:
+            data['dh'] = dh
+        return await self.post(data, referer)
+
+    async def update_prices(self, quantity: int) -> dict:
+        """
+        updateStarsPrices: the current TON price of `quantity` stars (cur_price)
+        """
+        logger.debug('update_prices quantity=%s', quantity)
+        data = {
+            'stars': '',
+            'quantity': str(quantity),
+            'method': 'updateStarsPrices',
+        }
+        referer = f'https://fragment.com/stars/buy?quantity={quantity}'
+        return await self.post(data, referer)
+
+    async def init_buy(self, recipient: str, quantity: int) -> dict:
+        """
+        initBuyStarsRequest: reserve a req_id for the purchase
+        """
+        logger.debug('init_buy recipient=%s quantity=%s', recipient, quantity)
+        data = {
+            'recipient': recipient,
+            'quantity': str(quantity),
+            'method': 'initBuyStarsRequest',
+        }
+        referer = f'https://fragment.com/stars/buy?recipient={recipient}&quantity={quantity}'
+        return await self.post(data, referer)
+
+    async def get_buy_link(self, req_id: str, recipient: str, quantity: int, show_sender: int = 1) -> dict:
+        """
+        getBuyStarsLink: the TON transaction paying for req_id
+        """
+        logger.debug('get_buy_link req_id=%s recipient=%s quantity=%s show_sender=%s', req_id, recipient, quantity, show_sender)
+        data = {
+            'id': str(req_id),
+            'show_sender': str(show_sender),
+            'method': 'getBuyStarsLink',
+        }
+        referer = f'https://fragment.com/stars/buy?recipient={recipient}&quantity={quantity}'
+        return await self.post(data, referer, form=self.link_form)
 
 
 def build_cookies_from_data(data: dict) -> str:
@@ -199,17 +437,6 @@ def build_account_json(fragment_data: dict) -> str:
 
 def build_device_json() -> str:
     """
-    Build device JSON string for Fragment API
-    """
-    device_json = {
-        'platform': 'windows',
-        'appName': 'tonkeeper',
-        'appVersion': '4.1.2',
-        'maxProtocolVersion': 2,
-        'features': [
-            'SendTransaction',
-            {'name': 'SendTransaction', 'maxMessages': 4, 'extraCurrencySupported': True},
-            {'name': 'SignData', 'types': ['text', 'binary', 'cell']},
-        ],
-    }
-    return json.dumps(device_json, separators=(',', ':'))
+    Device JSON string for Fragment API (constant, serialized once)
+    """
+    return DEVICE_JSON
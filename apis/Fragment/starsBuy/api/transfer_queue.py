@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+from common.ratelimit import backoff_delay
+
+from tonutils.account import AccountStatus
+from tonutils.utils import to_amount
+from tonutils.wallet import WalletV4R2
+from tonutils.wallet.data import TransferData
+
+logger = logging.getLogger('wallet.transfer_queue')
+
+# v4r2 wallets accept at most four internal messages per external message
+MAX_MESSAGES = 4
+# Optional wait (seconds) for more transfers to join a batch before sending
+TRANSFER_BATCH_LINGER = float(os.environ.get('TRANSFER_BATCH_LINGER', 0))
+# How often / how long to wait for a sent seqno to land on-chain
+SEQNO_POLL_INTERVAL = float(os.environ.get('SEQNO_POLL_INTERVAL', 1.5))
+SEQNO_CONFIRM_TIMEOUT = float(os.environ.get('SEQNO_CONFIRM_TIMEOUT', 60))
+# Attempts to read the seqno before a send; the batch stays queued meanwhile
+SEQNO_READ_RETRIES = int(os.environ.get('SEQNO_READ_RETRIES', 5))
+SEQNO_READ_BACKOFF_BASE = float(os.environ.get('SEQNO_READ_BACKOFF_BASE', 0.5))
+SEQNO_READ_BACKOFF_MAX = float(os.environ.get('SEQNO_READ_BACKOFF_MAX', 10))
+# Accounts without deployed code, whose next seqno is 0
+UNDEPLOYED = {AccountStatus.uninit, AccountStatus.nonexist}
+
+
+@dataclass
+class PendingTransfer:
+    address: str
+    amount: int
+    payload: Any
+    future: asyncio.Future
+
+
+class WalletTransferQueue:
+    """
+    Per-wallet, seqno-aware send queue.
+
+    Transfers submitted while a send is in flight are packed, up to four at
+    a time, into one external message with a single seqno. The seqno is
+    fetched once and then tracked locally. A v4r2 wallet only accepts the
+    next seqno after the previous message lands on-chain, so the worker
+    waits for inclusion before the next send. Callers are released as soon
+    as their message is sent.
+
+    `on_included` is called each time a sent batch lands on-chain.
+    """
+
+    def __init__(self, wallet: WalletV4R2, on_included: Optional[Callable[[], None]] = None):
+        self.wallet = wallet
+        self.on_included = on_included
+        self.seqno: Optional[int] = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight = 0
+        self._awaiting_seqno: Optional[int] = None
+        self.last_used = time.monotonic()
+
+        self.sent_batches = 0
+        self.sent_messages = 0
+        self.confirmed = 0
+        self.unconfirmed = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        """
+        Transfers queued or being sent
+        """
+        return self._queue.qsize() + self._in_flight
+
+    @property
+    def idle(self) -> bool:
+        """
+        Nothing queued, being sent or awaiting inclusion
+        """
+        return self.depth == 0 and self._awaiting_seqno is None and (self._worker is None or self._worker.done())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "address": self.wallet.address.to_str(),
+            "depth": self.depth,
+            "seqno": self.seqno,
+            "awaiting_seqno": self._awaiting_seqno,
+            "sent_batches": self.sent_batches,
+            "sent_messages": self.sent_messages,
+            "confirmed": self.confirmed,
+            "unconfirmed": self.unconfirmed,
+            "failed": self.failed,
+        }
+
+    async def submit(self, address: str, amount: int, payload: Any) -> Dict[str, Any]:
+        """
+        Queue a transfer (amount in nanotons) and wait until the batch that
+        carries it is sent. Returns the message hash, seqno and batch slot.
+        """
+        self.last_used = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(PendingTransfer(address, amount, payload, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self) -> None:
+        while not self._queue.empty():
+            batch = [self._queue.get_nowait()]
+            self._in_flight = 1
+            if TRANSFER_BATCH_LINGER:
+                await asyncio.sleep(TRANSFER_BATCH_LINGER)
+            while len(batch) < MAX_MESSAGES and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._in_flight = len(batch)
+            try:
+                sent = await self._send(batch)
+            except Exception as e:
+                # The seqno could not be read: nothing was sent
+                logger.error('seqno unavailable, %s transfer(s) not sent: %s', len(batch), e)
+                self.failed += len(batch)
+                for transfer in batch:
+                    if not transfer.future.done():
+                        transfer.future.set_exception(e)
+                sent = False
+            finally:
+                self._in_flight = 0
+            if sent:
+                await self._wait_for_inclusion()
+
+    async def _fetch_seqno(self) -> int:
+        try:
+            return await self.wallet.get_seqno(self.wallet.client, self.wallet.address)
+        except Exception:
+            # Undeployed wallets have no seqno get-method yet. Anything else
+            # (timeouts, an open circuit) must not be mistaken for seqno 0.
+            account = await self.wallet.client.get_raw_account(self.wallet.address.to_str())
+            if account.status in UNDEPLOYED:
+                return 0
+            raise
+
+    async def _read_seqno(self) -> int:
+        """
+        Fetch the seqno, retrying with backoff while the batch waits
+        """
+        for attempt in range(SEQNO_READ_RETRIES):
+            try:
+                return await self._fetch_seqno()
+            except Exception as e:
+                if attempt + 1 == SEQNO_READ_RETRIES:
+                    raise
+                delay = backoff_delay(attempt, SEQNO_READ_BACKOFF_BASE, SEQNO_READ_BACKOFF_MAX)
+                logger.warning('seqno read failed (%s), retry %s in %.2fs', e, attempt + 1, delay)
+                await asyncio.sleep(delay)
+
+    async def _send(self, batch: list) -> bool:
+        if self.seqno is None:
+            self.seqno = await self._read_seqno()
+        try:
+            seqno = self.seqno
+            logger.debug('sending batch of %s transfer(s) seqno=%s', len(batch), seqno)
+            tx_hash = await self.wallet.batch_transfer([
+                TransferData(
+                    destination=transfer.address,
+                    amount=to_amount(transfer.amount, 9, 9),
+                    body=transfer.payload,
+                )
+                for transfer in batch
+            ], seqno=seqno)
+        except Exception as e:
+            # Local seqno may be stale; re-read it before the next send
+            self.seqno = None
+            self.failed += len(batch)
+            for transfer in batch:
+                if not transfer.future.done():
+                    transfer.future.set_exception(e)
+            return False
+
+        self.seqno = seqno + 1
+        self._awaiting_seqno = self.seqno
+        self.sent_batches += 1
+        self.sent_messages += len(batch)
+        for index, transfer in enumerate(batch):
+            if not transfer.future.done():
+                transfer.future.set_result({
+                    "tx_hash": tx_hash,
+                    "seqno": seqno,
+                    "batch_index": index,
+                    "batch_size": len(batch),
+                })
+        return True
+
+    async def _wait_for_inclusion(self) -> None:
+        """
+        Wait until the on-chain seqno reaches the locally tracked one
+        """
+        expected = self._awaiting_seqno
+        deadline = time.monotonic() + SEQNO_CONFIRM_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SEQNO_POLL_INTERVAL)
+            try:
+                seqno = await self._fetch_seqno()
+            except Exception as e:
+                logger.debug('seqno poll failed: %s', e)
+                continue
+            if seqno >= expected:
+                self.confirmed += 1
+                self._awaiting_seqno = None
+                if self.on_included:
+                    self.on_included()
+                return
+
+        logger.warning('seqno %s not confirmed within %ss; re-reading wallet state', expected - 1, SEQNO_CONFIRM_TIMEOUT)
+        self.unconfirmed += 1
+        self._awaiting_seqno = None
+        self.seqno = None
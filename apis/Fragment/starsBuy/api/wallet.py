@@ -1,10 +1,150 @@
 from tonutils.client import TonapiClient
 from tonutils.utils import to_amount
 from tonutils.wallet import WalletV4R2
+import aiohttp
+import asyncio
+import hashlib
 import logging
+import os
+import time
+from datetime import datetime
+from typing import Optional
+from common.cache import TTLCache
+from common.http import get_client as get_http_client
+from common.resilience import get_breaker, hedged
+from common.singleflight import get_group
+from api.transfer_queue import WalletTransferQueue
 
 logger = logging.getLogger('wallet.api')
 
+# Derived wallets (and the keys they hold) live in memory for at most
+# WALLET_CACHE_TTL seconds; TonAPI clients are shared per API key
+WALLET_CACHE_SIZE = int(os.environ.get('WALLET_CACHE_SIZE', 256))
+WALLET_CACHE_TTL = float(os.environ.get('WALLET_CACHE_TTL', 600))
+TONAPI_CLIENT_CACHE_SIZE = int(os.environ.get('TONAPI_CLIENT_CACHE_SIZE', 64))
+TONAPI_BASE_URL = os.environ.get('TONAPI_BASE_URL', 'https://tonapi.io/v2')
+TRANSFER_QUEUE_IDLE_TTL = float(os.environ.get('TRANSFER_QUEUE_IDLE_TTL', 600))
+# Balances are cached per wallet for a few seconds and dropped when we send
+# from the wallet. With BALANCE_REFRESH_INTERVAL > 0, wallets whose balance
+# was read in the last BALANCE_WATCH_TTL seconds are refreshed in bulk.
+BALANCE_CACHE_TTL = float(os.environ.get('BALANCE_CACHE_TTL', 10))
+BALANCE_CACHE_SIZE = int(os.environ.get('BALANCE_CACHE_SIZE', 10000))
+BALANCE_REFRESH_INTERVAL = float(os.environ.get('BALANCE_REFRESH_INTERVAL', 0))
+BALANCE_WATCH_TTL = float(os.environ.get('BALANCE_WATCH_TTL', 120))
+# TonAPI accepts up to 100 accounts per bulk request
+BALANCE_BULK_SIZE = 100
+
+_clients = TTLCache(maxsize=TONAPI_CLIENT_CACHE_SIZE, ttl=float('inf'))
+_wallets = TTLCache(maxsize=WALLET_CACHE_SIZE, ttl=WALLET_CACHE_TTL)
+# One send queue per wallet (keyed by mnemonic) so transfers never race for a seqno.
+# A queue holds the wallet's keys, so it is dropped once idle for TRANSFER_QUEUE_IDLE_TTL.
+_queues: dict[str, WalletTransferQueue] = {}
+_queues_swept = 0.0
+# Balance entries keyed by raw wallet address
+_balances = TTLCache(maxsize=BALANCE_CACHE_SIZE, ttl=BALANCE_CACHE_TTL)
+_watched = TTLCache(maxsize=BALANCE_CACHE_SIZE, ttl=BALANCE_WATCH_TTL)
+_refresh_task = None
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256('\x00'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_client(API_KEY: str) -> TonapiClient:
+    """
+    Get the shared TonAPI client for an API key
+    """
+    key = _digest(API_KEY)
+    client = _clients.get(key)
+    if client is None:
+        # TonapiClient appends the /v2 API version itself
+        client = TonapiClient(api_key=API_KEY, is_testnet=False, base_url=TONAPI_BASE_URL.removesuffix('/v2'))
+        _clients.set(key, client)
+    return client
+
+
+async def get_wallet(
+    API_KEY: str,
+    MNEMONIC: list
+    ) -> WalletV4R2:
+    """
+    Get a derived wallet, deriving it from the mnemonic only on a cache miss
+    """
+    key = _digest(API_KEY, *MNEMONIC)
+    wallet = _wallets.get(key)
+    if wallet is None:
+        # Key derivation (PBKDF2) is CPU-bound; keep it off the event loop
+        wallet, public_key, private_key, mnemonic = await asyncio.to_thread(
+            WalletV4R2.from_mnemonic, get_client(API_KEY), MNEMONIC
+        )
+        _wallets.set(key, wallet)
+    return wallet
+
+
+def evict_wallet(
+    API_KEY: str,
+    MNEMONIC: list
+    ) -> None:
+    """
+    Drop a derived wallet from the cache
+    """
+    _wallets.pop(_digest(API_KEY, *MNEMONIC))
+
+
+async def get_transfer_queue(
+    API_KEY: str,
+    MNEMONIC: list
+    ) -> WalletTransferQueue:
+    """
+    Get the send queue for a wallet
+    """
+    _evict_idle_queues()
+    key = _digest(*MNEMONIC)
+    queue = _queues.get(key)
+    if queue is None:
+        wallet = await get_wallet(API_KEY, MNEMONIC)
+        address = _raw_address(wallet)
+        queue = _queues.setdefault(key, WalletTransferQueue(wallet, on_included=lambda: invalidate_balance(address)))
+    return queue
+
+
+def _evict_idle_queues() -> None:
+    global _queues_swept
+    now = time.monotonic()
+    if now - _queues_swept < min(60.0, TRANSFER_QUEUE_IDLE_TTL):
+        return
+    _queues_swept = now
+    for key, queue in list(_queues.items()):
+        if queue.idle and now - queue.last_used > TRANSFER_QUEUE_IDLE_TTL:
+            # The seqno is read again if the wallet sends later
+            del _queues[key]
+
+
+def get_queue_stats() -> list:
+    """
+    Depth and seqno state of every wallet send queue
+    """
+    return [queue.stats() for queue in _queues.values()]
+
+
+async def submit_transfer(
+    API_KEY: str,
+    MNEMONIC: list,
+    address: str,
+    amount: int,
+    payload: str
+    ) -> dict:
+    """
+    Send TON transfer through the wallet's send queue.
+    Returns tx_hash, seqno, batch slot and the sending wallet address.
+    """
+    queue = await get_transfer_queue(API_KEY, MNEMONIC)
+    try:
+        result = await queue.submit(address, amount, payload)
+    finally:
+        invalidate_balance(_raw_address(queue.wallet))
+    return {**result, "wallet_address": queue.wallet.address.to_str()}
+
 
 async def send_transfer(
     API_KEY: str,
@@ -14,41 +154,167 @@ async def send_transfer(
     payload: str
     ) -> str:
     """
-    Send TON transfer using wallet
+    Send TON transfer using wallet.
+    Concurrent transfers from the same wallet share one external message.
     """
     try:
         logger.debug('send_transfer address=%s amount=%s', address, amount)
-        client = TonapiClient(api_key=API_KEY, is_testnet=False)
-        wallet, public_key, private_key, mnemonic = WalletV4R2.from_mnemonic(client, MNEMONIC)
-        
-        tx_hash = await wallet.transfer(
-            destination=address,
-            amount=to_amount(amount, 9, 9),
-            body=payload,
-        )
+        result = await submit_transfer(API_KEY, MNEMONIC, address, amount, payload)
+        tx_hash = result["tx_hash"]
 
-        logger.debug('send_transfer success tx_hash=%s', tx_hash)
+        logger.debug('send_transfer success tx_hash=%s batch=%s/%s', tx_hash, result["batch_index"] + 1, result["batch_size"])
         return tx_hash
     except Exception as e:
         logger.exception('send_transfer error: %s', e)
         raise
 
 
+def _raw_address(wallet: WalletV4R2) -> str:
+    return wallet.address.to_str(is_user_friendly=False)
+
+
+def invalidate_balance(address: str) -> None:
+    """
+    Drop the cached balance of a wallet (raw address)
+    """
+    _balances.pop(address)
+
+
+def _tonapi_failure(error: Exception) -> bool:
+    # A 4xx is about the request (bad key, unknown account), not TonAPI's health
+    return not (isinstance(error, aiohttp.ClientResponseError) and error.status < 500)
+
+
+async def _fetch_balance(wallet: WalletV4R2, address: str) -> dict:
+    # tonutils calls TonAPI with its own session, so it goes through the breaker here.
+    # Cached in nanotons, like the bulk refresh; wallet.balance() would convert to TON.
+    balance_nano = await hedged('tonapi', lambda: get_breaker('tonapi').call(
+        lambda: wallet.client.get_account_balance(address), _tonapi_failure
+    ))
+    entry = {"balance_nano": balance_nano, "cached_at": datetime.now().isoformat()}
+    _balances.set(address, entry)
+    return entry
+
+
+async def get_balance_entry(
+    API_KEY: str,
+    MNEMONIC: list
+    ) -> dict:
+    """
+    Get wallet balance in nanotons with the time it was fetched ({balance_nano, cached_at}).
+    Served from cache when fresh; concurrent misses share one TonAPI call.
+    """
+    wallet = await get_wallet(API_KEY, MNEMONIC)
+    address = _raw_address(wallet)
+    if BALANCE_REFRESH_INTERVAL > 0:
+        _watch(API_KEY, address)
+
+    entry = _balances.get(address)
+    if entry is not None:
+        return entry
+
+    return await get_group('balances').do(address, lambda: _fetch_balance(wallet, address))
+
+
+def get_cached_balance_entry(
+    API_KEY: str,
+    MNEMONIC: list
+    ) -> Optional[dict]:
+    """
+    Cached balance entry ({balance_nano, cached_at}) of an already derived wallet,
+    or None; never derives the wallet or calls TonAPI
+    """
+    wallet = _wallets.get(_digest(API_KEY, *MNEMONIC))
+    if wallet is None:
+        return None
+    return _balances.get(_raw_address(wallet))
+
+
 async def get_balance(
     API_KEY: str,
     MNEMONIC: list
-    ) -> int:
+    ) -> float:
     """
-    Get wallet balance
+    Get wallet balance in TON
     """
     try:
         logger.debug('get_balance')
-        client = TonapiClient(api_key=API_KEY, is_testnet=False)
-        wallet, public_key, private_key, mnemonic = WalletV4R2.from_mnemonic(client, MNEMONIC)
-        
-        balance = await wallet.balance()
-        logger.debug('get_balance result=%s', balance)
-        return balance
+        entry = await get_balance_entry(API_KEY, MNEMONIC)
+        logger.debug('get_balance result=%s nanotons cached_at=%s', entry["balance_nano"], entry["cached_at"])
+        return to_amount(entry["balance_nano"], precision=9)
     except Exception as e:
         logger.exception('get_balance error: %s', e)
         raise
+
+
+async def refresh_balances(
+    API_KEY: str,
+    addresses: list
+    ) -> dict:
+    """
+    Fetch balances of many wallets with TonAPI bulk requests and cache them.
+    Returns {raw_address: balance in nanotons}.
+    """
+    client = get_http_client('tonapi', timeout=10)
+    balances = {}
+    for i in range(0, len(addresses), BALANCE_BULK_SIZE):
+        response = await client.post(
+            f'{TONAPI_BASE_URL}/accounts/_bulk',
+            json={'account_ids': addresses[i:i + BALANCE_BULK_SIZE]},
+            headers={'Authorization': f'Bearer {API_KEY}'},
+        )
+        response.raise_for_status()
+        cached_at = datetime.now().isoformat()
+        for account in response.json().get('accounts', []):
+            balance_nano = int(account['balance'])
+            balances[account['address']] = balance_nano
+            _balances.set(account['address'], {"balance_nano": balance_nano, "cached_at": cached_at})
+    return balances
+
+
+def _watch(API_KEY: str, address: str) -> None:
+    global _refresh_task
+    _watched.set(address, API_KEY)
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.ensure_future(_refresh_loop())
+
+
+async def _refresh_loop() -> None:
+    """
+    Keep recently read balances warm until nobody has asked for them in BALANCE_WATCH_TTL
+    """
+    while True:
+        await asyncio.sleep(BALANCE_REFRESH_INTERVAL)
+        by_key: dict[str, list] = {}
+        for address, api_key in _watched.items():
+            by_key.setdefault(api_key, []).append(address)
+        if not by_key:
+            return
+        t0 = time.monotonic()
+        results = await asyncio.gather(
+            *(refresh_balances(api_key, addresses) for api_key, addresses in by_key.items()),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning('balance refresh failed: %s', result)
+        logger.debug('refreshed %s wallet balance(s) in %.2fs', sum(map(len, by_key.values())), time.monotonic() - t0)
+
+
+async def get_transactions(
+    API_KEY: str,
+    address: str,
+    limit: int = 50
+    ) -> list:
+    """
+    Get the latest transactions of a wallet from TonAPI (newest first)
+    """
+    logger.debug('get_transactions address=%s limit=%s', address, limit)
+    client = get_http_client('tonapi', timeout=10)
+    response = await hedged('tonapi', lambda: client.get(
+        f'{TONAPI_BASE_URL}/blockchain/accounts/{address}/transactions',
+        params={'limit': limit},
+        headers={'Authorization': f'Bearer {API_KEY}'},
+    ))
+    response.raise_for_status()
+    return response.json().get('transactions', [])
@@ -0,0 +1,777 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from pytoniq_core import Address
+
+from api import fragment, wallet
+from common.http import UnsafeURLError, get_client, request_public_url
+from common.tracing import request_id
+
+logger = logging.getLogger('purchase_jobs')
+
+CONFIRMATION_POLL_INTERVAL = float(os.environ.get('CONFIRMATION_POLL_INTERVAL', 5))
+CONFIRMATION_TIMEOUT = float(os.environ.get('CONFIRMATION_TIMEOUT', 300))
+JOB_RETENTION = float(os.environ.get('JOB_RETENTION', 86400))
+WEBHOOK_RETRIES = int(os.environ.get('WEBHOOK_RETRIES', 3))
+# Webhooks are sent to a pinned address with the callback host as SNI, so
+# connections are not kept for reuse by requests to other hosts
+WEBHOOK_LIMITS = httpx.Limits(max_keepalive_connections=0)
+# Durable job queue: SQLite file shared by every worker process
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'purchase_jobs.db'))
+PURCHASE_WORKERS = int(os.environ.get('PURCHASE_WORKERS', 8))
+# A running job whose lease lapses (its process died) is picked up again
+JOB_LEASE = float(os.environ.get('JOB_LEASE', 300))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+# A wallet's seqno is tracked per process, so while one process has a job
+# running, or sent and not yet on-chain (this long), no other process
+# claims jobs for the same user
+JOB_WALLET_AFFINITY = float(os.environ.get('JOB_WALLET_AFFINITY', 90))
+# Jobs of one user run at most this many at a time per Fragment session the
+# user has, so a large batch from one tenant leaves workers for the others
+# (0 = no limit)
+BATCH_SESSION_CONCURRENCY = int(os.environ.get('BATCH_SESSION_CONCURRENCY', 2))
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+SENT = 'sent'
+CONFIRMED = 'confirmed'
+FAILED = 'failed'
+UNCONFIRMED = 'unconfirmed'
+FINAL_STATES = {CONFIRMED, FAILED, UNCONFIRMED}
+
+
+def _now() -> str:
+    return datetime.now().isoformat()
+
+
+def _owner() -> str:
+    # Computed per call: the pid changes after a fork
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+@dataclass
+class PurchaseJob:
+    job_id: str
+    user_id: int
+    username: str
+    quantity: int
+    callback_url: Optional[str] = None
+    idempotency_key: Optional[str] = None
+    # Id of the API request that queued the job, carried into its spans
+    request_id: Optional[str] = None
+    # Set for jobs queued by POST /buy-stars/batch
+    batch_id: Optional[str] = None
+    state: str = QUEUED
+    tx_hash: Optional[str] = None
+    transaction_hash: Optional[str] = None
+    error: Optional[str] = None
+    created_at: str = field(default_factory=_now)
+    updated_at: str = field(default_factory=_now)
+    sent_at: Optional[float] = None
+    # Progress through the Fragment steps (recipient, req_id, transaction)
+    checkpoint: Dict[str, Any] = field(default_factory=dict, repr=False)
+    # Transfer details used for matching; holds the TonAPI key in memory only
+    receipt: Dict[str, Any] = field(default_factory=dict, repr=False)
+
+    def set_state(self, state: str, error: Optional[str] = None) -> None:
+        self.state = state
+        self.error = error
+        self.updated_at = _now()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "state": self.state,
+            "step": self.checkpoint.get("step"),
+            "username": self.username,
+            "quantity": self.quantity,
+            "tx_hash": self.tx_hash,
+            "transaction_hash": self.transaction_hash,
+            "wallet_address": self.receipt.get("wallet_address"),
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class PurchaseJobStore:
+    """
+    SQLite-backed job table.
+
+    Jobs survive restarts and are shared by every worker process. Workers
+    claim queued jobs under a lease; an idempotency key is unique per user.
+    """
+
+    COLUMNS = (
+        'job_id', 'user_id', 'username', 'quantity', 'callback_url', 'idempotency_key', 'request_id', 'state',
+        'tx_hash', 'transaction_hash', 'error', 'created_at', 'updated_at', 'sent_at',
+        'checkpoint', 'receipt', 'batch_id',
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS purchase_jobs ("
+                "job_id TEXT PRIMARY KEY, "
+                "user_id TEXT NOT NULL, "
+                "username TEXT NOT NULL, "
+                "quantity INTEGER NOT NULL, "
+                "callback_url TEXT, "
+                "idempotency_key TEXT, "
+                "request_id TEXT, "
+                "state TEXT NOT NULL, "
+                "tx_hash TEXT, "
+                "transaction_hash TEXT, "
+                "error TEXT, "
+                "created_at TEXT NOT NULL, "
+                "updated_at TEXT NOT NULL, "
+                "sent_at REAL, "
+                "checkpoint TEXT NOT NULL DEFAULT '{}', "
+                "receipt TEXT NOT NULL DEFAULT '{}', "
+                "lease_until REAL, "
+                "owner TEXT, "
+                "batch_id TEXT, "
+                "UNIQUE (user_id, idempotency_key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS purchase_jobs_state ON purchase_jobs (state, created_at)")
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(purchase_jobs)")}
+            if 'request_id' not in columns:
+                conn.execute("ALTER TABLE purchase_jobs ADD COLUMN request_id TEXT")
+            if 'owner' not in columns:
+                conn.execute("ALTER TABLE purchase_jobs ADD COLUMN owner TEXT")
+            if 'batch_id' not in columns:
+                conn.execute("ALTER TABLE purchase_jobs ADD COLUMN batch_id TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS purchase_jobs_batch ON purchase_jobs (batch_id)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _values(self, job: PurchaseJob) -> tuple:
+        # The TonAPI key is looked up again when needed, never written to disk
+        receipt = {k: v for k, v in job.receipt.items() if k != 'ton_api_key'}
+        return (
+            job.job_id, str(job.user_id), job.username, job.quantity, job.callback_url, job.idempotency_key,
+            job.request_id, job.state, job.tx_hash, job.transaction_hash, job.error, job.created_at, job.updated_at,
+            job.sent_at, json.dumps(job.checkpoint), json.dumps(receipt), job.batch_id,
+        )
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> PurchaseJob:
+        values = dict(row)
+        values.pop('lease_until', None)
+        values.pop('owner', None)
+        values['checkpoint'] = json.loads(values['checkpoint'])
+        values['receipt'] = json.loads(values['receipt'])
+        return PurchaseJob(**values)
+
+    def insert(self, job: PurchaseJob) -> tuple:
+        """
+        Store a new job. If the user already has a job under the same
+        idempotency key, return that one instead. Returns (job, created).
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"INSERT OR IGNORE INTO purchase_jobs ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                self._values(job)
+            )
+            if cursor.rowcount:
+                return job, True
+            row = conn.execute(
+                "SELECT * FROM purchase_jobs WHERE user_id = ? AND idempotency_key = ?",
+                (str(job.user_id), job.idempotency_key)
+            ).fetchone()
+        return self._job(row), False
+
+    def find(self, user_id: Any, idempotency_key: str) -> Optional[PurchaseJob]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM purchase_jobs WHERE user_id = ? AND idempotency_key = ?",
+                (str(user_id), idempotency_key)
+            ).fetchone()
+        return self._job(row) if row else None
+
+    def ping(self) -> None:
+        with self._connect() as conn:
+            conn.execute("SELECT 1 FROM purchase_jobs LIMIT 1")
+
+    def get(self, job_id: str) -> Optional[PurchaseJob]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM purchase_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def save(self, job: PurchaseJob, expected_state: Optional[str] = None, lease: Optional[float] = None) -> bool:
+        """
+        Write a job back. With expected_state, only if the stored job is
+        still in that state (so a transition happens once across processes).
+        """
+        assignments = ', '.join(f"{column} = ?" for column in self.COLUMNS[1:])
+        params = list(self._values(job)[1:])
+        if lease is not None:
+            assignments += ", lease_until = ?"
+            params.append(time.time() + lease)
+        query = f"UPDATE purchase_jobs SET {assignments} WHERE job_id = ?"
+        params.append(job.job_id)
+        if expected_state is not None:
+            query += " AND state = ?"
+            params.append(expected_state)
+        with self._connect() as conn:
+            return conn.execute(query, params).rowcount == 1
+
+    def claim(self, lease: float, skip_users: List[str] = ()) -> Optional[PurchaseJob]:
+        """
+        Take the oldest queued job (or one whose lease lapsed) and mark it
+        running, skipping users whose wallet another process is sending from
+        and the users in `skip_users`
+        """
+        now = time.time()
+        owner = _owner()
+        skip = f"AND job.user_id NOT IN ({', '.join('?' * len(skip_users))}) " if skip_users else ""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM purchase_jobs AS job "
+                "WHERE (job.state = ? OR (job.state = ? AND job.lease_until < ?)) "
+                f"{skip}"
+                "AND NOT EXISTS (SELECT 1 FROM purchase_jobs AS other "
+                "WHERE other.user_id = job.user_id AND other.owner IS NOT NULL AND other.owner != ? "
+                "AND ((other.state = ? AND other.lease_until >= ?) OR (other.state = ? AND other.sent_at >= ?))) "
+                "ORDER BY job.created_at LIMIT 1",
+                (QUEUED, RUNNING, now, *skip_users, owner, RUNNING, now, SENT, now - JOB_WALLET_AFFINITY)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE purchase_jobs SET state = ?, lease_until = ?, owner = ?, updated_at = ? WHERE job_id = ?",
+                    (RUNNING, now + lease, owner, _now(), row['job_id'])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+        job = self._job(row)
+        job.state = RUNNING
+        return job
+
+    def list_batch(self, user_id: Any, batch_id: str) -> List[PurchaseJob]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM purchase_jobs WHERE batch_id = ? AND user_id = ? ORDER BY created_at, rowid",
+                (batch_id, str(user_id))
+            ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def claim_sent(self, lease: float) -> List[PurchaseJob]:
+        """
+        Take over confirmation of sent jobs whose tracking lease lapsed
+        (the process tracking them stopped)
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT * FROM purchase_jobs WHERE state = ? AND (lease_until IS NULL OR lease_until < ?)",
+                (SENT, now)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE purchase_jobs SET lease_until = ?, owner = ? WHERE job_id = ?",
+                [(now + lease, _owner(), row['job_id']) for row in rows]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return [self._job(row) for row in rows]
+
+    def renew(self, job_ids: List[str], lease: float) -> None:
+        """
+        Extend this process's lease on jobs it is still working on
+        """
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE purchase_jobs SET lease_until = ? WHERE job_id = ? AND owner = ?",
+                [(time.time() + lease, job_id, _owner()) for job_id in job_ids]
+            )
+
+    def release_sent(self) -> None:
+        """
+        Let other processes take over confirmation of this process's sent jobs now
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE purchase_jobs SET lease_until = 0 WHERE state = ? AND owner = ?", (SENT, _owner())
+            )
+
+    def purge(self, older_than: float) -> int:
+        """
+        Delete final jobs last updated more than `older_than` seconds ago
+        """
+        cutoff = datetime.fromtimestamp(time.time() - older_than).isoformat()
+        with self._connect() as conn:
+            return conn.execute(
+                f"DELETE FROM purchase_jobs WHERE state IN ({', '.join('?' * len(FINAL_STATES))}) AND updated_at < ?",
+                (*FINAL_STATES, cutoff)
+            ).rowcount
+
+
+def _same_address(a: Optional[str], b: Optional[str]) -> bool:
+    try:
+        return Address(a) == Address(b)
+    except Exception:
+        return False
+
+
+def _comment(out_msg: Dict[str, Any]) -> Optional[str]:
+    if out_msg.get('decoded_op_name') != 'text_comment':
+        return None
+    return (out_msg.get('decoded_body') or {}).get('text')
+
+
+def match_transaction(
+    job: PurchaseJob,
+    transactions: List[Dict[str, Any]],
+    ambiguous: bool = False
+) -> Optional[Dict[str, Any]]:
+    """
+    Find the wallet transaction carrying a job's transfer: by external
+    message hash, or by an outgoing message sent after the job with the same
+    destination, amount and Fragment comment (which carries the purchase's
+    Ref#). Jobs recorded without a comment match on destination and amount
+    only, unless `ambiguous` says another pending job would match the same way.
+    """
+    receipt = job.receipt
+    comment = receipt.get('comment')
+    for tx in transactions:
+        in_msg = tx.get('in_msg') or {}
+        if job.tx_hash and in_msg.get('hash') == job.tx_hash:
+            return tx
+        if tx.get('utime', 0) < (job.sent_at or 0) - 60 or (ambiguous and not comment):
+            continue
+        for out_msg in tx.get('out_msgs') or []:
+            if int(out_msg.get('value', -1)) != int(receipt.get('amount', -2)):
+                continue
+            if comment and (_comment(out_msg) or '').strip() != comment.strip():
+                continue
+            if _same_address((out_msg.get('destination') or {}).get('address'), receipt.get('destination')):
+                return tx
+    return None
+
+
+class ConfirmationTracker:
+    """
+    Confirms sent purchases on-chain.
+
+    Pending jobs are grouped by wallet, so each poll fetches one page of
+    transactions per wallet no matter how many purchases are pending on it.
+    """
+
+    def __init__(
+        self,
+        on_final: Callable[[PurchaseJob], Awaitable[None]],
+        api_key_for: Callable[[PurchaseJob], Awaitable[str]],
+        renew: Callable[[List[str]], Awaitable[None]]
+    ):
+        self.on_final = on_final
+        self.api_key_for = api_key_for
+        self.renew = renew
+        self._pending: Dict[str, PurchaseJob] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def track(self, job: PurchaseJob) -> None:
+        self._pending[job.job_id] = job
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._pending:
+            await asyncio.sleep(CONFIRMATION_POLL_INTERVAL)
+            try:
+                await self.renew(list(self._pending))
+            except Exception as e:
+                logger.warning('renewing confirmation leases failed: %s', e)
+            by_wallet: Dict[str, List[PurchaseJob]] = {}
+            for job in list(self._pending.values()):
+                by_wallet.setdefault(job.receipt.get('wallet_address'), []).append(job)
+            await asyncio.gather(
+                *(self._check_wallet(address, jobs) for address, jobs in by_wallet.items()),
+                return_exceptions=True,
+            )
+
+    async def _check_wallet(self, address: str, jobs: List[PurchaseJob]) -> None:
+        try:
+            transactions = await wallet.get_transactions(await self.api_key_for(jobs[0]), address)
+        except Exception as e:
+            logger.warning('confirmation poll failed wallet=%s: %s', address, e)
+            transactions = []
+
+        # Without a comment, two pending transfers of the same amount to the same
+        # address can't be told apart; those wait for their message hash instead
+        fits = Counter(
+            (job.receipt.get('destination'), job.receipt.get('amount'))
+            for job in jobs if not job.receipt.get('comment')
+        )
+        for job in jobs:
+            ambiguous = fits[(job.receipt.get('destination'), job.receipt.get('amount'))] > 1
+            tx = match_transaction(job, transactions, ambiguous)
+            if tx is not None:
+                job.transaction_hash = tx.get('hash')
+                if tx.get('success') and not tx.get('aborted'):
+                    job.set_state(CONFIRMED)
+                else:
+                    job.set_state(FAILED, 'Transaction was not successful on-chain')
+            elif time.time() - (job.sent_at or 0) > CONFIRMATION_TIMEOUT:
+                job.set_state(UNCONFIRMED, 'Transaction not found before confirmation timeout')
+            else:
+                continue
+
+            self._pending.pop(job.job_id, None)
+            await self.on_final(job)
+
+
+class PurchaseJobManager:
+    """
+    Runs stars purchases from a durable queue and tracks them to a final
+    on-chain state. Clients poll jobs by id, wait on them, or receive a
+    webhook.
+
+    A pool of async workers claims jobs from SQLite. Each Fragment step is
+    checkpointed, so after a crash a job resumes from its req_id; a job
+    that had reached the transfer is confirmed on-chain, never re-sent.
+    """
+
+    def __init__(self, service, path: str = JOB_DB_PATH, workers: int = PURCHASE_WORKERS):
+        self.service = service
+        self.path = path
+        self._store: Optional[PurchaseJobStore] = None
+        self.workers = workers
+        self.tracker = ConfirmationTracker(self._on_final, self._api_key_for, self._renew)
+        # Jobs being worked on or confirmed by this process
+        self._active: Dict[str, PurchaseJob] = {}
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._pid = None
+        self._draining = False
+        self._adopted_at = 0.0
+        # Jobs running in this process, by user; see BATCH_SESSION_CONCURRENCY
+        self._running_by_user: Dict[str, int] = {}
+        self._claim_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def store(self) -> PurchaseJobStore:
+        """The job database, opened on first use (not at import)"""
+        if self._store is None:
+            self._store = PurchaseJobStore(self.path)
+        return self._store
+
+    @property
+    def running(self) -> int:
+        """Purchase workers running in this process"""
+        if self._pid != os.getpid():
+            return 0
+        return sum(not task.done() for task in self._workers)
+
+    def start(self) -> None:
+        """
+        Start the workers on the running loop and take over confirmation of
+        sent jobs no process holds a lease on (once per process, so it
+        survives forking servers)
+        """
+        if self._draining:
+            return
+        if self._pid == os.getpid() and self._workers and not all(task.done() for task in self._workers):
+            return
+        self._pid = os.getpid()
+        self._wakeup = asyncio.Event()
+        self._claim_lock = asyncio.Lock()
+        self._running_by_user = {}
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        removed = self.store.purge(JOB_RETENTION)
+        self._adopted_at = time.monotonic()
+        self._adopt_sent(self.store.claim_sent(JOB_LEASE))
+        logger.info('purchase workers started workers=%s purged=%s', self.workers, removed)
+
+    def _adopt_sent(self, jobs: List[PurchaseJob]) -> None:
+        # Sent jobs are confirmed only by the process holding their lease
+        for job in jobs:
+            self._active[job.job_id] = job
+            self.tracker.track(job)
+
+    async def _renew(self, job_ids: List[str]) -> None:
+        await asyncio.to_thread(self.store.renew, job_ids, JOB_LEASE)
+
+    async def get(self, job_id: str) -> Optional[PurchaseJob]:
+        self.start()
+        job = self._active.get(job_id)
+        if job is None:
+            job = await asyncio.to_thread(self.store.get, job_id)
+        return job
+
+    async def find(self, user_id: Any, idempotency_key: str) -> Optional[PurchaseJob]:
+        """
+        The user's job submitted under an idempotency key, if any
+        """
+        return await asyncio.to_thread(self.store.find, user_id, idempotency_key)
+
+    async def submit(
+        self,
+        user_id: int,
+        username: str,
+        quantity: int,
+        callback_url: Optional[str] = None,
+        idempotency_key: Optional[str] = None,
+        batch_id: Optional[str] = None
+    ) -> tuple:
+        """
+        Queue a purchase and return (job, created) immediately. A repeated
+        idempotency key returns the user's existing job instead of a new one.
+        """
+        self.start()
+        job = PurchaseJob(
+            uuid.uuid4().hex, user_id, username, quantity, callback_url, idempotency_key, request_id.get(), batch_id
+        )
+        job, created = await asyncio.to_thread(self.store.insert, job)
+        if created and self._wakeup is not None:
+            self._wakeup.set()
+        return job, created
+
+    async def list_batch(self, user_id: Any, batch_id: str) -> List[PurchaseJob]:
+        """
+        The user's jobs queued by one batch, in item order, with this process's latest state
+        """
+        jobs = await asyncio.to_thread(self.store.list_batch, user_id, batch_id)
+        return [self._active.get(job.job_id, job) for job in jobs]
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[PurchaseJob]:
+        """
+        Wait until a job is sent or final, or the timeout passes; returns its latest state
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = await self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job.state == SENT or job.state in FINAL_STATES or remaining <= 0:
+                return job
+            # Woken by local progress; polled for jobs run by other processes
+            changed = self._changed.setdefault(job_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(changed.wait(), min(remaining, JOB_POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                # Jobs run by other processes never notify here; don't keep their events.
+                # Another waiter on the same job sets up a new one on its next round.
+                if self._changed.get(job_id) is changed:
+                    del self._changed[job_id]
+
+    def _notify_changed(self, job: PurchaseJob) -> None:
+        changed = self._changed.pop(job.job_id, None)
+        if changed is not None:
+            changed.set()
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Stop claiming jobs and give the ones in progress up to timeout to be
+        sent. Jobs still running are then cancelled; their lease lapses and
+        another process resumes them from their last checkpoint.
+        """
+        self._draining = True
+        if self._pid != os.getpid() or not self._workers:
+            return
+        self._wakeup.set()
+        _, pending = await asyncio.wait(self._workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning('purchase workers cancelled at shutdown workers=%s', len(pending))
+        try:
+            await asyncio.to_thread(self.store.release_sent)
+        except Exception as e:
+            logger.warning('releasing sent purchase jobs failed: %s', e)
+
+    def _user_limit(self, user_id: str) -> int:
+        # Scaled by the user's sessions when their data is cached, one otherwise
+        user_data = self.service.user_data_cache.get(user_id) or {}
+        return BATCH_SESSION_CONCURRENCY * max(1, len(user_data.get('fragments') or ()))
+
+    async def _claim(self) -> Optional[PurchaseJob]:
+        # Claims in this process are serialized so the per-user counts stay exact
+        async with self._claim_lock:
+            skip_users = []
+            if BATCH_SESSION_CONCURRENCY > 0:
+                skip_users = [
+                    user_id for user_id, running in self._running_by_user.items()
+                    if running >= self._user_limit(user_id)
+                ]
+            job = await asyncio.to_thread(self.store.claim, JOB_LEASE, skip_users)
+            if job is not None:
+                user_id = str(job.user_id)
+                self._running_by_user[user_id] = self._running_by_user.get(user_id, 0) + 1
+            return job
+
+    def _release(self, job: PurchaseJob) -> None:
+        user_id = str(job.user_id)
+        running = self._running_by_user.get(user_id, 0) - 1
+        if running > 0:
+            self._running_by_user[user_id] = running
+        else:
+            self._running_by_user.pop(user_id, None)
+        # A freed slot may let a skipped user's job run
+        self._wakeup.set()
+
+    async def _worker(self) -> None:
+        while not self._draining:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.exception('claiming purchase job failed: %s', e)
+                job = None
+            if job is None:
+                if time.monotonic() - self._adopted_at > CONFIRMATION_POLL_INTERVAL:
+                    # Confirmation of sent jobs left behind by a stopped process
+                    self._adopted_at = time.monotonic()
+                    try:
+                        self._adopt_sent(await asyncio.to_thread(self.store.claim_sent, JOB_LEASE))
+                    except Exception as e:
+                        logger.warning('claiming sent purchase jobs failed: %s', e)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._active[job.job_id] = job
+            try:
+                await self._run(job)
+            except Exception as e:
+                logger.exception('purchase job %s crashed: %s', job.job_id, e)
+            finally:
+                self._release(job)
+                if job.state != SENT:
+                    self._active.pop(job.job_id, None)
+
+    async def _checkpoint(self, job: PurchaseJob) -> None:
+        job.updated_at = _now()
+        await asyncio.to_thread(self.store.save, job, RUNNING, JOB_LEASE)
+        self._notify_changed(job)
+
+    async def _run(self, job: PurchaseJob) -> None:
+        request_id.set(job.request_id or job.job_id)
+        checkpoint = job.checkpoint
+        if checkpoint.get('step') == 'sending':
+            # Interrupted while sending: the transfer may be on-chain already
+            logger.warning('purchase job %s resumed after send; confirming instead of re-sending', job.job_id)
+            await self._mark_sent_from_checkpoint(job)
+            return
+
+        try:
+            receipt = await self.service.purchase_stars(
+                job.user_id, job.username, job.quantity,
+                checkpoint=checkpoint,
+                on_checkpoint=lambda _: self._checkpoint(job)
+            )
+        except Exception as e:
+            if checkpoint.get('step') == 'sending':
+                # Failed during or after the send: let the tracker settle it on-chain
+                logger.warning('purchase job %s failed after send (%s); confirming on-chain', job.job_id, e)
+                await self._mark_sent_from_checkpoint(job)
+                return
+            logger.exception('purchase job %s failed: %s', job.job_id, e)
+            receipt = None
+
+        if not receipt:
+            job.set_state(FAILED, 'Failed to buy stars. Please check your wallet balance and Fragment credentials.')
+            await self._on_final(job, expected_state=RUNNING)
+            return
+        await self._mark_sent(job, receipt)
+
+    async def _mark_sent(self, job: PurchaseJob, receipt: Dict[str, Any], sent_at: Optional[float] = None) -> None:
+        job.receipt = receipt
+        job.tx_hash = receipt.get('tx_hash')
+        job.sent_at = sent_at or time.time()
+        job.set_state(SENT)
+        # The lease now covers confirmation; the tracker renews it
+        if not await asyncio.to_thread(self.store.save, job, RUNNING, JOB_LEASE):
+            # Our lease lapsed and another process took the job over; it confirms it
+            logger.error('purchase job %s was sent but is no longer ours; not tracking it here', job.job_id)
+            self._active.pop(job.job_id, None)
+            return
+        self._notify_changed(job)
+        self.tracker.track(job)
+
+    async def _mark_sent_from_checkpoint(self, job: PurchaseJob) -> None:
+        checkpoint = job.checkpoint
+        await self._mark_sent(job, {
+            "wallet_address": checkpoint.get('wallet_address'),
+            "destination": checkpoint['transaction']['destination'],
+            "amount": checkpoint['transaction']['amount'],
+            "comment": await fragment.encoded(checkpoint['transaction']['payload']),
+            "req_id": checkpoint.get('req_id'),
+            "recipient": checkpoint.get('recipient'),
+            "quantity": job.quantity
+        }, sent_at=checkpoint.get('sending_at'))
+
+    async def _api_key_for(self, job: PurchaseJob) -> str:
+        api_key = job.receipt.get('ton_api_key')
+        if not api_key:
+            # Jobs resumed from disk: look the key up again
+            user_data = await self.service.get_user_data_from_api(job.user_id)
+            api_key = job.receipt['ton_api_key'] = user_data["wallet"].get('tonApiKey', '')
+        return api_key
+
+    async def _on_final(self, job: PurchaseJob, expected_state: str = SENT) -> None:
+        self._active.pop(job.job_id, None)
+        # Only the process that moves the job out of its state reports it
+        if not await asyncio.to_thread(self.store.save, job, expected_state):
+            return
+        self._notify_changed(job)
+        logger.debug('purchase job %s final state=%s', job.job_id, job.state)
+        if job.callback_url:
+            await self._notify(job)
+
+    async def _notify(self, job: PurchaseJob) -> None:
+        for attempt in range(WEBHOOK_RETRIES):
+            # Checked again at send time (the host may resolve differently now)
+            # and sent to the address that was checked
+            try:
+                response = await request_public_url(
+                    get_client('webhook', timeout=10, limits=WEBHOOK_LIMITS), 'POST', job.callback_url,
+                    json=job.to_dict()
+                )
+                if response.status_code < 300:
+                    return
+            except UnsafeURLError as e:
+                logger.error('webhook for job %s refused: callback_url %s', job.job_id, e)
+                return
+            except Exception as e:
+                logger.warning('webhook for job %s failed: %s', job.job_id, e)
+            await asyncio.sleep(2 ** attempt)
+        logger.error('webhook for job %s gave up after %s attempts', job.job_id, WEBHOOK_RETRIES)
@@ -0,0 +1,162 @@
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from api.fragment import ChallengeError, session_key
+
+logger = logging.getLogger('fragment.sessions')
+
+# 'least_loaded' (fewest purchases in flight, weighted by health) or 'round_robin'
+FRAGMENT_SESSION_STRATEGY = os.environ.get('FRAGMENT_SESSION_STRATEGY', 'least_loaded')
+# Consecutive failures after which a session leaves rotation
+FRAGMENT_SESSION_MAX_FAILURES = int(os.environ.get('FRAGMENT_SESSION_MAX_FAILURES', 3))
+# First time out of rotation; doubled on each repeat, up to the max
+FRAGMENT_SESSION_COOLDOWN = float(os.environ.get('FRAGMENT_SESSION_COOLDOWN', 60))
+FRAGMENT_SESSION_MAX_COOLDOWN = float(os.environ.get('FRAGMENT_SESSION_MAX_COOLDOWN', 900))
+# Weight of the latest outcome in the health score
+FRAGMENT_SESSION_SCORE_ALPHA = float(os.environ.get('FRAGMENT_SESSION_SCORE_ALPHA', 0.2))
+
+
+@dataclass
+class SessionHealth:
+    key: str
+    in_flight: int = 0
+    successes: int = 0
+    failures: int = 0
+    challenges: int = 0
+    consecutive_failures: int = 0
+    # Moving average of outcomes, 1.0 = every recent call succeeded
+    score: float = 1.0
+    ejections: int = 0
+    ejected_until: float = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "session": self.key,
+            "available": self.available,
+            "in_flight": self.in_flight,
+            "score": round(self.score, 3),
+            "successes": self.successes,
+            "failures": self.failures,
+            "challenges": self.challenges,
+            "ejections": self.ejections,
+            "retry_in": max(0.0, round(self.ejected_until - time.monotonic(), 1)),
+        }
+
+
+class SessionUse:
+    """
+    Outcome of one use of a session; a Fragment error response is marked
+    with fail(), exceptions are recorded automatically
+    """
+
+    __slots__ = ('ok',)
+
+    def __init__(self):
+        self.ok = True
+
+    def fail(self) -> None:
+        self.ok = False
+
+
+class FragmentSessionPool:
+    """
+    Spreads a user's purchases over their active Fragment sessions.
+
+    Each session (one set of stel_* / cf_clearance cookies and hash) is
+    throttled by Fragment on its own, so resellers with several sessions
+    get several times the throughput. Sessions are scored by recent
+    outcomes; a challenged session, or one failing repeatedly, is taken
+    out of rotation for a cooldown that grows while it keeps failing.
+    Health is per process.
+    """
+
+    def __init__(self, strategy: str = FRAGMENT_SESSION_STRATEGY):
+        self.strategy = strategy
+        self._health: Dict[str, SessionHealth] = {}
+        self._counter = itertools.count()
+
+    def health(self, session: Dict[str, Any]) -> SessionHealth:
+        key = session_key(session)
+        state = self._health.get(key)
+        if state is None:
+            state = self._health[key] = SessionHealth(key)
+        return state
+
+    def pick(self, sessions: List[Dict[str, Any]], prefer: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Choose a session for the next purchase. `prefer` (a session key)
+        wins while it is in rotation, so a resumed purchase keeps the
+        session its req_id was issued on.
+        """
+        if not sessions:
+            raise Exception("No active fragment data found for user")
+
+        available = [s for s in sessions if self.health(s).available]
+        if prefer is not None:
+            for session in available:
+                if session_key(session) == prefer:
+                    return session
+        if not available:
+            # Every session is cooling down: use the one that recovers first
+            return min(sessions, key=lambda s: self.health(s).ejected_until)
+
+        if len(available) == 1:
+            return available[0]
+        if self.strategy == 'round_robin':
+            return available[next(self._counter) % len(available)]
+        return min(available, key=lambda s: (self.health(s).in_flight + 1) / max(self.health(s).score, 0.05))
+
+    @contextmanager
+    def use(self, session: Dict[str, Any]) -> Iterator[SessionUse]:
+        """
+        Count a use of the session as in flight and record its outcome
+        """
+        state = self.health(session)
+        usage = SessionUse()
+        state.in_flight += 1
+        try:
+            yield usage
+        except ChallengeError:
+            self._record(state, False, challenge=True)
+            raise
+        except Exception:
+            self._record(state, False)
+            raise
+        else:
+            self._record(state, usage.ok)
+        finally:
+            state.in_flight -= 1
+
+    def _record(self, state: SessionHealth, ok: bool, challenge: bool = False) -> None:
+        state.score += FRAGMENT_SESSION_SCORE_ALPHA * ((1.0 if ok else 0.0) - state.score)
+        if ok:
+            state.successes += 1
+            state.consecutive_failures = 0
+            state.ejections = 0
+            return
+
+        state.failures += 1
+        state.consecutive_failures += 1
+        if challenge:
+            state.challenges += 1
+        if challenge or state.consecutive_failures >= FRAGMENT_SESSION_MAX_FAILURES:
+            cooldown = min(FRAGMENT_SESSION_COOLDOWN * 2 ** state.ejections, FRAGMENT_SESSION_MAX_COOLDOWN)
+            state.ejections += 1
+            state.consecutive_failures = 0
+            state.ejected_until = time.monotonic() + cooldown
+            logger.warning(
+                'fragment session %s out of rotation for %.0fs (challenge=%s score=%.2f)',
+                state.key, cooldown, challenge, state.score,
+            )
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        return [state.to_dict() for state in self._health.values()]
@@ -1,68 +1,141 @@
-import requests
-import json
 import logging
 import asyncio
-from typing import Optional, Dict, Any
+import os
+import time
+from typing import Optional, Dict, Any, Callable, Awaitable
 from api import fragment, wallet
+from session_pool import FragmentSessionPool, session_key
+from stars_prices import StarsPriceTable
+from common.http import get_client
+from common.resilience import CircuitOpenError, hedged
+from common.cache import TTLCache
+from common.singleflight import get_group
+from common.tracing import span
+from tonutils.utils import to_amount
 
 logger = logging.getLogger('stars_buy_service')
 
 
+USER_DATA_CACHE_TTL = float(os.environ.get('USER_DATA_CACHE_TTL', 10))
+USER_DATA_CACHE_SIZE = int(os.environ.get('USER_DATA_CACHE_SIZE', 10000))
+# Pre-flight balance check: a purchase is refused only if the balance is
+# below the quoted price by more than this share (the quote may be stale)
+STARS_PREFLIGHT_TOLERANCE = float(os.environ.get('STARS_PREFLIGHT_TOLERANCE', 0.05))
+# After the combined /context route answers 404, calls use the legacy lookups
+# for this long before it is tried again (the 404 may be about one user only)
+COMBINED_CONTEXT_RETRY = float(os.environ.get('COMBINED_CONTEXT_RETRY', 300))
+
+
 class StarsBuyService:
     def __init__(self, api_base_url: str = "http://localhost:3000/api"):
         self.api_base_url = api_base_url
+        self.user_data_cache = TTLCache(maxsize=USER_DATA_CACHE_SIZE, ttl=USER_DATA_CACHE_TTL)
+        # Monotonic time until which the combined /context route is skipped
+        self.combined_context_retry_at = 0.0
+        self.sessions = FragmentSessionPool()
+        self.prices = StarsPriceTable()
         
     async def get_user_data_from_api(self, user_id: int) -> Dict[str, Any]:
         """
         Get user wallet and fragment data from Node.js API
         """
-        try:
-            # Get wallet data
-            wallet_response = requests.get(f"{self.api_base_url}/wallets/user/{user_id}")
-            if wallet_response.status_code != 200:
-                raise Exception(f"Failed to get wallet data: {wallet_response.text}")
+        with span('user_data'):
+            cached = self.user_data_cache.get(str(user_id))
+            if cached is not None:
+                return cached
             
-            wallet_data = wallet_response.json()
-            if not wallet_data.get("success") or not wallet_data.get("data"):
-                raise Exception("No wallet found for user")
+            # Concurrent misses for the same user share one round of backend lookups
+            return await get_group('user_data').do(str(user_id), lambda: self._load_user_data(user_id))
+    
+    async def _load_user_data(self, user_id: int) -> Dict[str, Any]:
+        """
+        Look up user data on the Node.js API and cache it
+        """
+        try:
+            user_data = None
+            if time.monotonic() >= self.combined_context_retry_at:
+                user_data = await self._get_user_context(user_id)
+            if user_data is None:
+                user_data = await self._get_user_data_legacy(user_id)
             
-            # Get first wallet (users should have one wallet per subscription)
-            user_wallet = wallet_data["data"][0] if wallet_data["data"] else None
-            if not user_wallet:
+            if not user_data["wallet"]:
                 raise Exception("No wallet found for user")
-            
-            # Get fragment data
-            fragment_response = requests.get(f"{self.api_base_url}/fragment-user-data/user/{user_id}/active")
-            if fragment_response.status_code != 200:
-                raise Exception(f"Failed to get fragment data: {fragment_response.text}")
-            
-            fragment_data = fragment_response.json()
-            if not fragment_data.get("success") or not fragment_data.get("data"):
+            if not user_data["fragment"]:
                 raise Exception("No active fragment data found for user")
+            # Every active session of the user (older Node APIs return only one)
+            user_data["fragments"] = user_data.get("fragments") or [user_data["fragment"]]
             
-            user_fragment = fragment_data["data"]
-            
-            return {
-                "wallet": user_wallet,
-                "fragment": user_fragment
-            }
+            self.user_data_cache.set(str(user_id), user_data)
+            return user_data
             
         except Exception as e:
             logger.exception(f"Error getting user data: {e}")
             raise
     
-    def build_cookies_from_fragment_data(self, fragment_data: Dict[str, Any]) -> str:
+    async def _get_user_context(self, user_id: int) -> Optional[Dict[str, Any]]:
         """
-        Build cookies string from fragment data
+        Get wallet and active fragment data in one call (None on a 404, so
+        this call falls back to the legacy lookups)
         """
-        cookies_data = {
-            'stel_ssid': fragment_data.get('stelSsid', ''),
-            'stel_dt': fragment_data.get('stelDt', ''),
-            'stel_ton_token': fragment_data.get('stelTonToken', ''),
-            'stel_token': fragment_data.get('stelToken', ''),
-            'cf_clearance': fragment_data.get('cfClearance', '')
+        client = get_client('backend')
+        response = await hedged('backend', lambda: client.get(f"{self.api_base_url}/fragment-user-data/user/{user_id}/context"))
+        if response.status_code == 404:
+            logger.warning('Combined user context route returned 404, using legacy lookups for %ss', COMBINED_CONTEXT_RETRY)
+            self.combined_context_retry_at = time.monotonic() + COMBINED_CONTEXT_RETRY
+            return None
+        if response.status_code != 200:
+            raise Exception(f"Failed to get user context: {response.text}")
+        
+        data = response.json().get("data") or {}
+        return {
+            "wallet": data.get("wallet"),
+            "fragment": data.get("fragment"),
+            "fragments": data.get("fragments")
         }
-        return fragment.build_cookies_from_data(cookies_data)
+    
+    async def _get_user_data_legacy(self, user_id: int) -> Dict[str, Any]:
+        """
+        Get wallet and active fragment data with the two legacy lookups, run concurrently
+        """
+        client = get_client('backend')
+        wallet_response, fragment_response = await asyncio.gather(
+            hedged('backend', lambda: client.get(f"{self.api_base_url}/wallets/user/{user_id}")),
+            hedged('backend', lambda: client.get(f"{self.api_base_url}/fragment-user-data/user/{user_id}/active")),
+        )
+        
+        # Get wallet data
+        if wallet_response.status_code != 200:
+            raise Exception(f"Failed to get wallet data: {wallet_response.text}")
+        
+        wallet_data = wallet_response.json()
+        if not wallet_data.get("success") or not wallet_data.get("data"):
+            raise Exception("No wallet found for user")
+        
+        # Get first wallet (users should have one wallet per subscription)
+        user_wallet = wallet_data["data"][0] if wallet_data["data"] else None
+        
+        # Get fragment data
+        if fragment_response.status_code != 200:
+            raise Exception(f"Failed to get fragment data: {fragment_response.text}")
+        
+        fragment_data = fragment_response.json()
+        if not fragment_data.get("success") or not fragment_data.get("data"):
+            raise Exception("No active fragment data found for user")
+        
+        return {
+            "wallet": user_wallet,
+            "fragment": fragment_data["data"]
+        }
+    
+    def invalidate_user_data(self, user_id: Optional[int] = None) -> int:
+        """
+        Drop cached user data for one user, or for everyone if user_id is None
+        """
+        if user_id is None:
+            removed = len(self.user_data_cache)
+            self.user_data_cache.clear()
+            return removed
+        return 0 if self.user_data_cache.pop(str(user_id)) is None else 1
     
     async def search_user(self, user_id: int, username: str, quantity: int = 50) -> Optional[Dict[str, Any]]:
         """
@@ -73,14 +146,14 @@ class StarsBuyService:
             
             # Get user data from API
             user_data = await self.get_user_data_from_api(user_id)
-            fragment_data = user_data["fragment"]
+            fragment_data = self.sessions.pick(user_data["fragments"])
             
-            # Build cookies and hash
-            cookies = self.build_cookies_from_fragment_data(fragment_data)
-            hash_value = fragment_data.get('fragmentHash', '')
+            session = fragment.FragmentSession.from_data(fragment_data)
+            self.prices.watch()
             
             # Search for user
-            user_result = await fragment.get_user_address(cookies, hash_value, username, quantity)
+            with span('search'), self.sessions.use(fragment_data):
+                user_result = await session.search_recipient(username, quantity)
             found = user_result.get("found") or {}
             
             nickname = found.get("name")
@@ -99,6 +172,8 @@ class StarsBuyService:
             logger.debug('search_user result=%s', result)
             return result
             
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logger.exception(f"Error searching user: {e}")
             return None
@@ -107,86 +182,132 @@ class StarsBuyService:
         """
         Buy stars for a user
         """
+        receipt = await self.purchase_stars(user_id, username, quantity)
+        return receipt["tx_hash"] if receipt else None
+    
+    async def purchase_stars(
+        self,
+        user_id: int,
+        username: str,
+        quantity: int,
+        checkpoint: Optional[Dict[str, Any]] = None,
+        on_checkpoint: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Buy stars for a user and return a receipt describing the TON transfer
+        (tx_hash, seqno, wallet and destination addresses, amount, req_id).
+
+        Progress is recorded in `checkpoint` after each Fragment step and
+        handed to `on_checkpoint`; passing a saved checkpoint back in skips
+        the steps it already covers, so a retried purchase resumes from its
+        req_id instead of starting over.
+
+        Returns None if the purchase failed before any TON was sent. An
+        error once the checkpoint reached 'sending' is raised instead, as
+        the transfer may be on-chain.
+        """
+        checkpoint = {} if checkpoint is None else checkpoint
+        
+        async def save(step: str, **values: Any) -> None:
+            checkpoint.update(values, step=step)
+            if on_checkpoint:
+                await on_checkpoint(checkpoint)
+        
         try:
-            logger.debug('buy_stars user_id=%s username=%s quantity=%s', user_id, username, quantity)
+            logger.debug('buy_stars user_id=%s username=%s quantity=%s step=%s', user_id, username, quantity, checkpoint.get('step'))
             
             # Get user data from API
             user_data = await self.get_user_data_from_api(user_id)
             wallet_data = user_data["wallet"]
-            fragment_data = user_data["fragment"]
-            
-            # Build cookies and hash
-            cookies = self.build_cookies_from_fragment_data(fragment_data)
-            hash_value = fragment_data.get('fragmentHash', '')
-            
-            # Search for recipient
-            user_result = await fragment.get_user_address(cookies, hash_value, username, quantity)
-            found = user_result.get("found") or {}
-            
-            nickname = found.get("name")
-            address = found.get("recipient")
-            
-            if not nickname or not address:
-                logger.error('buy_stars: no nickname/address in user_result=%s', user_result)
-                return None
-            
-            # Step 1: Update stars buy state
-            referer = f'https://fragment.com/stars/buy?recipient={address}&quantity={quantity}'
-            try:
-                update_result = await fragment.update_stars_buy_state(
-                    COOKIES=cookies,
-                    HASH=hash_value,
-                    mode="new",
-                    lv=True,
-                    referer=referer,
-                    dh=None,
-                )
-                logger.debug('updateStarsBuyState result: %s', update_result)
-            except Exception as ex:
-                logger.warning('updateStarsBuyState failed: %s', ex)
-            
-            # Step 2: Initialize buy stars request
-            init_result = await fragment.init_buy_stars(cookies, hash_value, address, quantity)
-            req_id = init_result.get('req_id')
-            
-            if not req_id:
-                logger.error('No req_id in init response: %s', init_result)
-                return None
-            
-            # Step 3: Get buy stars transaction
-            account_json = fragment.build_account_json(fragment_data)
-            device_json = fragment.build_device_json()
-            
-            buy_result = await fragment.get_buy_stars(
-                cookies, hash_value, req_id, address, quantity,
-                account_json=account_json,
-                device_json=device_json,
-                show_sender=1,
-            )
-            
-            if buy_result.get('error'):
-                logger.error('getBuyStarsLink error: %s', buy_result)
-                return None
             
-            # Extract transaction details
-            transaction = buy_result.get('transaction', {})
-            messages = transaction.get('messages', [])
-            if not messages:
-                logger.error('No messages in transaction: %s', buy_result)
-                return None
-            
-            message = messages[0]
-            dest_address = message.get('address')
-            amount_str = message.get('amount')
-            amount = int(amount_str) if isinstance(amount_str, str) else amount_str
-            payload = message.get('payload')
-            
-            if not dest_address or not amount or not payload:
-                logger.error('Missing transaction data: address=%s amount=%s payload=%s', dest_address, amount, payload)
-                return None
+            # A started purchase stays on the session its req_id was issued on
+            fragment_data = self.sessions.pick(user_data["fragments"], prefer=checkpoint.get('session'))
+            if checkpoint.get('session') not in (None, session_key(fragment_data)) and 'transaction' not in checkpoint:
+                logger.warning('buy_stars: session %s unavailable, restarting on %s', checkpoint['session'], session_key(fragment_data))
+                for key in ('recipient', 'req_id', 'session'):
+                    checkpoint.pop(key, None)
+            
+            # Cookies, headers and account JSON are prepared once per session
+            session = fragment.FragmentSession.from_data(fragment_data)
+            self.prices.watch()
+            
+            with self.sessions.use(fragment_data) as usage:
+                # Search for recipient
+                if 'recipient' not in checkpoint:
+                    with span('search'):
+                        user_result = await session.search_recipient(username, quantity)
+                    found = user_result.get("found") or {}
+                
+                    nickname = found.get("name")
+                    address = found.get("recipient")
+                
+                    if not nickname or not address:
+                        logger.error('buy_stars: no nickname/address in user_result=%s', user_result)
+                        return None
+                    await save('searched', recipient=address, session=session_key(fragment_data))
+                address = checkpoint['recipient']
+            
+                if 'req_id' not in checkpoint:
+                    # Step 1: Update stars buy state
+                    referer = f'https://fragment.com/stars/buy?recipient={address}&quantity={quantity}'
+                    try:
+                        with span('update_state'):
+                            update_result = await session.update_buy_state(
+                                mode="new",
+                                lv=True,
+                                referer=referer,
+                                dh=None,
+                            )
+                        logger.debug('updateStarsBuyState result: %s', update_result)
+                    except Exception as ex:
+                        logger.warning('updateStarsBuyState failed: %s', ex)
+                
+                    # Step 2: Initialize buy stars request
+                    with span('init'):
+                        init_result = await session.init_buy(address, quantity)
+                    req_id = init_result.get('req_id')
+                
+                    if not req_id:
+                        logger.error('No req_id in init response: %s', init_result)
+                        usage.fail()
+                        return None
+                    await save('initialized', req_id=req_id)
+                req_id = checkpoint['req_id']
+            
+                if 'transaction' not in checkpoint:
+                    # Step 3: Get buy stars transaction
+                    with span('get_link'):
+                        buy_result = await session.get_buy_link(req_id, address, quantity, show_sender=1)
+                
+                    if buy_result.get('error'):
+                        logger.error('getBuyStarsLink error: %s', buy_result)
+                        usage.fail()
+                        return None
+                
+                    # Extract transaction details
+                    transaction = buy_result.get('transaction', {})
+                    messages = transaction.get('messages', [])
+                    if not messages:
+                        logger.error('No messages in transaction: %s', buy_result)
+                        return None
+                
+                    message = messages[0]
+                    dest_address = message.get('address')
+                    amount_str = message.get('amount')
+                    amount = int(amount_str) if isinstance(amount_str, str) else amount_str
+                    payload = message.get('payload')
+                
+                    if not dest_address or not amount or not payload:
+                        logger.error('Missing transaction data: address=%s amount=%s payload=%s', dest_address, amount, payload)
+                        return None
+                    self.prices.record(quantity, amount)
+                    await save('linked', transaction={"destination": dest_address, "amount": amount, "payload": payload})
+            dest_address = checkpoint['transaction']['destination']
+            amount = checkpoint['transaction']['amount']
             
             # Decode payload
-            payload = await fragment.encoded(payload)
+            with span('payload_decode'):
+                payload = await fragment.encoded(checkpoint['transaction']['payload'])
             
             # Step 4: Send TON transfer
             mnemonic_list = wallet_data.get('mnemonics', '').split()
@@ -196,22 +317,88 @@ class StarsBuyService:
                 logger.error('Missing wallet data: mnemonic=%s tonApiKey=%s', bool(mnemonic_list), bool(ton_api_key))
                 return None
             
-            tx_hash = await wallet.send_transfer(ton_api_key, mnemonic_list, dest_address, amount, payload)
+            # Recorded before sending: a purchase interrupted past this point
+            # may already be paid and must be confirmed, never sent again
+            ton_wallet = await wallet.get_wallet(ton_api_key, mnemonic_list)
+            await save('sending', wallet_address=ton_wallet.address.to_str(), sending_at=time.time())
+            
+            with span('ton_send'):
+                transfer = await wallet.submit_transfer(ton_api_key, mnemonic_list, dest_address, amount, payload)
+            tx_hash = transfer.get("tx_hash")
             
             if tx_hash:
                 logger.debug('buy_stars success tx_hash=%s', tx_hash)
-                return tx_hash
+                return {
+                    "tx_hash": tx_hash,
+                    "seqno": transfer.get("seqno"),
+                    "wallet_address": transfer.get("wallet_address"),
+                    "ton_api_key": ton_api_key,
+                    "destination": dest_address,
+                    "amount": amount,
+                    # The transfer's text comment, with the purchase's Ref#
+                    "comment": payload,
+                    "req_id": req_id,
+                    "recipient": address,
+                    "quantity": quantity
+                }
             else:
-                logger.error('buy_stars: no tx_hash returned')
-                return None
+                # The transfer may still have been broadcast
+                raise Exception("No tx_hash returned for the TON transfer")
                 
         except Exception as e:
             logger.exception(f"Error buying stars: {e}")
+            if checkpoint.get('step') == 'sending':
+                # Possibly paid: the caller must confirm on-chain, not fail the purchase
+                raise
             return None
     
-    async def get_wallet_balance(self, user_id: int) -> Optional[int]:
+    async def quote_stars(self, user_id: int, quantity: Optional[int] = None) -> Any:
+        """
+        Price of `quantity` stars from the in-memory price table (the whole
+        table without a quantity). Only an empty table is filled from
+        Fragment first, through one of the user's sessions.
+        """
+        if self.prices.quote(quantity or 1) is None:
+            user_data = await self.get_user_data_from_api(user_id)
+            session = fragment.FragmentSession.from_data(self.sessions.pick(user_data["fragments"]))
+            self.prices.watch()
+            # Coalesced per session, so a user's quote never runs on another user's session
+            await get_group('stars_prices').do(session.key, lambda: self.prices.refresh(session))
+        return self.prices.quote(quantity) if quantity else self.prices.get_table()
+    
+    def check_balance(self, user_id: int, quantity: int) -> Optional[Dict[str, Any]]:
         """
-        Get wallet balance for a user
+        Pre-flight check of a purchase against the quoted price and the
+        cached wallet balance. Returns the shortfall in nanotons ({required_nano, balance_nano})
+        if the wallet clearly cannot pay, None if it can or either is unknown.
+        Reads caches only: on any miss the purchase goes ahead unchecked.
+        """
+        quote = self.prices.quote(quantity)
+        if quote is None:
+            return None
+        user_data = self.user_data_cache.get(str(user_id))
+        if user_data is None:
+            return None
+        wallet_data = user_data["wallet"]
+        mnemonic_list = wallet_data.get('mnemonics', '').split()
+        ton_api_key = wallet_data.get('tonApiKey', '')
+        if not mnemonic_list or not ton_api_key:
+            return None
+        entry = wallet.get_cached_balance_entry(ton_api_key, mnemonic_list)
+        if entry is None or entry["balance_nano"] >= quote["amount"] * (1 - STARS_PREFLIGHT_TOLERANCE):
+            return None
+        return {"required_nano": quote["amount"], "balance_nano": entry["balance_nano"]}
+    
+    async def get_wallet_balance(self, user_id: int) -> Optional[float]:
+        """
+        Get wallet balance for a user in TON
+        """
+        entry = await self.get_wallet_balance_entry(user_id)
+        return to_amount(entry["balance_nano"], precision=9) if entry else None
+    
+    async def get_wallet_balance_entry(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Get wallet balance for a user in nanotons with the time it was fetched ({balance_nano, cached_at})
         """
         try:
             logger.debug('get_wallet_balance user_id=%s', user_id)
@@ -227,10 +414,12 @@ class StarsBuyService:
                 logger.error('Missing wallet data: mnemonic=%s tonApiKey=%s', bool(mnemonic_list), bool(ton_api_key))
                 return None
             
-            balance = await wallet.get_balance(ton_api_key, mnemonic_list)
-            logger.debug('get_wallet_balance result=%s', balance)
-            return balance
+            entry = await wallet.get_balance_entry(ton_api_key, mnemonic_list)
+            logger.debug('get_wallet_balance result=%s', entry)
+            return entry
             
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logger.exception(f"Error getting wallet balance: {e}")
             return None
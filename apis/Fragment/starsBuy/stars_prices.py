@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List, Optional, Tuple
+
+from api.fragment import FragmentSession
+
+logger = logging.getLogger('stars_prices')
+
+# Quantities whose price is refreshed from Fragment; other quantities are
+# priced per star from the nearest known one
+STARS_PRICE_QUANTITIES = [int(q) for q in os.environ.get('STARS_PRICE_QUANTITIES', '50,100,500,1000,5000').split(',') if q]
+STARS_PRICE_REFRESH_INTERVAL = float(os.environ.get('STARS_PRICE_REFRESH_INTERVAL', 60))
+# Prices older than this are not quoted
+STARS_PRICE_MAX_AGE = float(os.environ.get('STARS_PRICE_MAX_AGE', 600))
+# The refresh loop stops once no purchase or quote has been seen for this long
+STARS_PRICE_WATCH_TTL = float(os.environ.get('STARS_PRICE_WATCH_TTL', 600))
+# Fragment session record (JSON, same fields as the backend's) owned by the
+# service and used for background refreshes; without one, prices are only
+# refreshed on demand through the requesting user's own session
+STARS_PRICE_SESSION = os.environ.get('STARS_PRICE_SESSION', '')
+
+NANOTONS = Decimal(10 ** 9)
+_NUMBER = r'\d{1,3}(?:,\d{3})*(?:\.\d+)?|\d+(?:\.\d+)?'
+_PLAIN_AMOUNT = re.compile(rf'\s*({_NUMBER})\s*')
+# The TON price element: <div class="tm-value icon-before icon-ton">1,234.5</div>
+_TON_ELEMENT = re.compile(rf'<[^>]*\bclass="[^"]*\bicon-ton\b[^"]*"[^>]*>\s*({_NUMBER})\s*<')
+
+
+def parse_ton_amount(value: Any) -> Optional[int]:
+    """
+    Nanotons from a TON amount as Fragment renders it: a bare number
+    ("0.1234") or HTML with the amount in its icon-ton element. None if
+    the value is neither, rather than whatever number it happens to contain.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    text = str(value)
+    match = _PLAIN_AMOUNT.fullmatch(text) or _TON_ELEMENT.search(text)
+    if not match:
+        return None
+    try:
+        return int(Decimal(match.group(1).replace(',', '')) * NANOTONS)
+    except InvalidOperation:
+        return None
+
+
+class StarsPriceTable:
+    """
+    TON price of Telegram Stars by quantity, kept in memory.
+
+    Filled from Fragment's updateStarsPrices, on demand and on a background
+    refresh through the service's own STARS_PRICE_SESSION (which stops when
+    nothing has been bought or quoted for STARS_PRICE_WATCH_TTL), and from
+    the exact amounts of getBuyStarsLink transactions. Prices are per process.
+    """
+
+    def __init__(self, quantities: List[int] = STARS_PRICE_QUANTITIES, session_data: str = STARS_PRICE_SESSION):
+        self.quantities = quantities
+        # quantity -> (nanotons, monotonic time recorded, ISO time recorded)
+        self._prices: Dict[int, Tuple[int, float, str]] = {}
+        self._session_data: Optional[dict] = json.loads(session_data) if session_data else None
+        self._seen_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def record(self, quantity: int, nanotons: int) -> None:
+        if quantity > 0 and nanotons > 0:
+            self._prices[quantity] = (nanotons, time.monotonic(), datetime.now().isoformat())
+
+    def quote(self, quantity: int) -> Optional[Dict[str, Any]]:
+        """
+        Price of `quantity` stars, or None if no fresh price is known
+        """
+        now = time.monotonic()
+        fresh = {q: entry for q, entry in self._prices.items() if now - entry[1] <= STARS_PRICE_MAX_AGE}
+        if not fresh:
+            return None
+        # Fragment prices stars linearly, so the nearest quantity's per-star price applies
+        nearest = quantity if quantity in fresh else min(fresh, key=lambda q: abs(q - quantity))
+        nanotons, recorded, updated_at = fresh[nearest]
+        amount = nanotons if nearest == quantity else nanotons * quantity // nearest
+        return {
+            "quantity": quantity,
+            "amount": amount,
+            "amount_ton": f"{Decimal(amount) / NANOTONS:f}",
+            "exact": nearest == quantity,
+            "age": round(now - recorded, 1),
+            "updated_at": updated_at,
+        }
+
+    def get_table(self) -> List[Dict[str, Any]]:
+        quotes = (self.quote(q) for q in sorted(self._prices))
+        return [quote for quote in quotes if quote is not None and quote["exact"]]
+
+    async def refresh(self, session: FragmentSession) -> int:
+        """
+        Fetch the configured quantities' prices from Fragment; returns how many were updated
+        """
+        updated = 0
+        for quantity in self.quantities:
+            try:
+                result = await session.update_prices(quantity)
+            except Exception as e:
+                logger.warning('stars price refresh failed quantity=%s: %s', quantity, e)
+                continue
+            nanotons = parse_ton_amount(result.get('cur_price', result.get('amount')))
+            if nanotons is None:
+                logger.warning('stars price refresh: no price for quantity=%s in %s', quantity, list(result))
+                continue
+            self.record(quantity, nanotons)
+            updated += 1
+        return updated
+
+    def watch(self) -> None:
+        """
+        Keep prices refreshed through the service session while they are in use
+        """
+        self._seen_at = time.monotonic()
+        if self._session_data is None or STARS_PRICE_REFRESH_INTERVAL <= 0:
+            return
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh_loop())
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(STARS_PRICE_REFRESH_INTERVAL)
+            if time.monotonic() - self._seen_at > STARS_PRICE_WATCH_TTL:
+                return
+            t0 = time.monotonic()
+            updated = await self.refresh(FragmentSession.from_data(self._session_data))
+            logger.debug('refreshed %s stars price(s) in %.2fs', updated, time.monotonic() - t0)
+
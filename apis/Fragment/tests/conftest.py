@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Same import layout as main.py: the app root plus the starsBuy package dir
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'starsBuy'))
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import pytest
+
+import purchase_jobs
+from purchase_jobs import QUEUED, SENT, PurchaseJob, PurchaseJobManager, PurchaseJobStore, match_transaction
+
+WALLET = '0:' + '11' * 32
+FRAGMENT = '0:' + '22' * 32
+AMOUNT = 1_500_000_000
+
+
+def sent_job(job_id, comment=None, sent_at=1_000.0):
+    job = PurchaseJob(job_id, 1, 'alice', 50)
+    job.state = SENT
+    job.sent_at = sent_at
+    job.receipt = {'wallet_address': WALLET, 'destination': FRAGMENT, 'amount': AMOUNT}
+    if comment is not None:
+        job.receipt['comment'] = comment
+    return job
+
+
+def transfer(comment, utime=1_010):
+    return {
+        'hash': f'tx-{comment}',
+        'utime': utime,
+        'in_msg': {'hash': f'ext-{comment}'},
+        'out_msgs': [{
+            'destination': {'address': FRAGMENT},
+            'value': str(AMOUNT),
+            'decoded_op_name': 'text_comment',
+            'decoded_body': {'text': comment},
+        }],
+    }
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PurchaseJobStore(str(tmp_path / 'jobs.db'))
+
+
+def test_same_destination_and_amount_match_by_comment():
+    # Two purchases pending on one wallet, same Fragment address and amount
+    first = sent_job('first', comment='50 Telegram Stars Ref#AAA')
+    second = sent_job('second', comment='50 Telegram Stars Ref#BBB')
+    transactions = [transfer('50 Telegram Stars Ref#BBB'), transfer('50 Telegram Stars Ref#AAA')]
+
+    assert match_transaction(first, transactions, ambiguous=True)['hash'] == 'tx-50 Telegram Stars Ref#AAA'
+    assert match_transaction(second, transactions, ambiguous=True)['hash'] == 'tx-50 Telegram Stars Ref#BBB'
+    # The other job's transfer alone never confirms this one
+    assert match_transaction(first, transactions[:1], ambiguous=True) is None
+
+
+def test_job_without_comment_is_not_matched_when_ambiguous():
+    job = sent_job('legacy')
+    transactions = [transfer('50 Telegram Stars Ref#AAA')]
+
+    assert match_transaction(job, transactions, ambiguous=True) is None
+    assert match_transaction(job, transactions)['hash'] == 'tx-50 Telegram Stars Ref#AAA'
+
+
+def test_transfers_before_the_job_are_ignored():
+    job = sent_job('late', comment='50 Telegram Stars Ref#AAA', sent_at=5_000.0)
+
+    assert match_transaction(job, [transfer('50 Telegram Stars Ref#AAA', utime=1_000)]) is None
+
+
+def test_claim_sent_takes_over_only_lapsed_leases(store, monkeypatch):
+    job = sent_job('orphan')
+    store.insert(job)
+    monkeypatch.setattr(purchase_jobs, '_owner', lambda: 'host:1')
+    store.save(job, lease=60)
+
+    # Still leased by the process that sent it
+    monkeypatch.setattr(purchase_jobs, '_owner', lambda: 'host:2')
+    assert store.claim_sent(60) == []
+
+    store.save(job, lease=-1)
+    assert [j.job_id for j in store.claim_sent(60)] == ['orphan']
+    # Now held by the new owner
+    assert store.claim_sent(60) == []
+
+    # The old owner can no longer extend the lease
+    monkeypatch.setattr(purchase_jobs, '_owner', lambda: 'host:1')
+    store.renew(['orphan'], 3600)
+    with store._connect() as conn:
+        row = conn.execute("SELECT owner, lease_until FROM purchase_jobs WHERE job_id = 'orphan'").fetchone()
+    assert row['owner'] == 'host:2'
+    assert row['lease_until'] < time.time() + 120
+
+
+def test_replayed_idempotency_key_returns_the_original_job(tmp_path):
+    async def run():
+        # No workers, so submitted jobs stay queued
+        manager = PurchaseJobManager(service=None, path=str(tmp_path / 'jobs.db'), workers=0)
+        first, created = await manager.submit(1, 'alice', 50, idempotency_key='order-1')
+        replay, replay_created = await manager.submit(1, 'alice', 50, idempotency_key='order-1')
+        other_user, other_created = await manager.submit(2, 'alice', 50, idempotency_key='order-1')
+        found = await manager.find(1, 'order-1')
+        return first, created, replay, replay_created, other_user, other_created, found
+
+    first, created, replay, replay_created, other_user, other_created, found = asyncio.run(run())
+    assert created and not replay_created
+    assert replay.job_id == first.job_id
+    assert replay.state == QUEUED
+    # Keys are scoped to the user
+    assert other_created and other_user.job_id != first.job_id
+    assert found.job_id == first.job_id
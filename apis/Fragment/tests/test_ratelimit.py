@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+import pytest
+
+from common.ratelimit import AdaptiveRateLimiter, RateLimitedError, parse_retry_after
+
+
+def limiter(max_pause=None):
+    return AdaptiveRateLimiter(rate=5, burst=10, min_rate=0.5, max_rate=20, max_pause=max_pause)
+
+
+def test_retry_after_pause_is_clamped():
+    bucket = limiter(max_pause=2)
+    bucket.throttled(3600)
+
+    assert 0 < bucket.paused_until - time.monotonic() <= 2
+
+
+def test_retry_after_is_not_clamped_without_max_pause():
+    bucket = limiter()
+    bucket.throttled(3600)
+
+    assert bucket.paused_until - time.monotonic() > 3000
+
+
+def test_acquire_fails_fast_when_the_pause_outlasts_the_deadline():
+    bucket = limiter(max_pause=30)
+    bucket.throttled(3600)
+
+    started = time.monotonic()
+    with pytest.raises(RateLimitedError):
+        asyncio.run(bucket.acquire(timeout=1))
+    assert time.monotonic() - started < 0.5
+    assert bucket.waiting == 0
+
+
+def test_acquire_waits_out_a_pause_within_the_deadline():
+    bucket = limiter(max_pause=0.2)
+    bucket.throttled(60)
+
+    assert asyncio.run(bucket.acquire(timeout=5)) >= 0.15
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after('-5') == 0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
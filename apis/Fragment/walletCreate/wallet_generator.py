@@ -1,8 +1,26 @@
 import tqdm
 from tonsdk.contract.wallet import Wallets, WalletVersionEnum
+import gzip
 import json
+import multiprocessing
+import os
+import textwrap
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+# Generator processes are started from a clean server process rather than
+# forked from a (possibly threaded) API worker
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def new_executor(workers=None):
+    """Process pool for key generation (workers=None uses all cores)"""
+    return ProcessPoolExecutor(
+        max_workers=workers or os.cpu_count() or 1,
+        mp_context=multiprocessing.get_context(START_METHOD)
+    )
+
 class WalletGenerator:
     def __init__(self):
         self.output_file = "wallets.txt"
@@ -30,56 +48,52 @@ class WalletGenerator:
         except Exception as e:
             raise Exception(f"Error generating wallet: {str(e)}")
     
-    def generate_multiple_wallets(self, count):
-        """Generate multiple wallets and return list of wallet data"""
+    def iter_wallets_parallel(self, count, workers=None, chunksize=None, executor=None):
+        """
+        Yield wallet data, fanning key generation out across a process pool
+        (workers=None uses all cores). A long-lived `executor` is used as is;
+        otherwise a pool is started for this call.
+        """
+        workers = workers or getattr(executor, '_max_workers', None) or os.cpu_count() or 1
+        if chunksize is None:
+            chunksize = max(1, count // (workers * 4))
+        if executor is not None:
+            yield from executor.map(_generate_wallet, range(count), chunksize=chunksize)
+            return
+        with new_executor(workers) as pool:
+            yield from pool.map(_generate_wallet, range(count), chunksize=chunksize)
+    
+    def generate_multiple_wallets(self, count, workers=1):
+        """Generate multiple wallets and return list of wallet data (workers=None uses all cores)"""
         try:
-            wallets = []
-            
-            for i in tqdm.tqdm(range(count), desc="Generating wallets"):
-                wallet_data = self.generate_single_wallet()
-                wallets.append(wallet_data)
+            if workers == 1:
+                iterator = (self.generate_single_wallet() for _ in range(count))
+            else:
+                iterator = self.iter_wallets_parallel(count, workers)
             
-            return wallets
+            return list(tqdm.tqdm(iterator, total=count, desc="Generating wallets"))
             
         except Exception as e:
             raise Exception(f"Error generating multiple wallets: {str(e)}")
     
     def generate_wallets_to_file(self, count, filename=None):
-        """Generate wallets and save to file (legacy method)"""
+        """Generate wallets and append them to a file, in constant memory (legacy method); returns the number written"""
         try:
             if filename:
                 output_file = filename
             else:
                 output_file = self.output_file
             
-            output = ""
-            wallets = []
+            written = 0
             
-            for i in tqdm.tqdm(range(count), desc="Generating wallets"):
-                # Generate wallet
-                mnemonics, pub_k, priv_k, wallet = Wallets.create(WalletVersionEnum.v4r2, workchain=0)
-                wallet_address = wallet.address.to_string(True, True, False)
-                
-                # Add to output string
-                output += "\n\n" + wallet_address + "\n" + ' '.join(mnemonics) + "\n"
-                
-                # Add to wallets list
-                wallet_data = {
-                    "address": wallet_address,
-                    "mnemonics": mnemonics,
-                    "public_key": pub_k.hex() if hasattr(pub_k, 'hex') else str(pub_k),
-                    "private_key": priv_k.hex() if hasattr(priv_k, 'hex') else str(priv_k),
-                    "workchain": 0,
-                    "version": "v4r2",
-                    "generated_at": datetime.now().isoformat()
-                }
-                wallets.append(wallet_data)
-            
-            # Save to file
+            # Write each wallet as it is generated instead of buffering the output
             with open(output_file, "a") as f:
-                f.write(output)
+                for i in tqdm.tqdm(range(count), desc="Generating wallets"):
+                    wallet_data = self.generate_single_wallet()
+                    f.write("\n\n" + wallet_data["address"] + "\n" + ' '.join(wallet_data["mnemonics"]) + "\n")
+                    written += 1
             
-            return wallets
+            return written
             
         except Exception as e:
             raise Exception(f"Error generating wallets to file: {str(e)}")
@@ -102,21 +116,100 @@ class WalletGenerator:
             raise Exception(f"Error generating wallets JSON: {str(e)}")
     
     def save_wallets_to_json_file(self, count, filename="wallets.json"):
-        """Generate wallets and save to JSON file"""
+        """Generate wallets and stream them to a JSON file (same layout as generate_wallets_json)"""
         try:
-            json_data = self.generate_wallets_json(count)
-            
             with open(filename, "w") as f:
-                f.write(json_data)
+                f.write('{\n  "generated_at": %s,\n  "count": %d,\n  "wallets": [' % (
+                    json.dumps(datetime.now().isoformat()), count))
+                for i in tqdm.tqdm(range(count), desc="Generating wallets"):
+                    record = textwrap.indent(json.dumps(self.generate_single_wallet(), indent=2), "    ")
+                    f.write(("\n" if i == 0 else ",\n") + record)
+                f.write("\n  ]\n}" if count else "]\n}")
             
             return filename
             
         except Exception as e:
             raise Exception(f"Error saving wallets to JSON file: {str(e)}")
+    
+    def export_wallets_jsonl(self, count, filename, compress=None, resume=False, flush_every=1000, workers=1):
+        """
+        Stream wallets to a JSONL file, one record per line, in constant memory.
+        compress defaults to gzip for '.gz' filenames; resume continues an
+        interrupted export until the file holds count records.
+        Returns the number of records in the file.
+        """
+        try:
+            if compress is None:
+                compress = filename.endswith(".gz")
+            
+            done = 0
+            if resume and os.path.exists(filename):
+                done = _recover_jsonl(filename, compress)
+            
+            remaining = count - done
+            if remaining <= 0:
+                return done
+            
+            opener = gzip.open if compress else open
+            with opener(filename, "at" if resume else "wt", encoding="utf-8") as f:
+                if workers == 1:
+                    iterator = (self.generate_single_wallet() for _ in range(remaining))
+                else:
+                    iterator = self.iter_wallets_parallel(remaining, workers)
+                
+                for i, wallet_data in enumerate(tqdm.tqdm(iterator, total=remaining, desc="Exporting wallets"), 1):
+                    f.write(json.dumps(wallet_data, separators=(",", ":")) + "\n")
+                    if i % flush_every == 0:
+                        f.flush()
+            
+            return count
+            
+        except Exception as e:
+            raise Exception(f"Error exporting wallets to JSONL file: {str(e)}")
+
+def _recover_jsonl(filename, compress):
+    """
+    Count complete records in an interrupted JSONL export and drop any
+    partial trailing record so appending can continue cleanly.
+    """
+    if not compress:
+        done = 0
+        last_newline = 0
+        with open(filename, "rb") as f:
+            offset = 0
+            for line in f:
+                offset += len(line)
+                if line.endswith(b"\n"):
+                    done += 1
+                    last_newline = offset
+        with open(filename, "r+b") as f:
+            f.truncate(last_newline)
+        return done
+    
+    # A gzip stream cut off mid-member can't be appended to; copy the
+    # readable complete lines into a fresh file instead
+    done = 0
+    tmp_name = filename + ".tmp"
+    with gzip.open(tmp_name, "wb") as out:
+        try:
+            with gzip.open(filename, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    out.write(line)
+                    done += 1
+        except (EOFError, OSError, zlib.error):
+            pass
+    os.replace(tmp_name, filename)
+    return done
+
+def _generate_wallet(_index=None):
+    """Process pool entry point (must be a picklable module-level function)"""
+    return WalletGenerator().generate_single_wallet()
 
 # Legacy function for backward compatibility
 def generate_wallets(count):
-    """Legacy function to generate wallets and save to file"""
+    """Legacy function to generate wallets and save to file; returns the number written"""
     generator = WalletGenerator()
     return generator.generate_wallets_to_file(count)
 
@@ -148,17 +241,11 @@ if __name__ == "__main__":
         
         # Generate wallets
         generator = WalletGenerator()
-        wallets = generator.generate_wallets_to_file(count)
+        written = generator.generate_wallets_to_file(count)
         
         print(f"\n✅ Successfully generated {count} wallets!")
         print(f"📁 Wallets saved to: {generator.output_file}")
-        print(f"📊 Generated {len(wallets)} wallet(s)")
-        
-        # Show first wallet as example
-        if wallets:
-            print(f"\n📋 Example wallet:")
-            print(f"   Address: {wallets[0]['address']}")
-            print(f"   Mnemonics: {' '.join(wallets[0]['mnemonics'])}")
+        print(f"📊 Generated {written} wallet(s)")
         
     except ValueError:
         print("❌ Please enter a valid number.")
@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from cryptography.fernet import Fernet
+
+from common import metrics
+from walletCreate.wallet_generator import new_executor
+
+logger = logging.getLogger('wallet_pool')
+
+# One process at a time refills the reserve; its lease is renewed while it
+# runs and taken over by another process once it lapses
+REFILL_LEASE = float(os.environ.get('WALLET_POOL_REFILL_LEASE', 120))
+REFILL_CHECK_INTERVAL = 30
+
+
+def _owner():
+    # Computed per call: the pid changes after a fork
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class WalletPool:
+    """
+    Encrypted-at-rest reserve of pre-generated wallets.
+
+    Wallets are stored Fernet-encrypted in SQLite so the reserve survives
+    restarts and is shared by every worker process. Each process runs a
+    refill thread, but only the one holding the refill lease generates
+    wallets: it refills the reserve to the high watermark whenever it drops
+    below the low one, on a process pool kept for the life of the lease.
+    """
+
+    def __init__(self, generator, path, key, low_watermark=50, high_watermark=200, batch_size=50):
+        if low_watermark >= high_watermark:
+            raise ValueError("low_watermark must be below high_watermark")
+        self.generator = generator
+        self.path = path
+        self.fernet = Fernet(key)
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.batch_size = batch_size
+
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._executor = None
+
+        self.last_refill_rate = 0.0
+        self.last_refill_at = None
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS wallet_pool ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "payload BLOB NOT NULL, "
+                "created_at TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS wallet_pool_lease ("
+                "id INTEGER PRIMARY KEY CHECK (id = 1), "
+                "owner TEXT NOT NULL, "
+                "lease_until REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def start(self):
+        """Start the refill thread (once per process, so it survives forking servers)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._refill_loop, name='wallet-pool-refill', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        try:
+            self._release_lease()
+        except sqlite3.Error as e:
+            logger.warning('releasing wallet pool refill lease failed: %s', e)
+
+    def _acquire_lease(self):
+        """Take or renew the refill lease; True if this process holds it"""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO wallet_pool_lease (id, owner, lease_until) VALUES (1, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until "
+                "WHERE wallet_pool_lease.owner = excluded.owner OR wallet_pool_lease.lease_until < ?",
+                (_owner(), now + REFILL_LEASE, now)
+            )
+            return cursor.rowcount == 1
+
+    def _release_lease(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM wallet_pool_lease WHERE owner = ?", (_owner(),))
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = new_executor()
+        return self._executor
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def depth(self):
+        """Number of ready wallets in the reserve"""
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM wallet_pool").fetchone()[0]
+
+    def take(self):
+        """Pop a ready wallet, or return None if the reserve is empty"""
+        self.start()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, payload FROM wallet_pool ORDER BY id LIMIT 1").fetchone()
+            if row:
+                conn.execute("DELETE FROM wallet_pool WHERE id = ?", (row[0],))
+            depth = conn.execute("SELECT COUNT(*) FROM wallet_pool").fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        metrics.WALLET_POOL_DEPTH.set(depth)
+        self._wakeup.set()
+        if row is None:
+            metrics.WALLET_POOL_TAKES.inc(result='miss')
+            return None
+
+        metrics.WALLET_POOL_TAKES.inc(result='hit')
+        return json.loads(self.fernet.decrypt(row[1]))
+
+    def stats(self):
+        """Pool depth, refill rate and hit/miss counters (of every worker when METRICS_DIR is set)"""
+        depth = self.depth()
+        metrics.WALLET_POOL_DEPTH.set(depth)
+        takes = metrics.aggregate(metrics.WALLET_POOL_TAKES)
+        refill_rate = metrics.aggregate(metrics.WALLET_POOL_REFILL_RATE).get((), (0.0, None))[0]
+        return {
+            "depth": depth,
+            "low_watermark": self.low_watermark,
+            "high_watermark": self.high_watermark,
+            "hits": int(takes.get(('hit',), 0)),
+            "misses": int(takes.get(('miss',), 0)),
+            "refilled_total": int(metrics.aggregate(metrics.WALLET_POOL_REFILLED).get((), 0)),
+            "refill_rate_per_sec": round(refill_rate, 2),
+            "last_refill_at": self.last_refill_at,
+            "refilling": self._thread is not None and self._thread.is_alive()
+        }
+
+    def _fill(self, count):
+        t0 = time.monotonic()
+        try:
+            wallets = list(self.generator.iter_wallets_parallel(count, executor=self._get_executor()))
+        except BrokenProcessPool:
+            # Start a fresh pool next time
+            self._shutdown_executor()
+            raise
+        created_at = datetime.now().isoformat()
+        rows = [(self.fernet.encrypt(json.dumps(w).encode("utf-8")), created_at) for w in wallets]
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO wallet_pool (payload, created_at) VALUES (?, ?)", rows)
+            depth = conn.execute("SELECT COUNT(*) FROM wallet_pool").fetchone()[0]
+
+        elapsed = time.monotonic() - t0
+        self.last_refill_rate = len(rows) / elapsed if elapsed > 0 else 0.0
+        self.last_refill_at = created_at
+        metrics.WALLET_POOL_REFILLED.inc(len(rows))
+        metrics.WALLET_POOL_REFILL_RATE.set(self.last_refill_rate)
+        metrics.WALLET_POOL_DEPTH.set(depth)
+
+    def _refill_loop(self):
+        while not self._stop.is_set():
+            try:
+                if self._acquire_lease():
+                    depth = self.depth()
+                    if depth < self.low_watermark:
+                        while depth < self.high_watermark and not self._stop.is_set() and self._acquire_lease():
+                            self._fill(min(self.batch_size, self.high_watermark - depth))
+                            depth = self.depth()
+                        logger.info('wallet pool refilled depth=%s rate=%.1f/s', depth, self.last_refill_rate)
+                else:
+                    # Another process refills; don't keep idle generator processes here
+                    self._shutdown_executor()
+            except Exception as e:
+                logger.exception('wallet pool refill failed: %s', e)
+            self._wakeup.wait(timeout=REFILL_CHECK_INTERVAL)
+            self._wakeup.clear()
+        self._shutdown_executor()
@@ -64,6 +64,22 @@ class FragmentUserData {
     }
   }
 
+  // Get every active fragment session of a user (newest first)
+  static async getActiveSessionsByUserId(userId) {
+    try {
+      const [rows] = await pool.execute(`
+        SELECT fud.*, u.userName
+        FROM fragment_user_data fud 
+        JOIN users u ON fud.userId = u.id
+        WHERE fud.userId = ? AND fud.isActive = TRUE
+        ORDER BY fud.dateCreated DESC
+      `, [userId]);
+      return rows;
+    } catch (error) {
+      throw new Error(`Error fetching active fragment sessions: ${error.message}`);
+    }
+  }
+
   // Get fragment user data by fragment hash
   static async getByFragmentHash(fragmentHash) {
     try {
@@ -92,7 +108,8 @@ class FragmentUserData {
         stelDt,
         stelTonToken,
         stelToken,
-        cfClearance
+        cfClearance,
+        keepOthersActive
       } = fragmentData;
       
       // Check if user exists
@@ -105,11 +122,14 @@ class FragmentUserData {
         throw new Error('User not found');
       }
 
-      // Deactivate other active records for this user
-      await pool.execute(
-        'UPDATE fragment_user_data SET isActive = FALSE WHERE userId = ?',
-        [userId]
-      );
+      // Deactivate other active records for this user, unless the new
+      // session is added to the user's pool of sessions
+      if (!keepOthersActive) {
+        await pool.execute(
+          'UPDATE fragment_user_data SET isActive = FALSE WHERE userId = ?',
+          [userId]
+        );
+      }
 
       const [result] = await pool.execute(
         'INSERT INTO fragment_user_data (userId, fragmentHash, fragmentPublicKey, fragmentWallets, fragmentAddress, stelSsid, stelDt, stelTonToken, stelToken, cfClearance) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
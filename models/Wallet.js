@@ -138,6 +138,80 @@ class Wallet {
     }
   }
 
+  // Create many wallets with a single INSERT (all-or-nothing, one wallet per subscription)
+  static async createMany(walletsData) {
+    const connection = await pool.getConnection();
+    try {
+      const subscriptionIds = walletsData.map((w) => Number(w.subscriptionId));
+      if (new Set(subscriptionIds).size !== subscriptionIds.length) {
+        throw new Error('Duplicate subscriptionId in batch');
+      }
+
+      await connection.beginTransaction();
+
+      const placeholders = subscriptionIds.map(() => '?').join(', ');
+      const [subscriptionRows] = await connection.query(
+        `SELECT id FROM subscriptions WHERE id IN (${placeholders}) AND dateRevoked IS NULL`,
+        subscriptionIds
+      );
+      const validIds = new Set(subscriptionRows.map((row) => row.id));
+      const invalidIds = subscriptionIds.filter((id) => !validIds.has(id));
+      if (invalidIds.length > 0) {
+        throw new Error(`Subscription not found or revoked: ${invalidIds.join(', ')}`);
+      }
+
+      const [existingRows] = await connection.query(
+        `SELECT DISTINCT subscriptionId FROM wallets WHERE subscriptionId IN (${placeholders}) FOR UPDATE`,
+        subscriptionIds
+      );
+      if (existingRows.length > 0) {
+        throw new Error(`Subscription already has a wallet: ${existingRows.map((row) => row.subscriptionId).join(', ')}`);
+      }
+
+      const userIds = [...new Set(walletsData.map((w) => Number(w.userId)))];
+      const [userRows] = await connection.query(
+        `SELECT id FROM users WHERE id IN (${userIds.map(() => '?').join(', ')})`,
+        userIds
+      );
+      if (userRows.length !== userIds.length) {
+        throw new Error('User not found');
+      }
+
+      const values = walletsData.map((w) => [
+        w.subscriptionId,
+        w.userId,
+        w.walletAddress,
+        w.mnemonics,
+        w.publicKey,
+        w.privateKey,
+        w.tonApiKey || '',
+        w.workchain ?? 0,
+        w.version || 'v4r2'
+      ]);
+      await connection.query(
+        'INSERT INTO wallets (subscriptionId, userId, walletAddress, mnemonics, publicKey, privateKey, tonApiKey, workchain, version) VALUES ?',
+        [values]
+      );
+
+      await connection.commit();
+
+      const [rows] = await connection.query(`
+        SELECT w.*, u.userName, s.apiKey, s.selectedAPI, s.selectedSubscribe
+        FROM wallets w 
+        JOIN users u ON w.userId = u.id 
+        JOIN subscriptions s ON w.subscriptionId = s.id
+        WHERE w.subscriptionId IN (${placeholders})
+        ORDER BY w.id
+      `, subscriptionIds);
+      return rows;
+    } catch (error) {
+      await connection.rollback();
+      throw new Error(`Error creating wallets: ${error.message}`);
+    } finally {
+      connection.release();
+    }
+  }
+
   // Update wallet
   static async update(id, updateData) {
     try {
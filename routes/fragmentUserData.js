@@ -1,6 +1,8 @@
 const express = require('express');
 const router = express.Router();
 const FragmentUserData = require('../models/FragmentUserData');
+const Wallet = require('../models/Wallet');
+const fragmentApi = require('../services/fragmentApi');
 
 // Get all fragment user data
 router.get('/', async (req, res) => {
@@ -82,6 +84,47 @@ router.get('/user/:userId/active', async (req, res) => {
   }
 });
 
+// Get all active fragment sessions of a user
+router.get('/user/:userId/sessions', async (req, res) => {
+  try {
+    const sessions = await FragmentUserData.getActiveSessionsByUserId(req.params.userId);
+    res.json({
+      success: true,
+      message: 'لیست session های فعال Fragment با موفقیت دریافت شد',
+      data: sessions
+    });
+  } catch (error) {
+    res.status(500).json({
+      success: false,
+      message: `خطا در دریافت session های فعال Fragment: ${error.message}`
+    });
+  }
+});
+
+// Get wallet and active fragment data for a user in one call
+router.get('/user/:userId/context', async (req, res) => {
+  try {
+    const [wallets, sessions] = await Promise.all([
+      Wallet.getByUserId(req.params.userId),
+      FragmentUserData.getActiveSessionsByUserId(req.params.userId)
+    ]);
+    res.json({
+      success: true,
+      message: 'اطلاعات کاربر با موفقیت دریافت شد',
+      data: {
+        wallet: wallets[0] || null,
+        fragment: sessions[0] || null,
+        fragments: sessions
+      }
+    });
+  } catch (error) {
+    res.status(500).json({
+      success: false,
+      message: `خطا در دریافت اطلاعات کاربر: ${error.message}`
+    });
+  }
+});
+
 // Get fragment user data by fragment hash
 router.get('/hash/:fragmentHash', async (req, res) => {
   try {
@@ -117,7 +160,8 @@ router.post('/', async (req, res) => {
       stelSsid,
       stelDt,
       stelTonToken,
-      stelToken
+      stelToken,
+      keepOthersActive
     } = req.body;
     
     if (!userId || !fragmentHash || !fragmentPublicKey || !fragmentWallets || !fragmentAddress || !stelSsid || !stelDt || !stelTonToken || !stelToken) {
@@ -136,8 +180,10 @@ router.post('/', async (req, res) => {
       stelSsid,
       stelDt,
       stelTonToken,
-      stelToken
+      stelToken,
+      keepOthersActive: Boolean(keepOthersActive)
     });
+    fragmentApi.invalidateUserContext(userId);
 
     res.status(201).json({
       success: true,
@@ -178,6 +224,7 @@ router.put('/:id', async (req, res) => {
       stelToken,
       isActive
     });
+    fragmentApi.invalidateUserContext(fragmentData.userId);
 
     res.json({
       success: true,
@@ -195,7 +242,11 @@ router.put('/:id', async (req, res) => {
 // Delete fragment user data
 router.delete('/:id', async (req, res) => {
   try {
+    const existing = await FragmentUserData.getById(req.params.id);
     await FragmentUserData.delete(req.params.id);
+    if (existing) {
+      fragmentApi.invalidateUserContext(existing.userId);
+    }
     res.json({
       success: true,
       message: 'اطلاعات Fragment با موفقیت حذف شد'
@@ -212,6 +263,7 @@ router.delete('/:id', async (req, res) => {
 router.patch('/:id/activate', async (req, res) => {
   try {
     const fragmentData = await FragmentUserData.activate(req.params.id);
+    fragmentApi.invalidateUserContext(fragmentData.userId);
     res.json({
       success: true,
       message: 'اطلاعات Fragment با موفقیت فعال شد',
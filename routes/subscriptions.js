@@ -1,6 +1,7 @@
 const express = require('express');
 const router = express.Router();
 const Subscription = require('../models/Subscription');
+const fragmentApi = require('../services/fragmentApi');
 
 // Middleware to validate subscription data
 const validateSubscriptionData = (req, res, next) => {
@@ -123,6 +124,7 @@ router.put('/:id', async (req, res) => {
     const updateData = req.body;
     
     const updatedSubscription = await Subscription.update(subscriptionId, updateData);
+    fragmentApi.invalidateSubscription(subscriptionId);
     
     res.json({
       success: true,
@@ -142,6 +144,7 @@ router.delete('/:id', async (req, res) => {
   try {
     const subscriptionId = parseInt(req.params.id);
     await Subscription.delete(subscriptionId);
+    fragmentApi.invalidateSubscription(subscriptionId);
     
     res.json({
       success: true,
@@ -160,6 +163,7 @@ router.patch('/:id/revoke', async (req, res) => {
   try {
     const subscriptionId = parseInt(req.params.id);
     const revokedSubscription = await Subscription.revoke(subscriptionId);
+    fragmentApi.invalidateSubscription(subscriptionId);
     
     res.json({
       success: true,
@@ -179,6 +183,7 @@ router.patch('/:id/regenerate', async (req, res) => {
   try {
     const subscriptionId = parseInt(req.params.id);
     const updatedSubscription = await Subscription.regenerateApiKey(subscriptionId);
+    fragmentApi.invalidateSubscription(subscriptionId);
     
     res.json({
       success: true,
@@ -1,6 +1,7 @@
 const express = require('express');
 const router = express.Router();
 const Wallet = require('../models/Wallet');
+const fragmentApi = require('../services/fragmentApi');
 
 // Get all wallets
 router.get('/', async (req, res) => {
@@ -121,6 +122,7 @@ router.post('/', async (req, res) => {
       workchain,
       version
     });
+    fragmentApi.invalidateUserContext(userId);
 
     res.status(201).json({
       success: true,
@@ -135,6 +137,43 @@ router.post('/', async (req, res) => {
   }
 });
 
+// Create many wallets in one insert
+router.post('/bulk', async (req, res) => {
+  try {
+    const { wallets } = req.body;
+
+    if (!Array.isArray(wallets) || wallets.length === 0) {
+      return res.status(400).json({
+        success: false,
+        message: 'لیست ولت‌ها الزامی است'
+      });
+    }
+
+    const incomplete = wallets.some(({ subscriptionId, userId, walletAddress, mnemonics, publicKey, privateKey }) =>
+      !subscriptionId || !userId || !walletAddress || !mnemonics || !publicKey || !privateKey
+    );
+    if (incomplete) {
+      return res.status(400).json({
+        success: false,
+        message: 'تمام فیلدهای ضروری باید پر شوند'
+      });
+    }
+
+    const created = await Wallet.createMany(wallets);
+
+    res.status(201).json({
+      success: true,
+      message: 'ولت‌ها با موفقیت ایجاد شدند',
+      data: created
+    });
+  } catch (error) {
+    res.status(500).json({
+      success: false,
+      message: `خطا در ایجاد ولت‌ها: ${error.message}`
+    });
+  }
+});
+
 // Update wallet
 router.put('/:id', async (req, res) => {
   try {
@@ -148,6 +187,7 @@ router.put('/:id', async (req, res) => {
       workchain,
       version
     });
+    fragmentApi.invalidateUserContext(wallet.userId);
 
     res.json({
       success: true,
@@ -165,7 +205,11 @@ router.put('/:id', async (req, res) => {
 // Delete wallet
 router.delete('/:id', async (req, res) => {
   try {
+    const existing = await Wallet.getById(req.params.id);
     await Wallet.delete(req.params.id);
+    if (existing) {
+      fragmentApi.invalidateUserContext(existing.userId);
+    }
     res.json({
       success: true,
       message: 'ولت با موفقیت حذف شد'
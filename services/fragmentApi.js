@@ -0,0 +1,33 @@
+const axios = require('axios');
+
+const FRAGMENT_API_URL = process.env.FRAGMENT_API_URL || 'http://localhost:3003';
+const INTERNAL_API_TOKEN = process.env.INTERNAL_API_TOKEN || '';
+
+const client = axios.create({
+  baseURL: FRAGMENT_API_URL,
+  timeout: Number(process.env.FRAGMENT_API_TIMEOUT_MS || 2000),
+  headers: INTERNAL_API_TOKEN ? { 'X-Internal-Token': INTERNAL_API_TOKEN } : {}
+});
+
+// Notify the Python Fragment API that cached data is stale.
+// Fire-and-forget: a failed notification only means the cache expires by TTL.
+const notify = (path, body) => {
+  client.post(path, body).catch((error) => {
+    console.error(`⚠️ Fragment API cache invalidation failed (${path}): ${error.message}`);
+  });
+};
+
+// Invalidate a cached subscription (after update, delete, revoke or key regeneration)
+const invalidateSubscription = (subscriptionId) => {
+  notify('/internal/subscriptions/invalidate', { subscriptionId });
+};
+
+// Invalidate a user's cached wallet/fragment context (after wallet or cookie changes)
+const invalidateUserContext = (userId) => {
+  notify('/internal/user-context/invalidate', { userId });
+};
+
+module.exports = {
+  invalidateSubscription,
+  invalidateUserContext
+};